@@ -0,0 +1,325 @@
+'''
+asyncio HTTP server module - serves the routes of a StreamingHandler from one event loop
+'''
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import email.utils
+import http.client
+from http import HTTPStatus
+import io
+import traceback
+import http_files
+import websocket
+
+class AsyncWaker():
+    '''
+    AsyncWaker class - wakes the coroutines waiting for frames of one publisher (a FrameRing or a
+    VideoFileStream).  The publisher calls wake from its own thread once per frame, however many
+    clients are waiting.
+    '''
+    def __init__(self, loop, publisher):
+        '''
+        Constructor - listen to the publisher
+        '''
+        self.loop = loop
+        self.publisher = publisher
+        self.event = asyncio.Event()
+        self.users = 0
+        publisher.addListener(self.wake)
+
+    def wake(self):
+        '''
+        wake - called in the publisher's thread
+        '''
+        try:
+            self.loop.call_soon_threadsafe(self.notifyAll)
+        except RuntimeError:
+            pass  # the event loop has been closed
+
+    def notifyAll(self):
+        '''
+        notifyAll - release every coroutine waiting for the current frame
+        '''
+        self.event.set()
+        self.event = asyncio.Event()
+
+    async def wait(self, timeout):
+        '''
+        wait - wait for the next frame, False on timeout
+        '''
+        try:
+            await asyncio.wait_for(self.event.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    def close(self):
+        '''
+        close - stop listening to the publisher
+        '''
+        self.publisher.removeListener(self.wake)
+
+class AsyncStreamingServer():
+    '''
+    AsyncStreamingServer class - an HTTP server that runs every connection as a coroutine of one
+    event loop instead of a thread.
+
+    MJPEG streams and downloads are served by the event loop itself.  Frame sources come from the
+    server object's frameSource(path) method and are read without blocking; their producers wake
+    the loop through an AsyncWaker.  Long poll requests named by the server's optional longPoll(path)
+    method wait the same way before they are answered.  All other requests are handed to the
+    existing handler class in a small thread pool.
+    '''
+    streamTimeout = 10.0
+
+    def __init__(self, server, address, handlerClass, workers=4, reusePort=False):
+        '''
+        Constructor - server is a StreamingCameraServer or StreamingFileServer that was created without
+        binding, reusePort lets several processes listen on the address
+        '''
+        self.server = server
+        self.address = address
+        self.handlerClass = handlerClass
+        self.workers = workers
+        self.reusePort = reusePort
+        self.wakers = {}
+        self.loop = None
+
+    def serveForever(self):
+        '''
+        serveForever - run the event loop
+        '''
+        asyncio.run(self.main())
+
+    async def main(self):
+        '''
+        main - start listening
+        '''
+        self.loop = asyncio.get_running_loop()
+        self.loop.set_default_executor(ThreadPoolExecutor(max_workers=self.workers))
+        listener = await asyncio.start_server(self.handleClient, self.address[0] or None, self.address[1],
+                                              reuse_address=True, reuse_port=self.reusePort or None,
+                                              backlog=128)
+        print("asyncio server listening on", self.address)
+        async with listener:
+            await listener.serve_forever()
+
+    async def handleClient(self, reader, writer):
+        '''
+        handleClient - answer one request, the connection is closed afterwards
+        '''
+        clientAddress = writer.get_extra_info('peername')
+        try:
+            head = await reader.readuntil(b'\r\n\r\n')
+            (requestLine, _, headerBytes) = head.partition(b'\r\n')
+            (method, path, version) = requestLine.decode('latin-1').split()
+            headers = http.client.parse_headers(io.BytesIO(headerBytes))
+            body = b''
+            if headers.get('Content-Length'):
+                body = await reader.readexactly(int(headers['Content-Length']))
+            source = None
+            if method == 'GET':
+                source = await self.loop.run_in_executor(None, self.server.frameSource, path)
+                poll = None
+                if source is None and hasattr(self.server, 'longPoll'):
+                    poll = await self.loop.run_in_executor(None, self.server.longPoll, path)
+                if poll is not None:
+                    (cursor, after) = poll
+                    try:
+                        newer = await self.waitNewer(cursor.publisher, after)
+                    finally:
+                        cursor.close()
+                    if not newer:
+                        self.writeHead(writer, 304, [('ETag', '"{}"'.format(after))])
+                        await writer.drain()
+                        return
+            if source is not None and '/stream.ws' in path:
+                await self.serveWebSocket(reader, writer, headers, source)
+            elif source is not None:
+                await self.serveStream(writer, source)
+            elif method in ('GET', 'HEAD') and path.startswith('/download/'):
+                await self.serveFile(writer, method, headers, http_files.recordingName(path, '/download/'))
+            else:
+                response = await self.loop.run_in_executor(None, self.runHandler, head + body, clientAddress)
+                writer.write(response)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ValueError):
+            pass  # malformed or truncated request
+        except (BrokenPipeError, ConnectionResetError):
+            print('Removed client', clientAddress)
+        except Exception:
+            # logged like the threaded server's handle_error, the event loop keeps serving
+            print('-' * 40)
+            print('Exception occurred during processing of request from', clientAddress)
+            traceback.print_exc()
+            print('-' * 40)
+        finally:
+            writer.close()
+
+    def runHandler(self, request, clientAddress):
+        '''
+        runHandler - run the handler class on a buffered request, in a worker thread, returns the response bytes
+        '''
+        handler = self.handlerClass.__new__(self.handlerClass)
+        handler.server = self.server
+        handler.client_address = clientAddress
+        handler.request = None
+        handler.connection = None
+        handler.rfile = io.BytesIO(request)
+        handler.wfile = io.BytesIO()
+        handler.close_connection = True
+        handler.handle_one_request()
+        return handler.wfile.getvalue()
+
+    def writeHead(self, writer, status, headers):
+        '''
+        writeHead - write the status line and headers of a response
+        '''
+        lines = ['HTTP/1.0 {} {}'.format(status, HTTPStatus(status).phrase),
+                 'Date: {}'.format(email.utils.formatdate(usegmt=True)),
+                 'Connection: close']
+        lines += ['{}: {}'.format(keyword, value) for (keyword, value) in headers]
+        writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+
+    async def serveFile(self, writer, method, headers, fileName):
+        '''
+        serveFile - send a recording with the event loop's zero copy sendfile
+        '''
+        if fileName is None:
+            self.writeHead(writer, 404, [('Content-Length', 0)])
+            await writer.drain()
+            return
+        response = await self.loop.run_in_executor(None, http_files.prepareFile, headers, fileName)
+        self.writeHead(writer, response.status, response.headers)
+        await writer.drain()
+        if response.fileHandle is None:
+            return
+        with response.fileHandle:
+            if method == 'GET' and response.count > 0:
+                await self.loop.sendfile(writer.transport, response.fileHandle, response.first, response.count)
+
+    def useWaker(self, publisher):
+        '''
+        useWaker - the waker of a publisher, created for its first client
+        '''
+        waker = self.wakers.get(publisher)
+        if waker is None:
+            waker = AsyncWaker(self.loop, publisher)
+            self.wakers[publisher] = waker
+        waker.users += 1
+        return waker
+
+    def releaseWaker(self, waker):
+        '''
+        releaseWaker - a client no longer uses a waker, which stops listening after its last client
+        '''
+        waker.users -= 1
+        if waker.users == 0:
+            waker.close()
+            del self.wakers[waker.publisher]
+
+    async def waitNewer(self, publisher, sequence):
+        '''
+        waitNewer - wait, without holding a worker thread, until the publisher has a frame other than
+        the one with the given sequence number, False after the server's long poll timeout
+        '''
+        waker = self.useWaker(publisher)
+        try:
+            deadline = self.loop.time() + self.server.longPollTimeout
+            while publisher.sequence == sequence:
+                remaining = deadline - self.loop.time()
+                if remaining <= 0 or not await waker.wait(remaining):
+                    return publisher.sequence != sequence
+            return True
+        finally:
+            self.releaseWaker(waker)
+
+    async def serveStream(self, writer, source):
+        '''
+        serveStream - send frames of a source as a multipart MJPEG stream
+        '''
+        waker = self.useWaker(source.publisher)
+        try:
+            self.writeHead(writer, 200, [('Age', 0),
+                                         ('Cache-Control', 'no-cache, private'),
+                                         ('Pragma', 'no-cache'),
+                                         ('Content-Type', 'multipart/x-mixed-replace; boundary=FRAME')])
+            while True:
+                (sequence, frame) = source.poll()
+                if sequence is None:
+                    if not await waker.wait(self.streamTimeout):
+                        print("No frame for", self.streamTimeout, "seconds - ending stream")
+                        break
+                    continue
+                if frame is None:
+                    break
+                writer.write(b'--FRAME\r\nContent-Type: image/jpeg\r\nContent-Length: ' +
+                             str(len(frame)).encode('ascii') + b'\r\n\r\n')
+                writer.write(frame)
+                writer.write(b'\r\n')
+                await writer.drain()
+        finally:
+            self.releaseWaker(waker)
+            source.close()
+
+    async def serveWebSocket(self, reader, writer, headers, source):
+        '''
+        serveWebSocket - send frames of a source as binary WebSocket messages, honoring the client's
+        rate and pause requests, which are read by a second coroutine
+        '''
+        accept = websocket.acceptKey(headers)
+        if accept is None:
+            source.close()
+            self.writeHead(writer, 400, [('Content-Length', 0)])
+            return
+        self.writeHead(writer, 101, [('Upgrade', 'websocket'),
+                                     ('Connection', 'Upgrade'),
+                                     ('Sec-WebSocket-Accept', accept)])
+        client = websocket.WebSocketClient()
+        changed = asyncio.Event()
+        async def receive():
+            try:
+                while not client.closed:
+                    reply = client.receive(await reader.read(4096))
+                    if reply:
+                        writer.write(reply)
+                    changed.set()
+            except (ConnectionResetError, ValueError):
+                client.closed = True
+            finally:
+                changed.set()
+        receiver = asyncio.ensure_future(receive())
+        waker = self.useWaker(source.publisher)
+        sent = 0
+        try:
+            while not client.closed and not receiver.done():
+                if client.paused:
+                    changed.clear()
+                    await changed.wait()
+                    continue
+                (sequence, frame) = source.poll()
+                if sequence is None:
+                    if not await waker.wait(self.streamTimeout):
+                        print("No frame for", self.streamTimeout, "seconds - ending WebSocket stream")
+                        break
+                    continue
+                if frame is None:
+                    break
+                writer.write(websocket.frameHeader(len(frame)))
+                writer.write(frame)
+                await writer.drain()
+                sent += 1
+                if client.interval() > 0:
+                    changed.clear()
+                    try:
+                        await asyncio.wait_for(changed.wait(), client.interval())
+                    except asyncio.TimeoutError:
+                        pass
+                    source.skip()
+            if not client.closed:
+                writer.write(websocket.frameHeader(0, websocket.opClose))
+        finally:
+            print("WebSocket frames sent:", sent)
+            receiver.cancel()
+            self.releaseWaker(waker)
+            source.close()
@@ -0,0 +1,124 @@
+#!/usr/bin/python3
+'''
+Benchmark - throughput and correctness of FrameSplitter on a large recording, compared with the
+10000 byte start of frame search and BytesIO copy that the servers used before.
+
+usage: python3 benchmarks/bench_frame_splitter.py [megabytes]
+'''
+import contextlib
+import io
+import os
+import random
+import sys
+import tempfile
+import time
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from mjpeg import FrameIndex, FrameSplitter
+
+def makeRecording(directory, megabytes):
+    '''
+    makeRecording - write frames of 20 to 60 kB, about the size of VGA MJPEG frames, with 0xff bytes
+    stuffed as in JPEG entropy coded data
+    '''
+    fileName = os.path.join(directory, "bench.mjpeg")
+    random.seed(0)
+    bodies = [bytes(random.randrange(0, 0x100) for byte in range(4096)).replace(b"\xff", b"\xff\x00") for body in range(16)]
+    frames = 0
+    with open(fileName, "wb") as fileHandle:
+        while fileHandle.tell() < megabytes * 1024 * 1024:
+            body = b"".join(random.choice(bodies) for block in range(random.randint(5, 15)))
+            fileHandle.write(b"\xff\xd8" + body + b"\xff\xd9")
+            frames += 1
+    return (fileName, frames)
+
+class LegacyOutput():
+    '''
+    The StreamingOutput.write of the camera server before FrameSplitter
+    '''
+    def __init__(self):
+        self.buffer = io.BytesIO()
+        self.frames = []
+
+    def write(self, buf):
+        if buf.startswith(b'\xff\xd8'):
+            self.buffer.truncate()
+            self.frames.append(self.buffer.getvalue())
+            self.buffer.seek(0)
+        return self.buffer.write(buf)
+
+def runLegacy(fileName, chunkSize):
+    '''
+    runLegacy - the chunked start of frame search of the old readFile loops, without their spin loops
+    '''
+    output = LegacyOutput()
+    startOfFrame = b"\xff\xd8"
+    with open(fileName, "rb") as fileHandle:
+        output.write(startOfFrame)
+        buff = fileHandle.read(chunkSize)
+        segmentStart = 0
+        while buff:
+            location = buff.find(startOfFrame, segmentStart)
+            while location > 0:
+                output.write(buff[segmentStart:location])
+                segmentStart = location
+                location = buff.find(startOfFrame, segmentStart + 2)
+            output.write(buff[segmentStart:])
+            segmentStart = 0
+            buff = fileHandle.read(chunkSize)
+    return output.frames[1:]
+
+def runSplitter(fileName, chunkSize):
+    '''
+    runSplitter - FrameSplitter fed with chunks of chunkSize bytes
+    '''
+    splitter = FrameSplitter()
+    frames = []
+    with open(fileName, "rb") as fileHandle:
+        chunk = fileHandle.read(chunkSize)
+        while chunk:
+            frames.extend(frame for (offset, frame) in splitter.feed(chunk))
+            chunk = fileHandle.read(chunkSize)
+    return frames
+
+def runIndex(fileName, chunkSize):
+    '''
+    runIndex - build a FrameIndex, which scans with FrameSplitter in chunks of FrameIndex.chunkSize
+    '''
+    status = os.stat(fileName)
+    with contextlib.redirect_stdout(io.StringIO()):
+        index = FrameIndex.build(fileName, status)
+    return [None] * len(index)
+
+def wellFormed(frame):
+    '''
+    wellFormed - a frame with exactly one start and one end of image marker, at its ends
+    '''
+    return (frame is None or
+            (bytes(frame[:2]) == b"\xff\xd8" and bytes(frame[-2:]) == b"\xff\xd9" and bytes(frame).count(b"\xff\xd8") == 1))
+
+def main():
+    '''
+    Main program
+    '''
+    megabytes = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    with tempfile.TemporaryDirectory() as directory:
+        (fileName, frames) = makeRecording(directory, megabytes)
+        size = os.path.getsize(fileName)
+        print("recording: {:.0f} MB, {} frames".format(size / 1e6, frames))
+        print("{:>22} {:>8} {:>10} {:>10} {:>8} {:>10}".format("parser", "chunk", "MB/s", "frames/s", "frames", "malformed"))
+        for (name, runner, chunkSize) in (("legacy BytesIO", runLegacy, 10000),
+                                          ("FrameSplitter", runSplitter, 10000),
+                                          ("FrameSplitter", runSplitter, 65536),
+                                          ("FrameSplitter", runSplitter, 1024 * 1024),
+                                          ("FrameIndex.build", runIndex, FrameIndex.chunkSize)):
+            with open(fileName, "rb") as fileHandle:
+                fileHandle.read()  # same page cache state for every run
+            start = time.perf_counter()
+            found = runner(fileName, chunkSize)
+            elapsed = time.perf_counter() - start
+            malformed = sum(1 for frame in found if not wellFormed(frame))
+            print("{:>22} {:>8} {:>10.0f} {:>10.0f} {:>8} {:>10}".format(name, chunkSize, size / 1e6 / elapsed,
+                                                                         len(found) / elapsed, len(found), malformed))
+
+if __name__ == '__main__':
+    main()
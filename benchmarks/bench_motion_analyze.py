@@ -0,0 +1,111 @@
+#!/usr/bin/python3
+'''
+Benchmark - cost of counting the active cells of one motion vector frame, as MotionDetector.analyze
+does in the camera's callback thread, with ZoneSet compared with the whole frame mask
+multiplication used before.  The frames are replayed from a .npy file of saved motion data when one
+is given, otherwise generated.
+
+usage: python3 benchmarks/bench_motion_analyze.py [frames.npy]
+'''
+import os
+import sys
+import time
+import numpy as np
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from motion import MotionZone, ZoneSet
+
+motionType = np.dtype([('x', 'i1'), ('y', 'i1'), ('sad', 'u2')])  # picamera's motion data
+frameRates = (15, 30, 60, 90)
+repeats = 5
+
+def makeFrames(count, shape=(30, 41)):
+    '''
+    makeFrames - motion frames of VGA size with sensor noise and a moving object
+    '''
+    generator = np.random.default_rng(0)
+    frames = np.zeros((count,) + shape, dtype=motionType)
+    frames['sad'] = generator.integers(0, 300, size=frames.shape)
+    for (number, frame) in enumerate(frames):
+        column = number % (shape[1] - 8)
+        frame['sad'][20:28, column:column + 8] += 600
+    return frames
+
+def defaultMask():
+    '''
+    defaultMask - the mask HandleDefaults starts with, rows 25 to 29 without the last column
+    '''
+    mask = np.zeros((30, 41), dtype=int)
+    mask[25:, :40] = 1
+    return mask
+
+def checkerMask():
+    '''
+    checkerMask - a scattered mask whose bounding box is the whole frame
+    '''
+    mask = np.zeros((30, 41), dtype=int)
+    mask[::2, ::2] = 1
+    return mask
+
+def runLegacy(frames, mask):
+    '''
+    runLegacy - the expression analyze evaluated before ZoneSet
+    '''
+    counts = []
+    for frame in frames:
+        counts.append(((frame['sad'] * mask) > 255).sum())
+    return counts
+
+def runZoneSet(frames, mask):
+    '''
+    runZoneSet - ZoneSet.score of a single zone, the mask prepared once
+    '''
+    zones = ZoneSet([MotionZone('default', mask)])
+    counts = []
+    for frame in frames:
+        counts.append(zones.score(frame['sad'], 100.0)[1])
+    return counts
+
+def runZones(frames, mask):
+    '''
+    runZones - ZoneSet.score of the mask split into four weighted zones, counts of all zones together
+    '''
+    quarters = []
+    for number in range(4):
+        quarter = np.zeros(mask.shape, dtype=int)
+        quarter[:, number * mask.shape[1] // 4:(number + 1) * mask.shape[1] // 4 + (number == 3)] = 1
+        quarters.append(MotionZone(str(number), quarter * mask, 0.25 * (number + 1), 10.0 * (number + 1)))
+    zones = ZoneSet(quarters)
+    counts = []
+    for frame in frames:
+        counts.append(zones.score(frame['sad'], 100.0)[1])
+    return counts
+
+def main():
+    '''
+    Main program
+    '''
+    if len(sys.argv) > 1:
+        frames = np.load(sys.argv[1])
+    else:
+        frames = makeFrames(5000)
+    print("motion frames:", len(frames), "of", frames.shape[1:])
+    print("{:>8} {:>12} {:>12} {}".format("mask", "analyzer", "us/frame",
+                                          " ".join("{:>8}".format("cpu@" + str(rate)) for rate in frameRates)))
+    for (maskName, mask) in (("default", defaultMask()), ("whole", np.ones((30, 41), dtype=int)), ("checker", checkerMask())):
+        expected = None
+        for (name, runner) in (("legacy", runLegacy), ("ZoneSet", runZoneSet), ("4 zones", runZones)):
+            perFrame = None
+            for attempt in range(repeats):  # the best run, the others were disturbed
+                start = time.perf_counter()
+                counts = runner(frames, mask)
+                elapsed = (time.perf_counter() - start) / len(frames)
+                perFrame = elapsed if perFrame is None else min(perFrame, elapsed)
+            if expected is None:
+                expected = counts
+            elif list(map(int, counts)) != list(map(int, expected)):
+                print("counts of", name, "differ from legacy for mask", maskName)
+            print("{:>8} {:>12} {:>12.2f} {}".format(maskName, name, perFrame * 1e6,
+                                                     " ".join("{:>7.2f}%".format(perFrame * rate * 100) for rate in frameRates)))
+
+if __name__ == '__main__':
+    main()
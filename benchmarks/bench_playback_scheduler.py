@@ -0,0 +1,116 @@
+#!/usr/bin/python3
+'''
+Benchmark - thread count, context switches and frame rate of the playback scheduler as the number
+of playback sessions grows, compared with one thread per session.
+
+usage: python3 benchmarks/bench_playback_scheduler.py [seconds per run]
+'''
+import contextlib
+import io
+import os
+import resource
+import sys
+import tempfile
+import threading
+import time
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from playback import PlaybackScheduler, VideoFileStream
+
+frameCount = 150
+
+def makeRecording(directory):
+    '''
+    makeRecording - write a synthetic 10 second recording
+    '''
+    fileName = os.path.join(directory, "bench.mjpeg")
+    with open(fileName, "wb") as fileHandle:
+        for frameNumber in range(frameCount):
+            fileHandle.write(b"\xff\xd8" + bytes(20000) + b"\xff\xd9")
+    return fileName
+
+def contextSwitches():
+    '''
+    contextSwitches - voluntary plus involuntary context switches of this process
+    '''
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_nvcsw + usage.ru_nivcsw
+
+class CountingStream(VideoFileStream):
+    '''
+    A VideoFileStream that counts the frames it publishes
+    '''
+    def publish(self, frame):
+        self.published += 1
+
+def makeStreams(fileName, sessions):
+    '''
+    makeStreams - one stream per session, each with its own speed factor so that none are shared
+    '''
+    streams = []
+    for session in range(sessions):
+        stream = CountingStream(fileName, 1, frameCount, 1.0 + session / 100000.0)
+        stream.published = 0
+        streams.append(stream)
+    return streams
+
+scheduler = PlaybackScheduler()
+
+def runScheduler(fileName, sessions, seconds):
+    '''
+    runScheduler - all sessions driven by one PlaybackScheduler
+    '''
+    streams = makeStreams(fileName, sessions)
+    for stream in streams:
+        scheduler.add(stream, stream.open())
+    return measure(streams, seconds)
+
+def runThreads(fileName, sessions, seconds):
+    '''
+    runThreads - one thread per session, sleeping until each frame is due
+    '''
+    def play(stream):
+        deadline = stream.open()
+        governor = threading.Condition()
+        while deadline is not None:
+            with governor:
+                governor.wait(max(0.0, deadline - time.monotonic()))
+            deadline = stream.advance()
+    streams = makeStreams(fileName, sessions)
+    for stream in streams:
+        threading.Thread(target=play, args=(stream,), daemon=True).start()
+    return measure(streams, seconds)
+
+def measure(streams, seconds):
+    '''
+    measure - let the streams play and collect the statistics
+    '''
+    time.sleep(0.5)  # settle
+    for stream in streams:
+        stream.published = 0
+    threads = threading.active_count()
+    switches = contextSwitches()
+    time.sleep(seconds)
+    switches = contextSwitches() - switches
+    published = sum(stream.published for stream in streams)
+    for stream in streams:
+        stream.setStop()
+    time.sleep(0.5)  # let the stopped streams drain
+    return (threads, switches / seconds, published / seconds / len(streams))
+
+def main():
+    '''
+    Main program
+    '''
+    seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 5.0
+    scheduler.start()
+    with tempfile.TemporaryDirectory() as directory:
+        fileName = makeRecording(directory)
+        print("{:>8} {:>10} {:>8} {:>14} {:>12}".format("sessions", "mode", "threads", "switches/s", "fps/session"))
+        for sessions in (1, 10, 50, 100, 200):
+            for (mode, runner) in (("scheduler", runScheduler), ("threads", runThreads)):
+                with contextlib.redirect_stdout(io.StringIO()):  # silence the playback progress messages
+                    (threads, switches, fps) = runner(fileName, sessions, seconds)
+                print("{:>8} {:>10} {:>8} {:>14.0f} {:>12.2f}".format(sessions, mode, threads, switches, fps))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,242 @@
+'''
+Recording catalog module - an SQLite index of the recordings in the working directory, so that
+listing them does not scan the directory
+'''
+import calendar
+import collections
+import glob
+import html
+import os
+import sqlite3
+import threading
+import time
+from urllib.parse import parse_qs, urlencode
+from mjpeg import FrameIndex, TimestampTrack, defaultFrameInterval
+import http_files
+
+Recording = collections.namedtuple('Recording', ['fileName', 'triggerTime', 'size', 'frames', 'duration', 'peakActiveCells'])
+
+class RecordingCatalog():
+    '''
+    RecordingCatalog class - size, frame count, duration, trigger time and peak motion of every
+    recording, kept in an SQLite file by whoever writes or deletes recordings.
+
+    Listings are read a page at a time, newest first, by walking the trigger time index from a
+    (trigger time, file name) key, so a page costs the same with ten recordings or ten thousand.
+    '''
+    schema = ('CREATE TABLE IF NOT EXISTS recordings ('
+              'fileName TEXT PRIMARY KEY, triggerTime REAL NOT NULL, size INTEGER NOT NULL, '
+              'frames INTEGER NOT NULL, duration REAL NOT NULL, peakActiveCells INTEGER)',
+              'CREATE INDEX IF NOT EXISTS recordingsByTime ON recordings (triggerTime, fileName)')
+    namePattern = "Motion_Detected%Y-%m-%d:%H:%M:%S"
+
+    def __init__(self, fileName='recordings.db'):
+        '''
+        Constructor - open, or create, the catalog file
+        '''
+        self.fileName = fileName
+        self.connection = sqlite3.connect(fileName, timeout=10.0, check_same_thread=False, isolation_level=None)
+        self.connection.execute('PRAGMA journal_mode=WAL')  # the camera and playback servers share the file
+        for statement in self.schema:
+            self.connection.execute(statement)
+        self.condition = threading.Condition()  # for controlling access to the connection
+
+    def add(self, recording):
+        '''
+        add - insert or replace the entry of a recording
+        '''
+        with self.condition:
+            self.connection.execute('INSERT OR REPLACE INTO recordings VALUES (?, ?, ?, ?, ?, ?)', tuple(recording))
+
+    def remove(self, fileName):
+        '''
+        remove - drop the entry of a deleted recording
+        '''
+        with self.condition:
+            self.connection.execute('DELETE FROM recordings WHERE fileName = ?', (fileName,))
+
+    def delete(self, fileName):
+        '''
+        delete - delete a recording, its sidecar files and its entry.  The entry is dropped even when
+        the file is already gone, the error is raised after.
+        '''
+        try:
+            os.remove(fileName)
+        finally:
+            FrameIndex.forget(fileName)
+            self.remove(fileName)
+
+    def record(self, fileName, triggerTime=None, peakActiveCells=None):
+        '''
+        record - describe a recording from the file, its frame index and its timestamp track, and add
+        it.  Without a trigger time the first frame's capture time, the time in the file name or the
+        file's modification time is used.  H.264 recordings have no frame index, their frames are
+        counted from the timestamp track.
+        '''
+        status = os.stat(fileName)
+        track = TimestampTrack.load(fileName)
+        if http_files.isMotionJPEG(fileName):
+            frames = len(FrameIndex.load(fileName))
+        else:
+            frames = len(track) if track is not None else 0
+        if track is not None and len(track) > 0:
+            duration = track.time(len(track)) - track.time(1)
+        else:
+            duration = frames * defaultFrameInterval
+        if triggerTime is None and track is not None and len(track) > 0:
+            triggerTime = track.base
+        if triggerTime is None:
+            triggerTime = self.nameTime(fileName)
+        if triggerTime is None:
+            triggerTime = status.st_mtime
+        recording = Recording(fileName, triggerTime, status.st_size, frames, duration, peakActiveCells)
+        self.add(recording)
+        return recording
+
+    def nameTime(self, fileName):
+        '''
+        nameTime - the UTC time in the name of a motion recording, None for other names
+        '''
+        try:
+            return float(calendar.timegm(time.strptime(os.path.splitext(fileName)[0], self.namePattern)))
+        except ValueError:
+            return None
+
+    def sync(self):
+        '''
+        sync - bring the catalog in line with the working directory, for recordings written or
+        deleted while nobody kept it up to date.  This is the one listing that scans the directory.
+        '''
+        known = {}
+        with self.condition:
+            for (fileName, size) in self.connection.execute('SELECT fileName, size FROM recordings'):
+                known[fileName] = size
+        present = set()
+        for pattern in http_files.recordingPatterns:
+            for fileName in glob.glob(pattern):
+                present.add(fileName)
+                status = http_files.fileStatus(fileName)
+                if status is not None and known.get(fileName) != status[1]:
+                    print("Adding", fileName, "to the recording catalog")
+                    try:
+                        self.record(fileName)
+                    except OSError as error:
+                        print("Could not catalog", fileName, error)
+        for fileName in known:
+            if fileName not in present:
+                self.remove(fileName)
+
+    def page(self, start=None, stop=None, before=None, limit=50):
+        '''
+        page - (recordings, key of the next page) of up to limit recordings triggered in [start, stop),
+        newest first, older than the before key.  The key is None on the last page.
+        '''
+        conditions = []
+        parameters = []
+        if start is not None:
+            conditions.append('triggerTime >= ?')
+            parameters.append(start)
+        if stop is not None:
+            conditions.append('triggerTime < ?')
+            parameters.append(stop)
+        if before is not None:
+            conditions.append('(triggerTime, fileName) < (?, ?)')
+            parameters.extend(before)
+        query = 'SELECT * FROM recordings'
+        if conditions:
+            query += ' WHERE ' + ' AND '.join(conditions)
+        query += ' ORDER BY triggerTime DESC, fileName DESC LIMIT ?'
+        parameters.append(limit + 1)
+        with self.condition:
+            recordings = [Recording(*row) for row in self.connection.execute(query, parameters)]
+        nextKey = None
+        if len(recordings) > limit:
+            recordings = recordings[:limit]
+            nextKey = (recordings[-1].triggerTime, recordings[-1].fileName)
+        return (recordings, nextKey)
+
+    def between(self, start, stop):
+        '''
+        between - the recordings triggered in [start, stop), oldest first
+        '''
+        with self.condition:
+            return [Recording(*row) for row in self.connection.execute(
+                'SELECT * FROM recordings WHERE triggerTime >= ? AND triggerTime < ? ORDER BY triggerTime, fileName',
+                (start, stop))]
+
+    def oldest(self, limit=10):
+        '''
+        oldest - up to limit of the earliest triggered recordings, oldest first
+        '''
+        with self.condition:
+            return [Recording(*row) for row in self.connection.execute(
+                'SELECT * FROM recordings ORDER BY triggerTime, fileName LIMIT ?', (limit,))]
+
+    def usage(self):
+        '''
+        usage - (number of recordings, their total size in bytes)
+        '''
+        with self.condition:
+            return tuple(self.connection.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM recordings').fetchone())
+
+    def newest(self, extension=None):
+        '''
+        newest - the most recently triggered recording, of those whose name ends with extension if
+        given, None if there is none
+        '''
+        if extension is None:
+            (recordings, nextKey) = self.page(limit=1)
+            return recordings[0] if recordings else None
+        with self.condition:
+            row = self.connection.execute('SELECT * FROM recordings WHERE fileName LIKE ? '
+                                          'ORDER BY triggerTime DESC, fileName DESC LIMIT 1', ('%' + extension,)).fetchone()
+        return Recording(*row) if row is not None else None
+
+    def close(self):
+        '''
+        close - close the catalog file
+        '''
+        with self.condition:
+            self.connection.close()
+
+def listingQuery(query):
+    '''
+    listingQuery - the page arguments of an index page query string: from and to dates (YYYY-MM-DD,
+    UTC, both days included) and the before key of an older page
+    '''
+    arguments = parse_qs(query)
+    listing = {}
+    for (name, argument, days) in (('from', 'start', 0), ('to', 'stop', 1)):
+        try:
+            day = time.strptime(arguments[name][0], "%Y-%m-%d")
+            listing[argument] = calendar.timegm(day) + days * 86400
+        except (KeyError, ValueError):
+            pass
+    (triggerTime, _, fileName) = arguments.get('before', [''])[0].partition(' ')
+    try:
+        listing['before'] = (float(triggerTime), fileName)
+    except ValueError:
+        pass
+    return listing
+
+def filterForm(action, query):
+    '''
+    filterForm - HTML of the date filter form of an index page
+    '''
+    arguments = parse_qs(query)
+    form = '<form action="' + action + '" method="get">'
+    form += '<label for="from">From </label><input type="date" name="from" value="' + html.escape(arguments.get('from', [''])[0]) + '">'
+    form += '<label for="to"> to </label><input type="date" name="to" value="' + html.escape(arguments.get('to', [''])[0]) + '">'
+    form += ' <input type="submit" value="Filter">'
+    form += '</form>'
+    return form
+
+def olderLink(action, query, nextKey):
+    '''
+    olderLink - HTML of the link from a page of an index page listing to the next, older, page
+    '''
+    if nextKey is None:
+        return ''
+    arguments = [(name, value) for (name, values) in parse_qs(query).items() if name in ('from', 'to') for value in values]
+    arguments.append(('before', '{!r} {}'.format(nextKey[0], nextKey[1])))
+    return '<a href="' + action + '?' + html.escape(urlencode(arguments)) + '">older recordings</a>'
@@ -0,0 +1,169 @@
+'''
+Event recorder module - writes motion events to recordings while they happen
+'''
+import collections
+import io
+import threading
+import time
+from mjpeg import TimestampTrack, startOfFrame
+
+nalStartCode = b"\x00\x00\x00\x01"  # the encoder starts every NAL unit with the four byte start code
+idrPicture = 5  # NAL unit type of the slices of a key frame
+pictureTypes = (1, idrPicture)  # NAL unit types of the slices of a picture, SPS and PPS headers are not frames
+
+class EventRecorder(threading.Thread):
+    '''
+    EventRecorder class - records one motion event into a .mjpeg or, from the H.264 encoder, a .h264 file.
+
+    The thread first takes the pre-trigger frames out of the camera's circular buffer and attaches
+    itself to the recording tee, both while holding the tee, so that every chunk of the encoder ends
+    up in the recording exactly once.  Only the chunk references are taken under the lock, the
+    frames are copied after it is released.  Live chunks wait in a bounded queue, which is written out in
+    batches; when the queue is full whole frames are dropped instead of stalling the encoder.  The
+    event lasts until postTrigger seconds after the last extend(), but no longer than maximumSeconds,
+    and ends at a frame boundary.  An H.264 recording starts at the SPS header of a key frame,
+    firstFrame, so that it can be decoded on its own.
+    '''
+    postTrigger = 15.0  # seconds recorded after the last motion
+    batchBytes = 256 * 1024  # written as soon as this much is queued
+    batchInterval = 1.0  # seconds, and at least this often
+    maxQueueBytes = 8 * 1024 * 1024
+
+    def __init__(self, fileName, tee, stream, preTriggerFrames, triggerTime, maximumSeconds=120.0, preTriggerSeconds=None, onFinish=None,
+                 eventFormat='mjpeg', firstFrame=None):
+        '''
+        Constructor - stream is the camera's circular buffer, preTriggerFrames(seconds, firstFrame)
+        the position copy_to starts at and the wall-clock times of the frames it copies,
+        onFinish(recorder) is called after the recording is complete
+        '''
+        super(EventRecorder, self).__init__(daemon=True)
+        self.fileName = fileName
+        self.tee = tee
+        self.stream = stream
+        self.preTriggerFrames = preTriggerFrames
+        self.triggerTime = triggerTime
+        self.maximumSeconds = maximumSeconds
+        self.preTriggerSeconds = preTriggerSeconds
+        self.onFinish = onFinish
+        self.eventFormat = eventFormat
+        self.firstFrame = firstFrame
+        self.lastMotion = triggerTime
+        self.chunks = collections.deque()
+        self.queuedBytes = 0
+        self.times = []
+        self.dropping = False
+        self.droppedFrames = 0
+        self.closing = None  # time the event ended, the recording closes at the next frame
+        self.closed = False
+        self.error = None  # the OSError that ended the recording early
+        self.condition = threading.Condition()  # for controlling access to the queue
+
+    def extend(self):
+        '''
+        extend - motion continues, keep recording
+        '''
+        with self.condition:
+            self.lastMotion = time.time()
+
+    def isFrameStart(self, buf):
+        '''
+        isFrameStart - whether a chunk from the encoder starts a frame
+        '''
+        if self.eventFormat == 'h264':
+            return bytes(buf[:4]) == nalStartCode and len(buf) > 4 and buf[4] & 0x1f in pictureTypes
+        return bytes(buf[:2]) == startOfFrame
+
+    def write(self, buf):
+        '''
+        write - queue a chunk from the encoder, called by the tee in the encoder's thread
+        '''
+        frameStart = self.isFrameStart(buf)
+        with self.condition:
+            if self.closed:
+                return len(buf)
+            if frameStart:
+                if self.closing is not None:
+                    self.closed = True
+                    self.condition.notify()
+                    return len(buf)
+                # H.264 frames after a dropped one can not be decoded, dropping goes on until a key frame
+                resumable = self.eventFormat != 'h264' or buf[4] & 0x1f == idrPicture
+                self.dropping = self.queuedBytes + len(buf) > self.maxQueueBytes or (self.dropping and not resumable)
+                if self.dropping:
+                    self.droppedFrames += 1
+                else:
+                    self.times.append(time.time())
+            if not self.dropping:
+                self.chunks.append(buf)
+                self.queuedBytes += len(buf)
+                if self.queuedBytes >= self.batchBytes:
+                    self.condition.notify()
+        return len(buf)
+
+    def flush(self):
+        '''
+        flush - nothing to do, the queue is written by the thread
+        '''
+
+    def attach(self):
+        '''
+        attach - copy the pre-trigger frames and join the tee, returns the copied bytes
+        '''
+        with self.tee.condition:
+            with self.stream.lock:
+                (position, self.times) = self.preTriggerFrames(self.preTriggerSeconds, self.firstFrame)
+                chunks = list(self.stream._data)  # the buffer replaces its chunks, it never changes one
+            self.tee.attach(self)
+        preTrigger = io.BytesIO()
+        if position is not None:
+            for chunk in chunks:
+                if position < len(chunk):
+                    preTrigger.write(chunk[position:])
+                position = max(position - len(chunk), 0)
+        return preTrigger.getbuffer()
+
+    def run(self):
+        '''
+        run - write the event to its file and its timestamp track.  When the file can not be written,
+        as on a full card, the event is given up, but the recorder still leaves the tee and reports
+        to onFinish, with the error in self.error.
+        '''
+        print("Writing file:", self.fileName)
+        try:
+            preTrigger = self.attach()
+            with open(self.fileName, "wb") as fileHandle:
+                fileHandle.write(preTrigger)
+                preTrigger.release()
+                done = False
+                while not done:
+                    with self.condition:
+                        self.condition.wait_for(lambda: self.queuedBytes >= self.batchBytes or self.closed, self.batchInterval)
+                        now = time.time()
+                        if self.closing is None and (now - self.lastMotion > self.postTrigger or
+                                                     now - self.triggerTime > self.maximumSeconds):
+                            self.closing = now
+                        if self.closing is not None and now - self.closing > 2 * self.batchInterval:
+                            self.closed = True  # the encoder has stopped, the last frame may be cut short
+                        batch = list(self.chunks)
+                        self.chunks.clear()
+                        self.queuedBytes = 0
+                        done = self.closed
+                    if batch:
+                        fileHandle.write(b"".join(batch))
+                        fileHandle.flush()
+        except OSError as error:
+            print("Could not write", self.fileName, ":", error)
+            self.error = error
+        finally:
+            self.tee.detach(self)
+            with self.condition:
+                self.closed = True
+                self.chunks.clear()
+                self.queuedBytes = 0
+                times = list(self.times)
+            if self.error is None:
+                TimestampTrack.write(self.fileName, times)
+                print("Done writing", self.fileName, ":", round(times[-1] - times[0], 1) if times else 0, "seconds,",
+                      self.droppedFrames, "frames dropped")
+            if self.onFinish is not None:
+                self.onFinish(self)
@@ -0,0 +1,135 @@
+'''
+Frame ring module - hands frames from one producer to many HTTP clients
+'''
+import threading
+
+class FrameRing():
+    '''
+    FrameRing class - a small ring of the most recent frames, each with a monotonically increasing
+    sequence number.  The producer never waits for clients; every client reads through its own
+    FrameCursor.  A frame of None marks the end of a stream.
+    '''
+    def __init__(self, slots=8):
+        '''
+        Constructor
+        '''
+        self.slots = [(0, None)] * slots  # (sequence number, frame)
+        self.sequence = 0  # sequence number of the newest frame, 0 before the first frame
+        self.dropped = 0  # frames dropped by all clients together
+        self.listeners = []  # called, in the producer's thread, after every frame
+        self.condition = threading.Condition()  # for controlling access to the ring
+
+    def publish(self, frame, sequence=None):
+        '''
+        publish - add a frame to the ring, overwriting the oldest one.  A producer that relays frames
+        numbered elsewhere passes their increasing sequence numbers, which may leave gaps.
+        '''
+        with self.condition:
+            self.sequence = self.sequence + 1 if sequence is None else sequence
+            self.slots[self.sequence % len(self.slots)] = (self.sequence, frame)
+            self.condition.notify_all()
+            listeners = self.listeners
+        for listener in listeners:
+            listener()
+
+    def addListener(self, listener):
+        '''
+        addListener - call listener after every frame published
+        '''
+        with self.condition:
+            self.listeners = self.listeners + [listener]
+
+    def removeListener(self, listener):
+        '''
+        removeListener - stop calling listener
+        '''
+        with self.condition:
+            self.listeners = [aListener for aListener in self.listeners if aListener is not listener]
+
+    def latest(self):
+        '''
+        latest - (sequence number, frame) of the newest frame
+        '''
+        with self.condition:
+            return self.slot(self.sequence)
+
+    def slot(self, sequence):
+        '''
+        slot - (sequence number, frame) of a frame still in the ring, the frame is None if it is not
+        '''
+        (slotSequence, frame) = self.slots[sequence % len(self.slots)]
+        return (sequence, frame if slotSequence == sequence else None)
+
+    def newer(self, sequence, timeout=None):
+        '''
+        newer - (sequence number, frame) of the newest frame as soon as it is not the frame with the
+        given sequence number, waiting up to timeout seconds.  Returns (None, None) on timeout.
+        '''
+        with self.condition:
+            if not self.condition.wait_for(lambda: self.sequence != sequence, timeout):
+                return (None, None)
+            return self.slot(self.sequence)
+
+    def cursor(self, onClose=None):
+        '''
+        cursor - a client cursor that starts with the next frame published, onClose is called when
+        the cursor is closed
+        '''
+        with self.condition:
+            return FrameCursor(self, self.sequence, onClose)
+
+class FrameCursor():
+    '''
+    FrameCursor class - the read position of one client in a FrameRing
+    '''
+    def __init__(self, ring, sequence, onClose=None):
+        '''
+        Constructor
+        '''
+        self.ring = ring
+        self.publisher = ring
+        self.sequence = sequence  # sequence number of the last frame read
+        self.dropped = 0
+        self.onClose = onClose
+
+    def next(self, timeout=None):
+        '''
+        next - the frame after the last one read, waiting up to timeout seconds for it.  A client that
+        has fallen further behind than the ring holds, or whose next frame was never published,
+        skips to the newest frame.  Returns (sequence number, frame), or (None, None) on timeout.
+        '''
+        ring = self.ring
+        with ring.condition:
+            if not ring.condition.wait_for(lambda: ring.sequence > self.sequence, timeout):
+                return (None, None)
+            (slotSequence, frame) = ring.slots[(self.sequence + 1) % len(ring.slots)]
+            if slotSequence == self.sequence + 1:
+                self.sequence += 1
+                return (self.sequence, frame)
+            if slotSequence > self.sequence + 1:
+                dropped = ring.sequence - self.sequence - 1
+                self.dropped += dropped
+                ring.dropped += dropped
+            self.sequence = ring.sequence
+            return ring.slot(ring.sequence)
+
+    def poll(self):
+        '''
+        poll - next without waiting
+        '''
+        return self.next(timeout=0)
+
+    def skip(self):
+        '''
+        skip - continue with the next frame published, without counting the skipped frames as dropped
+        '''
+        with self.ring.condition:
+            self.sequence = self.ring.sequence
+
+    def close(self):
+        '''
+        close - the client is done with the ring
+        '''
+        (onClose, self.onClose) = (self.onClose, None)
+        if onClose is not None:
+            onClose()
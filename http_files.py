@@ -0,0 +1,275 @@
+'''
+HTTP file transfer module - serves recordings to HTTP clients with Range, ETag and os.sendfile,
+and pages and static assets from memory with ETag and gzip
+'''
+import collections
+import email.utils
+import fnmatch
+import gzip
+import hashlib
+import os
+import threading
+from urllib.parse import unquote
+
+recordingPatterns = ('*.mjpeg', '*.h264')
+recordingTypes = {'.mjpeg': 'video/x-motion-jpeg', '.h264': 'video/h264'}
+
+class RangeNotSatisfiable(Exception):
+    '''
+    Raised for a Range header that selects no byte of the file
+    '''
+
+def recordingName(path, prefix):
+    '''
+    recordingName - name of the recording a request path refers to, None if it is not a recording in the working directory
+    '''
+    fileName = unquote(path[len(prefix):])
+    if fileName != os.path.basename(fileName) or fileName.startswith('.'):
+        return None
+    if not any(fnmatch.fnmatch(fileName, pattern) for pattern in recordingPatterns):
+        return None
+    return fileName
+
+def parseRange(rangeHeader, size):
+    '''
+    parseRange - (first byte, last byte) of a single range "bytes=" header, None when the header is
+    not a single byte range and should be ignored
+    '''
+    (unit, _, ranges) = rangeHeader.partition('=')
+    if unit.strip().lower() != 'bytes' or ',' in ranges:
+        return None
+    (first, _, last) = ranges.strip().partition('-')
+    try:
+        if first == '':
+            suffix = int(last)
+            if suffix <= 0:
+                raise RangeNotSatisfiable()
+            return (max(0, size - suffix), size - 1)
+        first = int(first)
+        last = int(last) if last != '' else size - 1
+    except ValueError:
+        return None
+    if first >= size:
+        raise RangeNotSatisfiable()
+    if first > last:
+        return None
+    return (first, min(last, size - 1))
+
+def fileStatus(fileName):
+    '''
+    fileStatus - (modification time, size) of a file, None if it does not exist
+    '''
+    try:
+        status = os.stat(fileName)
+    except FileNotFoundError:
+        return None
+    return (status.st_mtime_ns, status.st_size)
+
+def contentType(fileName):
+    '''
+    contentType - MIME type of a recording
+    '''
+    return recordingTypes.get(os.path.splitext(fileName)[1], 'application/octet-stream')
+
+def isMotionJPEG(fileName):
+    '''
+    isMotionJPEG - whether a recording is made of JPEG frames, which the servers can play back;
+    H.264 recordings are only downloaded
+    '''
+    return os.path.splitext(fileName)[1] == '.mjpeg'
+
+class FileResponse():
+    '''
+    FileResponse class - status, headers and byte range of the answer to a request for a file.
+    fileHandle is the open file when a body has to be sent, otherwise None.
+    '''
+    def __init__(self, status, headers, fileHandle=None, first=0, count=0):
+        '''
+        Constructor
+        '''
+        self.status = status
+        self.headers = headers
+        self.fileHandle = fileHandle
+        self.first = first
+        self.count = count
+
+def prepareFile(requestHeaders, fileName):
+    '''
+    prepareFile - decide how to answer a request for a file, honoring Range, If-Range and If-None-Match
+    '''
+    try:
+        fileHandle = open(fileName, 'rb')
+    except FileNotFoundError:
+        return FileResponse(404, [('Content-Length', 0)])
+    status = os.fstat(fileHandle.fileno())
+    size = status.st_size
+    etag = '"{:x}-{:x}-{:x}"'.format(status.st_ino, status.st_mtime_ns, size)
+    lastModified = email.utils.formatdate(status.st_mtime, usegmt=True)
+    if etag in [tag.strip() for tag in requestHeaders.get('If-None-Match', '').split(',')]:
+        fileHandle.close()
+        return FileResponse(304, [('ETag', etag)])
+    (first, last) = (0, size - 1)
+    partial = False
+    rangeHeader = requestHeaders.get('Range')
+    ifRange = requestHeaders.get('If-Range')
+    if rangeHeader and (ifRange is None or ifRange in (etag, lastModified)):
+        try:
+            byteRange = parseRange(rangeHeader, size)
+        except RangeNotSatisfiable:
+            fileHandle.close()
+            return FileResponse(416, [('Content-Range', 'bytes */{}'.format(size)), ('Content-Length', 0)])
+        if byteRange is not None:
+            (first, last) = byteRange
+            partial = True
+    count = last - first + 1
+    headers = [('Content-Type', contentType(fileName)),
+               ('Content-Length', count),
+               ('Accept-Ranges', 'bytes'),
+               ('ETag', etag),
+               ('Last-Modified', lastModified),
+               ('Content-Disposition', 'attachment; filename="{}"'.format(os.path.basename(fileName)))]
+    if partial:
+        headers.append(('Content-Range', 'bytes {}-{}/{}'.format(first, last, size)))
+    return FileResponse(206 if partial else 200, headers, fileHandle, first, count)
+
+def sendFile(handler, fileName):
+    '''
+    sendFile - answer a GET or HEAD request with a file.
+    The body is sent with os.sendfile straight from the page cache to the socket.
+    '''
+    response = prepareFile(handler.headers, fileName)
+    handler.send_response(response.status)
+    for (keyword, value) in response.headers:
+        handler.send_header(keyword, value)
+    handler.end_headers()
+    if response.fileHandle is None:
+        return
+    with response.fileHandle:
+        if handler.command == 'HEAD':
+            return
+        handler.wfile.flush()
+        (first, count) = (response.first, response.count)
+        try:
+            socketNumber = handler.connection.fileno()
+            while count > 0:
+                sent = os.sendfile(socketNumber, response.fileHandle.fileno(), first, count)
+                if sent == 0:
+                    break
+                first += sent
+                count -= sent
+        except (BrokenPipeError, ConnectionResetError):
+            print("Download of", fileName, "interrupted by client")
+
+class CachedContent():
+    '''
+    CachedContent class - a response body kept in memory together with its ETag and its gzip
+    compressed form, so that answering a request only writes bytes
+    '''
+    minimumGzipBytes = 512  # smaller bodies are sent as they are
+
+    def __init__(self, content, contentType):
+        '''
+        Constructor
+        '''
+        self.content = content
+        self.contentType = contentType
+        self.etag = '"{}"'.format(hashlib.blake2b(content, digest_size=8).hexdigest())
+        self.compressed = None
+        if len(content) >= self.minimumGzipBytes:
+            compressed = gzip.compress(content, compresslevel=9, mtime=0)
+            if len(compressed) < len(content):
+                self.compressed = compressed
+
+    def send(self, handler):
+        '''
+        send - answer a GET or HEAD request, 304 when the client's copy is current
+        '''
+        if self.etag in [tag.strip() for tag in handler.headers.get('If-None-Match', '').split(',')]:
+            handler.send_response(304)
+            handler.send_header('ETag', self.etag)
+            handler.end_headers()
+            return
+        body = self.content
+        acceptEncoding = [coding.split(';')[0].strip() for coding in handler.headers.get('Accept-Encoding', '').split(',')]
+        handler.send_response(200)
+        handler.send_header('Content-Type', self.contentType)
+        if self.compressed is not None:
+            handler.send_header('Vary', 'Accept-Encoding')
+            if 'gzip' in acceptEncoding:
+                body = self.compressed
+                handler.send_header('Content-Encoding', 'gzip')
+        handler.send_header('Content-Length', len(body))
+        handler.send_header('ETag', self.etag)
+        handler.send_header('Cache-Control', 'no-cache')
+        handler.end_headers()
+        if handler.command != 'HEAD':
+            handler.wfile.write(body)
+
+class StaticAsset():
+    '''
+    StaticAsset class - a file such as a style sheet, served from memory.  The file is only read
+    again when its modification time changes.
+    '''
+    def __init__(self, fileName, contentType):
+        '''
+        Constructor
+        '''
+        self.fileName = fileName
+        self.contentType = contentType
+        self.mtime = None
+        self.cached = None
+
+    def load(self):
+        '''
+        load - the CachedContent of the file, None if it does not exist
+        '''
+        try:
+            mtime = os.stat(self.fileName).st_mtime_ns
+            if mtime != self.mtime:
+                with open(self.fileName, 'rb') as fileHandle:
+                    self.cached = CachedContent(fileHandle.read(), self.contentType)
+                self.mtime = mtime
+        except FileNotFoundError:
+            (self.mtime, self.cached) = (None, None)
+        return self.cached
+
+    def send(self, handler):
+        '''
+        send - answer a request for the asset
+        '''
+        cached = self.load()
+        if cached is None:
+            handler.send_error(404)
+            return
+        cached.send(handler)
+
+class PageCache():
+    '''
+    PageCache class - rendered pages, each rebuilt only when the inputs it was rendered from change.
+    The least recently used pages are dropped beyond maxPages.
+    '''
+    def __init__(self, maxPages=64):
+        '''
+        Constructor
+        '''
+        self.maxPages = maxPages
+        self.pages = collections.OrderedDict()  # name -> (inputs, CachedContent)
+        self.condition = threading.Condition()  # for controlling access to the pages
+
+    def get(self, name, inputs, render, contentType='text/html; charset=utf-8'):
+        '''
+        get - the CachedContent of a page; render() builds its text when inputs differ from the
+        ones the cached page was built from
+        '''
+        with self.condition:
+            cached = self.pages.get(name)
+            if cached is not None and cached[0] == inputs:
+                self.pages.move_to_end(name)
+                return cached[1]
+        page = CachedContent(render().encode('utf-8'), contentType)
+        with self.condition:
+            self.pages[name] = (inputs, page)
+            self.pages.move_to_end(name)
+            while len(self.pages) > self.maxPages:
+                self.pages.popitem(last=False)
+        return page
@@ -0,0 +1,532 @@
+'''
+MJPEG recording module - helpers shared by the camera and playback servers
+'''
+from array import array
+import bisect
+import calendar
+import collections
+import mmap
+import os
+import re
+import struct
+import threading
+import time
+
+startOfFrame = b"\xff\xd8"
+endOfFrame = b"\xff\xd9"
+markerPattern = re.compile(b"\xff[\xd8\xd9]")  # start or end of image
+defaultFrameInterval = 1.0 / 15  # the camera's default frame rate
+
+class FrameSplitter():
+    '''
+    FrameSplitter class - splits an MJPEG byte stream, fed in chunks of any size, into JPEG frames
+    that run from a start of image marker to the following end of image marker.
+
+    Markers split across two chunks are found.  A frame that lies within one chunk is handed out as
+    a memoryview slice of that chunk without copying it, so the chunks must not be modified
+    afterwards; only frames that span chunks are assembled in a bytearray of their own.  A frame
+    cut short by a new start of image marker is dropped.
+    '''
+    maxFrameBytes = 8 * 1024 * 1024  # an unfinished frame larger than this is garbage
+
+    def __init__(self):
+        '''
+        Constructor
+        '''
+        self.position = 0  # stream offset of the next byte fed
+        self.start = None  # stream offset of the unfinished frame, None between frames
+        self.pending = bytearray()  # the part of the unfinished frame fed in earlier chunks
+        self.trailing = False  # the last chunk ended with 0xff, maybe the first half of a marker
+        self.end = 0  # stream offset after the last complete frame
+
+    def feed(self, chunk):
+        '''
+        feed - add the next chunk of the stream, returns a list of (stream offset, frame) of the frames it completed
+        '''
+        frames = []
+        view = memoryview(chunk)
+        size = len(chunk)
+        index = 0
+        frameStart = 0  # where the unfinished frame's bytes begin in this chunk
+        if self.trailing and size > 0:
+            if chunk[0] == startOfFrame[1]:
+                self.start = self.position - 1
+                self.pending = bytearray(startOfFrame[:1])
+                index = 1
+            elif self.start is not None and chunk[0] == endOfFrame[1]:
+                self.pending += view[:1]
+                frames.append((self.start, self.pending))
+                self.end = self.position + 1
+                self.start = None
+                self.pending = bytearray()
+                index = 1
+        for match in markerPattern.finditer(chunk, index):
+            location = match.start()
+            if chunk[location + 1] == startOfFrame[1]:
+                if self.start is not None:
+                    print("Dropping a frame cut short by the next one")
+                self.start = self.position + location
+                self.pending = bytearray()
+                frameStart = location
+            elif self.start is not None:
+                end = location + 2
+                if self.pending:
+                    self.pending += view[frameStart:end]
+                    frames.append((self.start, self.pending))
+                    self.pending = bytearray()
+                else:
+                    frames.append((self.start, view[frameStart:end]))
+                self.end = self.position + end
+                self.start = None
+        if self.start is not None:
+            self.pending += view[frameStart:]
+            if len(self.pending) > self.maxFrameBytes:
+                print("Dropping", len(self.pending), "bytes without an end of image marker")
+                self.start = None
+                self.pending = bytearray()
+        self.trailing = size > 0 and chunk[-1] == 0xff
+        self.position += size
+        return frames
+
+class FrameIndex():
+    '''
+    FrameIndex class - maps frame numbers (1 based) of a .mjpeg recording to byte offsets and lengths.
+
+    The index is built once by scanning the recording and is kept in a sidecar file next to it
+    (<recording>.idx).  The sidecar records the mtime and size of the recording it was built from
+    and is rebuilt automatically when either changes.
+    '''
+    magic = b"MJPGIDX1"
+    header = struct.Struct("<8sqqI")
+    chunkSize = 1024 * 1024
+    cache = {}
+    loading = set()  # recordings whose index is being read or built
+    condition = threading.Condition()  # for rendevous of cache object
+
+    def __init__(self, fileName, mtime, size, offsets):
+        '''
+        Constructor - offsets holds the start of every frame followed by the end of the last frame
+        '''
+        self.fileName = fileName
+        self.mtime = mtime
+        self.size = size
+        self.offsets = offsets
+
+    def __len__(self):
+        '''
+        number of frames in the recording
+        '''
+        return len(self.offsets) - 1
+
+    def offset(self, frameNumber):
+        '''
+        offset - byte offset of a frame
+        '''
+        return self.offsets[frameNumber - 1]
+
+    def length(self, frameNumber):
+        '''
+        length - byte length of a frame
+        '''
+        return self.offsets[frameNumber] - self.offsets[frameNumber - 1]
+
+    def isCurrent(self, status):
+        '''
+        isCurrent - True if the index still describes a recording with the given os.stat result
+        '''
+        return self.mtime == status.st_mtime_ns and self.size == status.st_size
+
+    @staticmethod
+    def sidecarName(fileName):
+        '''
+        sidecarName - name of the index file that belongs to a recording
+        '''
+        return fileName + ".idx"
+
+    @classmethod
+    def load(cls, fileName):
+        '''
+        load - get the index of a recording, from memory, from its sidecar or by scanning the recording.
+        The sidecar is read or the recording scanned without holding the cache, so only the loads of
+        the same recording wait for it.
+        '''
+        status = os.stat(fileName)
+        with cls.condition:  # cache object access
+            cls.condition.wait_for(lambda: fileName not in cls.loading)
+            frameIndex = cls.cache.get(fileName)
+            if frameIndex is not None and frameIndex.isCurrent(status):
+                return frameIndex
+            cls.loading.add(fileName)
+        try:
+            frameIndex = cls.readSidecar(fileName, status)
+            if frameIndex is None:
+                frameIndex = cls.build(fileName, status)
+                frameIndex.writeSidecar()
+            with cls.condition:  # cache object access
+                cls.cache[fileName] = frameIndex
+        finally:
+            with cls.condition:  # cache object access
+                cls.loading.discard(fileName)
+                cls.condition.notify_all()
+        return frameIndex
+
+    @classmethod
+    def forget(cls, fileName):
+        '''
+        forget - drop a recording's index, mapping and timestamp track, used when the recording is deleted
+        '''
+        with cls.condition:  # cache object access
+            cls.cache.pop(fileName, None)
+            cls.condition.notify_all()
+        MappedRecording.forget(fileName)
+        for sidecar in (cls.sidecarName(fileName), TimestampTrack.sidecarName(fileName)):
+            try:
+                os.remove(sidecar)
+            except FileNotFoundError:
+                pass
+
+    @classmethod
+    def build(cls, fileName, status):
+        '''
+        build - scan a recording for its frames
+        '''
+        print("Building frame index for:", fileName)
+        offsets = array('Q')
+        splitter = FrameSplitter()
+        with open(fileName, "rb") as fileHandle:
+            chunk = fileHandle.read(cls.chunkSize)
+            while chunk:
+                offsets.extend(offset for (offset, frame) in splitter.feed(chunk))
+                chunk = fileHandle.read(cls.chunkSize)
+        # a frame cut short at the end of the recording is left out
+        offsets.append(splitter.end)
+        return cls(fileName, status.st_mtime_ns, status.st_size, offsets)
+
+    @classmethod
+    def readSidecar(cls, fileName, status):
+        '''
+        readSidecar - read an index from its sidecar file, None if it is missing or stale
+        '''
+        try:
+            with open(cls.sidecarName(fileName), "rb") as fileHandle:
+                (magic, mtime, size, count) = cls.header.unpack(fileHandle.read(cls.header.size))
+                if magic != cls.magic or mtime != status.st_mtime_ns or size != status.st_size:
+                    return None
+                offsets = array('Q')
+                offsets.fromfile(fileHandle, count + 1)
+        except (OSError, EOFError, struct.error):
+            return None
+        return cls(fileName, mtime, size, offsets)
+
+    def writeSidecar(self):
+        '''
+        writeSidecar - save the index next to the recording
+        '''
+        sidecar = self.sidecarName(self.fileName)
+        try:
+            with open(sidecar + ".tmp", "wb") as fileHandle:
+                fileHandle.write(self.header.pack(self.magic, self.mtime, self.size, len(self)))
+                self.offsets.tofile(fileHandle)
+            os.replace(sidecar + ".tmp", sidecar)
+        except OSError as error:
+            print("Could not write frame index:", sidecar, error)
+
+class MappedRecording():
+    '''
+    MappedRecording class - a read only memory map of a recording that hands out frames as memoryview
+    slices of the mapped file, so frames reach the HTTP clients without being copied.
+
+    Mappings are shared by every reader of the same recording.  A mapping stays valid for as long as
+    a client holds one of its frames, even after a newer mapping of a changed recording replaces it.
+    '''
+    cache = {}
+    condition = threading.Condition()  # for rendevous of cache object
+
+    def __init__(self, fileName, frameIndex):
+        '''
+        Constructor - map the recording described by frameIndex
+        '''
+        self.fileName = fileName
+        self.frameIndex = frameIndex
+        self.map = None
+        self.view = memoryview(b"")
+        if frameIndex.size > 0:
+            with open(fileName, "rb") as fileHandle:
+                self.map = mmap.mmap(fileHandle.fileno(), frameIndex.size, access=mmap.ACCESS_READ)
+                self.view = memoryview(self.map)
+
+    def __len__(self):
+        '''
+        number of frames in the recording
+        '''
+        return len(self.frameIndex)
+
+    def frame(self, frameNumber):
+        '''
+        frame - zero copy view of a frame
+        '''
+        offset = self.frameIndex.offset(frameNumber)
+        return self.view[offset:offset + self.frameIndex.length(frameNumber)]
+
+    def prefetch(self):
+        '''
+        prefetch - read the whole recording into the page cache ahead of playback, so that its first
+        frames do not wait for the disk
+        '''
+        if self.map is None:
+            return
+        if hasattr(self.map, 'madvise'):
+            self.map.madvise(mmap.MADV_WILLNEED)
+        bytes(self.view[::mmap.PAGESIZE])  # touches every page
+
+    @classmethod
+    def open(cls, fileName):
+        '''
+        open - get the shared mapping of a recording, remapping it if the recording has changed
+        '''
+        frameIndex = FrameIndex.load(fileName)
+        with cls.condition:  # cache object access
+            recording = cls.cache.get(fileName)
+            if recording is None or recording.frameIndex is not frameIndex:
+                recording = cls(fileName, frameIndex)
+                cls.cache[fileName] = recording
+            cls.condition.notify_all()
+        return recording
+
+    @classmethod
+    def forget(cls, fileName):
+        '''
+        forget - drop the shared mapping of a recording, the memory is unmapped when its last frame is released
+        '''
+        with cls.condition:  # cache object access
+            cls.cache.pop(fileName, None)
+            cls.condition.notify_all()
+
+class TimestampTrack():
+    '''
+    TimestampTrack class - wall-clock capture time of every frame of a recording.
+
+    The track is kept in a sidecar file (<recording>.ts) as the capture time of the first frame
+    followed by the offset of every frame from it in microseconds.
+    '''
+    magic = b"MJPGTS02"
+    typeCodes = {magic: 'Q', b"MJPGTS01": 'I'}  # array type of the offsets, 32 bit in older tracks
+    header = struct.Struct("<8sqdI")
+
+    def __init__(self, base, offsets):
+        '''
+        Constructor - base is the capture time of the first frame, offsets are in microseconds
+        '''
+        self.base = base
+        self.offsets = offsets
+
+    def __len__(self):
+        '''
+        number of frames in the track
+        '''
+        return len(self.offsets)
+
+    def time(self, frameNumber):
+        '''
+        time - capture time (seconds since the epoch) of a frame
+        '''
+        return self.base + self.offsets[frameNumber - 1] / 1000000.0
+
+    def frameAt(self, wallClock):
+        '''
+        frameAt - number of the first frame captured at or after a wall-clock time
+        '''
+        frameNumber = bisect.bisect_left(self.offsets, int((wallClock - self.base) * 1000000.0)) + 1
+        return min(frameNumber, len(self))
+
+    def frameAtClock(self, clockText):
+        '''
+        frameAtClock - frameAt for a HH:MM:SS time (UTC, like the recording file names) on the day the track starts
+        '''
+        (hours, minutes, seconds) = [float(value) for value in clockText.split(':')]
+        day = calendar.timegm(time.gmtime(self.base)[:3] + (0, 0, 0))
+        return self.frameAt(day + hours * 3600.0 + minutes * 60.0 + seconds)
+
+    def clock(self, frameNumber):
+        '''
+        clock - HH:MM:SS capture time (UTC) of a frame
+        '''
+        return time.strftime("%H:%M:%S", time.gmtime(self.time(min(max(frameNumber, 1), len(self)))))
+
+    @staticmethod
+    def sidecarName(fileName):
+        '''
+        sidecarName - name of the timestamp file that belongs to a recording
+        '''
+        return fileName + ".ts"
+
+    @classmethod
+    def write(cls, fileName, times):
+        '''
+        write - save the capture times (seconds since the epoch) of the frames of a recording
+        '''
+        if not times:
+            return
+        base = times[0]
+        offsets = array(cls.typeCodes[cls.magic], [max(0, int((aTime - base) * 1000000.0)) for aTime in times])
+        sidecar = cls.sidecarName(fileName)
+        try:
+            with open(sidecar + ".tmp", "wb") as fileHandle:
+                fileHandle.write(cls.header.pack(cls.magic, os.stat(fileName).st_size, base, len(offsets)))
+                offsets.tofile(fileHandle)
+            os.replace(sidecar + ".tmp", sidecar)
+        except OSError as error:
+            print("Could not write timestamp track:", sidecar, error)
+
+    @classmethod
+    def load(cls, fileName):
+        '''
+        load - read the track of a recording, None if the recording has none or it does not match the recording
+        '''
+        try:
+            with open(cls.sidecarName(fileName), "rb") as fileHandle:
+                (magic, size, base, count) = cls.header.unpack(fileHandle.read(cls.header.size))
+                if magic not in cls.typeCodes or size != os.stat(fileName).st_size:
+                    return None
+                offsets = array(cls.typeCodes[magic])
+                offsets.fromfile(fileHandle, count)
+        except (OSError, EOFError, struct.error):
+            return None
+        return cls(base, offsets)
+
+class FramePacer():
+    '''
+    FramePacer class - schedules frames at real time x speedFactor.
+
+    Deadlines are computed from the capture times in the recording's timestamp track (or from a
+    nominal frame interval when there is no track) relative to a fixed origin, so waiting errors do
+    not accumulate.  A pacer that falls more than maxLag behind moves its origin instead of racing
+    through the backlog.
+    '''
+    maxLag = 0.5
+
+    def __init__(self, track, speedFactor, frameInterval=defaultFrameInterval):
+        '''
+        Constructor
+        '''
+        self.track = track
+        self.speedFactor = speedFactor if speedFactor > 0 else 1.0
+        self.frameInterval = frameInterval
+        self.origin = time.monotonic()
+        self.originTime = 0.0
+
+    def frameTime(self, frameNumber):
+        '''
+        frameTime - capture time of a frame in seconds, relative to the start of the recording
+        '''
+        if self.track is None or len(self.track) == 0:
+            return (frameNumber - 1) * self.frameInterval
+        if frameNumber <= len(self.track):
+            return self.track.offsets[frameNumber - 1] / 1000000.0
+        return self.track.offsets[-1] / 1000000.0 + (frameNumber - len(self.track)) * self.frameInterval
+
+    def start(self, frameNumber, due=None):
+        '''
+        start - make frameNumber due at time.monotonic() due, now by default
+        '''
+        self.origin = time.monotonic() if due is None else due
+        self.originTime = self.frameTime(frameNumber)
+
+    def deadline(self, frameNumber):
+        '''
+        deadline - time.monotonic() at which frameNumber is due
+        '''
+        now = time.monotonic()
+        deadline = self.origin + (self.frameTime(frameNumber) - self.originTime) / self.speedFactor
+        if now - deadline > self.maxLag:
+            print("Playback fell", now - deadline, "seconds behind - resynchronizing")
+            self.start(frameNumber)
+            return now
+        return deadline
+
+    def delay(self, frameNumber):
+        '''
+        delay - seconds to wait before frameNumber is due
+        '''
+        return max(0.0, self.deadline(frameNumber) - time.monotonic())
+
+class FrameCache():
+    '''
+    FrameCache class - bounded LRU cache of single frames, keyed by the identity of the recording
+    (device, inode, mtime and size) and the frame number, used for frame by frame scrubbing
+    '''
+    def __init__(self, maxBytes=16 * 1024 * 1024, maxFrames=512):
+        '''
+        Constructor
+        '''
+        self.frames = collections.OrderedDict()
+        self.maxBytes = maxBytes
+        self.maxFrames = maxFrames
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.condition = threading.Condition()  # for controlling access to the cache
+
+    def get(self, fileName, frameNumber):
+        '''
+        get - a frame of a recording as bytes, None if the recording has no such frame
+        '''
+        status = os.stat(fileName)
+        key = (status.st_dev, status.st_ino, status.st_mtime_ns, status.st_size, frameNumber)
+        with self.condition:
+            frame = self.frames.get(key)
+            if frame is not None:
+                self.frames.move_to_end(key)
+                self.hits += 1
+                return frame
+            self.misses += 1
+        recording = MappedRecording.open(fileName)
+        if frameNumber < 1 or frameNumber > len(recording):
+            return None
+        frame = bytes(recording.frame(frameNumber))  # a copy, so the cache does not keep mappings alive
+        with self.condition:
+            if key not in self.frames:
+                self.frames[key] = frame
+                self.size += len(frame)
+                while self.size > self.maxBytes or len(self.frames) > self.maxFrames:
+                    (oldKey, oldFrame) = self.frames.popitem(last=False)
+                    self.size -= len(oldFrame)
+            self.condition.notify_all()
+        return frame
+
+def copyRange(source, destination, offset, count):
+    '''
+    copyRange - copy count bytes starting at offset from one open file to another inside the kernel
+    '''
+    while count > 0:
+        try:
+            copied = os.copy_file_range(source.fileno(), destination.fileno(), count, offset)
+        except (AttributeError, OSError):
+            # no copy_file_range (old kernel or Python, or across file systems) - sendfile also stays in the kernel
+            copied = os.sendfile(destination.fileno(), source.fileno(), offset, count)
+        if copied == 0:
+            raise OSError("unexpected end of file while copying {}".format(source.name))
+        offset += copied
+        count -= copied
+
+def exportClip(fileName, startFrame, stopFrame):
+    '''
+    exportClip - copy frames startFrame..stopFrame of a recording into a new recording, returns its name
+    '''
+    frameIndex = FrameIndex.load(fileName)
+    startFrame = max(startFrame, 1)
+    stopFrame = min(stopFrame, len(frameIndex))
+    if startFrame > stopFrame:
+        raise ValueError("no frames between {} and {}".format(startFrame, stopFrame))
+    clipName = "{}_clip{}-{}.mjpeg".format(fileName[:-len(".mjpeg")], startFrame, stopFrame)
+    offset = frameIndex.offset(startFrame)
+    count = frameIndex.offset(stopFrame) + frameIndex.length(stopFrame) - offset
+    print("Exporting frames", startFrame, "to", stopFrame, "of", fileName, "to", clipName)
+    with open(fileName, "rb") as source:
+        with open(clipName + ".tmp", "wb") as destination:
+            copyRange(source, destination, offset, count)
+    os.replace(clipName + ".tmp", clipName)
+    track = TimestampTrack.load(fileName)
+    if track is not None:
+        TimestampTrack.write(clipName, [track.time(frameNumber) for frameNumber in range(startFrame, min(stopFrame, len(track)) + 1)])
+    return clipName
@@ -0,0 +1,149 @@
+'''
+Motion analysis module - scores the camera's motion vector frames against weighted motion zones,
+working in buffers preallocated when the zones change rather than in new arrays per frame
+'''
+import base64
+import numpy as np
+
+maskShape = (30, 41)  # motion vector cells of a VGA frame
+
+def packMask(mask):
+    '''
+    packMask - base64 text of a mask packed eight cells to a byte, row by row
+    '''
+    return base64.b64encode(np.packbits(np.asarray(mask) != 0)).decode('ascii')
+
+def unpackMask(text, shape=maskShape):
+    '''
+    unpackMask - the boolean mask of a packMask text
+    '''
+    cells = shape[0] * shape[1]
+    bits = np.unpackbits(np.frombuffer(base64.b64decode(text), dtype=np.uint8), count=cells)
+    if bits.size != cells:
+        raise ValueError("a packed mask of {} cells was expected".format(cells))
+    return bits.reshape(shape).astype(bool)
+
+class MotionZone():
+    '''
+    MotionZone class - a named part of the frame.  A zone scores weight once threshold of its cells
+    have changed, and proportionally less below that; a threshold of None follows the sensitivity
+    setting.  Motion is detected when the scores of all zones add up to 1, or, for a single zone,
+    when more than threshold of its cells have changed.
+    '''
+    def __init__(self, name, mask, weight=1.0, threshold=None):
+        '''
+        Constructor
+        '''
+        self.name = name
+        self.mask = np.asarray(mask) != 0
+        self.weight = float(weight)
+        self.threshold = None if threshold is None else float(threshold)
+
+    def toDefaults(self):
+        '''
+        toDefaults - the zone as saved in the defaults file, its mask packed
+        '''
+        return {'name': self.name, 'weight': self.weight, 'threshold': self.threshold,
+                'shape': list(self.mask.shape), 'mask': packMask(self.mask)}
+
+    @classmethod
+    def fromDefaults(cls, entry):
+        '''
+        fromDefaults - a zone from its entry in the defaults file
+        '''
+        return cls(entry['name'], unpackMask(entry['mask'], tuple(entry.get('shape', maskShape))),
+                   entry.get('weight', 1.0), entry.get('threshold'))
+
+class ZoneSet():
+    '''
+    ZoneSet class - the zones of the motion detector, evaluated together in one pass over a frame.
+
+    When the zones change, every cell is given to the last zone that enables it, and the bounding
+    box of the zones' cells is worked out, with a matrix of one row of each zone's cells in the box.
+    A frame is then scored by comparing the box's cells into a preallocated buffer and counting the
+    changed cells of all zones at once, as the product of the matrix and that buffer, into a second
+    one; the counts and scores are kept in preallocated lists.  A single zone that covers its whole
+    box is counted directly.
+    '''
+    changeLevel = np.uint16(255)  # a cell has changed when its sum of absolute differences is above this, typed like sad
+
+    def __init__(self, zones, shape=maskShape):
+        '''
+        Constructor - zones is a list of MotionZone, of which the first 255 are used
+        '''
+        self.zones = list(zones)[:255]
+        labels = np.zeros(shape, dtype=np.uint8)
+        for (number, zone) in enumerate(self.zones):
+            labels[zone.mask] = number + 1
+        rows = np.flatnonzero(labels.any(axis=1))
+        columns = np.flatnonzero(labels.any(axis=0))
+        if rows.size == 0:
+            (self.rows, self.columns) = (slice(0, 0), slice(0, 0))
+        else:
+            (self.rows, self.columns) = (slice(rows[0], rows[-1] + 1), slice(columns[0], columns[-1] + 1))
+        self.labels = np.ascontiguousarray(labels[self.rows, self.columns])
+        self.matrix = np.array([(self.labels == number + 1).ravel() for number in range(len(self.zones))],
+                               dtype=np.float64).reshape(len(self.zones), self.labels.size)
+        self.whole = len(self.zones) == 1 and bool(self.matrix.all())  # the single zone fills its box
+        self.changed = np.empty(self.labels.shape, dtype=np.float64)  # 1.0 for a changed cell
+        self.changedCells = self.changed.reshape(-1)
+        self.zoneCounts = np.empty(len(self.zones), dtype=np.float64)
+        self.weights = [zone.weight for zone in self.zones]
+        self.thresholds = []  # changed cells at which every zone scores its weight, for the current default threshold
+        self.scales = []  # score per changed cell of every zone
+        self.defaultThreshold = None
+        self.counts = [0] * len(self.zones)  # changed cells per zone of the last frame
+        self.scores = [0.0] * len(self.zones)  # score per zone of the last frame
+
+    def rescale(self, defaultThreshold):
+        '''
+        rescale - work out the threshold and the score of a changed cell of every zone for a new default threshold
+        '''
+        self.defaultThreshold = defaultThreshold
+        self.thresholds = [defaultThreshold if zone.threshold is None else zone.threshold for zone in self.zones]
+        self.scales = [zone.weight / max(threshold, 1.0) for (zone, threshold) in zip(self.zones, self.thresholds)]
+
+    def score(self, sad, defaultThreshold):
+        '''
+        score - (total score, changed cells in all zones) of a frame's sums of absolute differences.
+        defaultThreshold is the threshold of the zones that follow the sensitivity setting.
+        '''
+        if self.changed.size == 0:
+            return (0.0, 0)
+        if defaultThreshold != self.defaultThreshold:
+            self.rescale(defaultThreshold)
+        if self.labels.shape != sad.shape:
+            sad = sad[self.rows, self.columns]
+        np.greater(sad, self.changeLevel, out=self.changed)
+        if self.whole:
+            self.zoneCounts[0] = np.count_nonzero(self.changedCells)
+        else:
+            np.dot(self.matrix, self.changedCells, out=self.zoneCounts)
+        total = 0.0
+        cells = 0
+        for number in range(len(self.zones)):
+            count = int(self.zoneCounts[number])
+            # a zone scores at most its weight, so a busy zone can not trigger on behalf of a quiet one
+            zoneScore = min(count * self.scales[number], self.weights[number])
+            self.counts[number] = count
+            self.scores[number] = zoneScore
+            total += zoneScore
+            cells += count
+        return (total, cells)
+
+    def triggered(self, score):
+        '''
+        triggered - whether the last frame, of the given total score, shows motion.  A single zone
+        triggers above its threshold, like the single motion mask did; several zones trigger when
+        their scores add up to 1.
+        '''
+        if len(self.zones) == 1 and self.thresholds:
+            return self.counts[0] * self.weights[0] > self.thresholds[0]
+        return score >= 1.0
+
+    def describe(self):
+        '''
+        describe - the changed cells and score of every zone in the last frame, for the log
+        '''
+        return ", ".join("{}: {} cells, score {:.2f}".format(zone.name, count, score)
+                         for (zone, count, score) in zip(self.zones, self.counts, self.scores))
@@ -1,8 +1,10 @@
 '''
 Surveillance video module
 '''
-import io
-import glob
+import argparse
+import calendar
+import heapq
+import collections
 from http import server as httpServer
 import os
 import re
@@ -10,8 +12,15 @@ import socketserver
 import time
 import threading
 from threading import Condition
+from urllib.parse import parse_qs, unquote, urlsplit
+from mjpeg import FrameCache, FrameIndex, FramePacer, MappedRecording, TimestampTrack, exportClip
+import http_files
+from catalog import RecordingCatalog, filterForm, listingQuery, olderLink
+from async_server import AsyncStreamingServer
+import websocket
 
 sessionIDPattern = re.compile(r'sessionID=(\d+)')
+playlistTimeFormat = "%Y-%m-%dT%H:%M"  # UTC, as sent by datetime-local inputs
 
 class StreamingHandler(httpServer.BaseHTTPRequestHandler):
     '''
@@ -29,97 +38,63 @@ class StreamingHandler(httpServer.BaseHTTPRequestHandler):
             self.send_header('Location', '/index.html')
             self.end_headers()
 
-        elif '/index.html' in self.path and not 'mjpg' in self.path and not 'mjpeg' in self.path and not 'playbackStyle.css' in self.path:
+        elif '/index.html' in urlsplit(self.path).path and not 'mjpg' in urlsplit(self.path).path and not 'mjpeg' in urlsplit(self.path).path and not 'playbackStyle.css' in self.path:
             print("Processing an index page")
-            files = glob.glob('*.mjpeg')
-            page = ""
-            beforeList = True
-            startFrame = 1
-            stopFrame = 450
-            speedFactor = 1.0
+            (path, _, query) = self.path.partition('?')
+            (recordings, nextKey) = self.server.catalog.page(**listingQuery(query))
+            playable = [recording for recording in recordings if http_files.isMotionJPEG(recording.fileName)]
+            newest = playable[0] if playable else self.server.catalog.newest('.mjpeg')
             referenceID = 0
-            if 'sessionID' in self.path:
-                referenceID = self.path.replace("/index.html/sessionID=", "")
+            if 'sessionID' in path:
+                referenceID = path.replace("/index.html/sessionID=", "")
                 referenceID = int(referenceID)
-            filelist = ""
-            first = True
-            if files:
-                for afile in sorted(files):
-                    if first:
-                        first = False
-                        referenceID = self.server.sessionManager.initializeSessionObject(afile, referenceID)
-                    filelist += '<li><a href=' + afile + '/sessionID=' +str(self.server.sessionManager.sessions[referenceID]['sessionID']) + '>' + afile + '</a></li>'
+            if newest is not None:
+                referenceID = self.server.sessionManager.initializeSessionObject(newest.fileName, referenceID)
                 print("do_GET - waiting for interfaceObject access")
                 with self.server.sessionManager.sessions[referenceID]['condition']:  # interface object access
                     startFrame = self.server.sessionManager.sessions[referenceID]['startFrame']
                     stopFrame = self.server.sessionManager.sessions[referenceID]['stopFrame']
                     speedFactor = self.server.sessionManager.sessions[referenceID]['speedFactor']
+                    fileName = self.server.sessionManager.sessions[referenceID]['fileName']
+                    playlist = self.server.sessionManager.sessions[referenceID]['playlist']
                     self.server.sessionManager.sessions[referenceID]['condition'].notify()
-                    self.server.sessionManager.startVideoFileReadThread(referenceID)
                 print("do_GET - got information from interfaceObject")
-                page = '<!DOCTYPE html>'
-                page += '<html lang="en">'
-                page += '<head>'
-                page += '<meta charset="utf-8">'
-                page += '<link rel="stylesheet" href="playbackStyle.css"/>'
-                page += '<title>' + self.server.sessionManager.sessions[referenceID]['theThread'].fileName + '</title>'
-                page += '</head>'
-                page += '<body>'
-                page += '<h1>' + self.server.sessionManager.sessions[referenceID]['theThread'].fileName +'</h1>'
-                page += '<img class="base" src="stream.mjpg/sessionID=' + str(referenceID) + '" width="640" height="480" style="position:absolute; top:60px; left:10px" />'
-                page += '<canvas class="overlay" id="imageArea" width="640" height="480" style="position:absolute; top:60px; left:10px"></canvas>'
-                page += '<div style="position:absolute; top:540px; left:20px">'
-                page += '<h2>Video Sources</h2>'
-                page += '<ul>'
-                page += filelist
-                page += '</ul>'
-                page += '<h2>Playback Controls</h2>'
-                page += '<ul>'
-                page += '<li>'
-                page += '<form action="/index.html" method="post">'
-                page += '<label for="LoopStartFrame">Loop Start Frame</label><input pattern="[0-9]{1,3}" type="text" name="LoopStartFrame"'
-                page += ' placeholder="' + "{:3d}".format(startFrame) + '" maxlength="6" size="6">'
-                page += '<input type="submit" name="sessionid" value="'+ str(self.server.sessionManager.sessions[referenceID]['sessionID']) + '" style="display:none;">'
-                page += '</form>'
-                page += '</li>'
-                page += '<li>'
-                page += '<form action="/index.html" method="post">'
-                page += '<label for="LoopStopFrame">Loop Stop Frame</label><input pattern="[0-9]{1,3}" type="text" name="LoopStopFrame"'
-                page += ' placeholder="' + "{:3d}".format(stopFrame) + '" maxlength="6" size="6">'
-                page += '<input type="submit" name="sessionid" value="'+ str(self.server.sessionManager.sessions[referenceID]['sessionID']) + '" style="display:none;">'
-                page += '</form>'
-                page += '</li>'
-                page += '<li>'
-                page += '<form action="/index.html" method="post">'
-                page += '<label for="SpeedFactor">Speed Factor(> 1 faster, < 1 slower)</label>'
-                page += '<input pattern="[0-9]{1,2}\.[0-9]{1,2}" type="text" name="SpeedFactor"'
-                page += ' placeholder="' + "{:5.2f}".format(speedFactor) + '" maxlength="6" size="6">'
-                page += '<input type="submit" name="sessionid" value="'+ str(self.server.sessionManager.sessions[referenceID]['sessionID']) + '" style="display:none;">'
-                page += '</form>'
-                page += '</li>'
-                page += '</ul>'
-                page += '</div>'
-                page += '</body>'
-                page += '</html>'
+                inputs = (recordings, nextKey, query, startFrame, stopFrame, speedFactor, fileName, playlist,
+                          http_files.fileStatus(fileName), http_files.fileStatus(TimestampTrack.sidecarName(fileName)))
+                page = self.server.pageCache.get(referenceID, inputs,
+                                                 lambda: self.renderIndexPage(referenceID, recordings, query, nextKey,
+                                                                              startFrame, stopFrame, speedFactor, fileName, playlist))
             else:
-                page += 'No video files'
-            content = page.encode('utf-8')
-            self.send_response(200)
-            self.send_header('Content-Type', 'text/html')
-            self.send_header('Content-Length', len(content))
-            self.end_headers()
-            self.wfile.write(content)
+                page = self.server.pageCache.get('empty', (), lambda: 'No video files')
+            page.send(self)
         elif '/playbackStyle.css' in self.path:
-            fileObject = open('./playbackStyle.css', 'r')
-            content = ""
-            for line in fileObject:
-                content += line
-            content = content.encode('utf-8')
+            self.server.styleSheet.send(self)
+        elif self.path.startswith('/download/'):
+            self.do_HEAD()
+        elif '/stream.ws' in self.path:
+            source = self.server.frameSource(self.path)
+            if source is None:
+                self.send_error(404)
+                return
+            websocket.serveWebSocket(self, source)
+        elif self.path.startswith('/frame.jpg'):
+            query = parse_qs(urlsplit(self.path).query)
+            fileName = http_files.recordingName(query.get('file', [''])[0], '')
+            frame = None
+            try:
+                if fileName is not None:
+                    frame = self.server.frameCache.get(fileName, int(query.get('frame', ['1'])[0]))
+            except (FileNotFoundError, ValueError):
+                frame = None
+            if frame is None:
+                self.send_error(404)
+                return
             self.send_response(200)
-            self.send_header('Content-Type', 'text/css')
-            self.send_header('Content-Length', len(content))
+            self.send_header('Content-Type', 'image/jpeg')
+            self.send_header('Content-Length', len(frame))
+            self.send_header('Cache-Control', 'private, max-age=3600')
             self.end_headers()
-            self.wfile.write(content)
+            self.wfile.write(frame)
         elif '/stream.mjpg' in self.path:
             referenceID = 1
             matchObject = sessionIDPattern.search(self.path)
@@ -128,26 +103,31 @@ class StreamingHandler(httpServer.BaseHTTPRequestHandler):
                 print("Starting a stream with session ID:", referenceID)
             else:
                 print("Error -- starting a stream without the expected session ID  - defaulted to 1")
-            self.send_response(200)
-            self.send_header('Age', 0)
-            self.send_header('Cache-Control', 'no-cache, private')
-            self.send_header('Pragma', 'no-cache')
-            self.send_header('Content-Type', 'multipart/x-mixed-replace; boundary=FRAME')
-            self.end_headers()
+            session = self.server.sessionManager.getSession(referenceID)
+            producer = None if session is None else self.server.sessionManager.subscribe(referenceID)
+            if producer is None:
+                print("Session", referenceID, "does not exist")
+                self.send_error(404)
+                return
+            skipped = 0
             try:
+                self.send_response(200)
+                self.send_header('Age', 0)
+                self.send_header('Cache-Control', 'no-cache, private')
+                self.send_header('Pragma', 'no-cache')
+                self.send_header('Content-Type', 'multipart/x-mixed-replace; boundary=FRAME')
+                self.end_headers()
                 done = False
+                version = 0
                 print("HTTP server accepting a video stream")
                 while not done:
-                    with self.server.sessionManager.condition: # sessions object access
-                        with self.server.sessionManager.sessions[referenceID]['theThread'].condition: # thread object access
-                            result = self.server.sessionManager.sessions[referenceID]['theThread'].condition.wait(3.0)
-                            frame = self.server.sessionManager.sessions[referenceID]['theThread'].frame
-                            if not result:
-                                print("Wait timeout")
-                                frame = None
-                            self.server.sessionManager.sessions[referenceID]['theThread'].condition.notifyAll()
-                        self.server.sessionManager.condition.notifyAll()
-                    done = frame is None
+                    (newVersion, frame) = producer.waitFrame(version, 3.0)
+                    if frame is None:
+                        print("Wait timeout")
+                    elif version:
+                        skipped += newVersion - version - 1
+                    version = newVersion
+                    done = frame is None or session['closed']
                     if not done:
                         self.wfile.write(b'--FRAME\r\n')
                         self.send_header('Content-Type', 'image/jpeg')
@@ -157,23 +137,21 @@ class StreamingHandler(httpServer.BaseHTTPRequestHandler):
                         self.wfile.write(b'\r\n')
                 print("HTTP server finished with video stream")
             except BrokenPipeError:
-                print('Removing streaming client')
-                with self.server.sessionManager.sessions[referenceID]['theThread'].condition: # thread object access
-                    self.server.sessionManager.sessions[referenceID]['theThread'].setStop()
-                    self.server.sessionManager.sessions[referenceID]['theThread'].condition.notify()
                 print('Removed streaming client')
+            finally:
+                print("Frames skipped by slow client:", skipped)
+                self.server.sessionManager.unsubscribe(producer, referenceID)
         elif 'mjpeg' in self.path:
             referenceID = 1
             if 'sessionID' in self.path:
                 (fileName, referenceID) = self.path.split("/sessionID=")
                 fileName = fileName.split('/')[-1]
                 print(fileName, referenceID, self.path)
-                referenceID = int(referenceID)
-                with self.server.sessionManager.sessions[referenceID]['theThread'].condition:
-                    self.server.sessionManager.sessions[referenceID]['theThread'].setStop()
-                    self.server.sessionManager.sessions[referenceID]['theThread'].frame = None
-                    self.server.sessionManager.sessions[referenceID]['theThread'].setFileName(fileName)
-                    self.server.sessionManager.sessions[referenceID]['theThread'].condition.notify()
+                referenceID = self.server.sessionManager.initializeSessionObject(fileName, int(referenceID))
+                with self.server.sessionManager.sessions[referenceID]['condition']:
+                    self.server.sessionManager.sessions[referenceID]['fileName'] = fileName
+                    self.server.sessionManager.sessions[referenceID]['playlist'] = None
+                    self.server.sessionManager.sessions[referenceID]['condition'].notify()
                 print("Set file name in session:", referenceID, ", to:", fileName)
             else:
                 print("Error -- a session ID was expected while processing new a new file selection  - defaulted to 1")
@@ -184,6 +162,138 @@ class StreamingHandler(httpServer.BaseHTTPRequestHandler):
             self.send_error(404)
             self.end_headers()
 
+    def renderIndexPage(self, referenceID, recordings, query, nextKey, startFrame, stopFrame, speedFactor, fileName, playlist):
+        '''
+        renderIndexPage - the text of the playback page of a session, with a page of the recording catalog
+        '''
+        filelist = ""
+        for recording in recordings:
+            afile = recording.fileName
+            if http_files.isMotionJPEG(afile):
+                filelist += '<li><a href=' + afile + '/sessionID=' +str(self.server.sessionManager.sessions[referenceID]['sessionID']) + '>' + afile + '</a>'
+            else:
+                filelist += '<li>' + afile
+            filelist += ' <a href=/download/' + afile + '>download</a>'
+            filelist += ' {} frames, {:.1f} s, {:.1f} MB</li>'.format(recording.frames, recording.duration, recording.size / 1e6)
+        listingAction = '/index.html/sessionID=' + str(referenceID)
+        track = TimestampTrack.load(fileName)
+        try:
+            frameCount = len(FrameIndex.load(fileName))
+        except FileNotFoundError:
+            frameCount = 0
+        page = '<!DOCTYPE html>'
+        page += '<html lang="en">'
+        page += '<head>'
+        page += '<meta charset="utf-8">'
+        page += '<link rel="stylesheet" href="playbackStyle.css"/>'
+        page += '<title>' + fileName + '</title>'
+        page += '</head>'
+        page += '<body>'
+        if playlist is None:
+            page += '<h1>' + fileName +'</h1>'
+        else:
+            page += '<h1>Playlist ' + time.strftime(playlistTimeFormat, time.gmtime(playlist[0])) + ' to '
+            page += time.strftime(playlistTimeFormat, time.gmtime(playlist[1])) + '</h1>'
+        page += '<img class="base" src="stream.mjpg/sessionID=' + str(referenceID) + '" width="640" height="480" style="position:absolute; top:60px; left:10px" />'
+        page += '<canvas class="overlay" id="imageArea" width="640" height="480" style="position:absolute; top:60px; left:10px"></canvas>'
+        page += '<div style="position:absolute; top:540px; left:20px">'
+        page += '<h2>Video Sources</h2>'
+        page += filterForm(listingAction, query)
+        page += '<ul>'
+        page += filelist
+        page += '</ul>'
+        page += olderLink(listingAction, query, nextKey)
+        page += '<h2>Playlist</h2>'
+        page += '<form action="/index.html" method="post">'
+        page += '<label for="PlaylistFrom">Play Recordings From (UTC)</label><input type="datetime-local" name="PlaylistFrom"'
+        if playlist is not None:
+            page += ' value="' + time.strftime(playlistTimeFormat, time.gmtime(playlist[0])) + '"'
+        page += '><label for="PlaylistTo"> to </label><input type="datetime-local" name="PlaylistTo"'
+        if playlist is not None:
+            page += ' value="' + time.strftime(playlistTimeFormat, time.gmtime(playlist[1])) + '"'
+        page += '> <button type="submit" name="sessionid" value="'+ str(self.server.sessionManager.sessions[referenceID]['sessionID']) + '">Play as One Stream</button>'
+        page += '</form>'
+        if playlist is not None:
+            page += '<form action="/index.html" method="post">'
+            page += '<input type="hidden" name="PlaylistOff" value="on">'
+            page += '<button type="submit" name="sessionid" value="'+ str(self.server.sessionManager.sessions[referenceID]['sessionID']) + '">Stop Playlist</button>'
+            page += '</form>'
+        page += '<h2>Playback Controls</h2>'
+        page += '<ul>'
+        page += '<li>'
+        page += '<form action="/index.html" method="post">'
+        page += '<label for="LoopStartFrame">Loop Start Frame</label><input pattern="[0-9]{1,3}" type="text" name="LoopStartFrame"'
+        page += ' placeholder="' + "{:3d}".format(startFrame) + '" maxlength="6" size="6">'
+        page += '<input type="submit" name="sessionid" value="'+ str(self.server.sessionManager.sessions[referenceID]['sessionID']) + '" style="display:none;">'
+        page += '</form>'
+        page += '</li>'
+        page += '<li>'
+        page += '<form action="/index.html" method="post">'
+        page += '<label for="LoopStopFrame">Loop Stop Frame</label><input pattern="[0-9]{1,3}" type="text" name="LoopStopFrame"'
+        page += ' placeholder="' + "{:3d}".format(stopFrame) + '" maxlength="6" size="6">'
+        page += '<input type="submit" name="sessionid" value="'+ str(self.server.sessionManager.sessions[referenceID]['sessionID']) + '" style="display:none;">'
+        page += '</form>'
+        page += '</li>'
+        if track:
+            page += '<li>'
+            page += '<form action="/index.html" method="post">'
+            page += '<label for="LoopStartTime">Loop Start Time (UTC)</label><input pattern="[0-9]{2}:[0-9]{2}:[0-9]{2}" type="text" name="LoopStartTime"'
+            page += ' placeholder="' + track.clock(startFrame) + '" maxlength="8" size="8">'
+            page += '<input type="submit" name="sessionid" value="'+ str(self.server.sessionManager.sessions[referenceID]['sessionID']) + '" style="display:none;">'
+            page += '</form>'
+            page += '</li>'
+            page += '<li>'
+            page += '<form action="/index.html" method="post">'
+            page += '<label for="LoopStopTime">Loop Stop Time (UTC)</label><input pattern="[0-9]{2}:[0-9]{2}:[0-9]{2}" type="text" name="LoopStopTime"'
+            page += ' placeholder="' + track.clock(stopFrame) + '" maxlength="8" size="8">'
+            page += '<input type="submit" name="sessionid" value="'+ str(self.server.sessionManager.sessions[referenceID]['sessionID']) + '" style="display:none;">'
+            page += '</form>'
+            page += '</li>'
+        if frameCount > 0:
+            page += '<li>'
+            page += '<label for="Scrub">Scrub Frame</label>'
+            page += '<input type="range" id="Scrub" name="Scrub" min="1" max="' + str(frameCount) + '" value="' + str(min(max(startFrame, 1), frameCount)) + '">'
+            page += ' <span id="ScrubFrame"></span> <a href=/index.html/sessionID=' + str(referenceID) + '>resume playback</a>'
+            page += '<script>'
+            page += 'document.getElementById("Scrub").addEventListener("input", function(event) {\n'
+            page += '  document.getElementById("ScrubFrame").textContent = event.target.value;\n'
+            page += '  document.querySelector("img.base").src = "/frame.jpg?file=" + encodeURIComponent("' + fileName + '") + "&frame=" + event.target.value;\n'
+            page += '}, false);\n'
+            page += '</script>'
+            page += '</li>'
+        page += '<li>'
+        page += '<form action="/index.html" method="post">'
+        page += '<label for="SpeedFactor">Speed Factor(> 1 faster, < 1 slower)</label>'
+        page += '<input pattern="[0-9]{1,2}\.[0-9]{1,2}" type="text" name="SpeedFactor"'
+        page += ' placeholder="' + "{:5.2f}".format(speedFactor) + '" maxlength="6" size="6">'
+        page += '<input type="submit" name="sessionid" value="'+ str(self.server.sessionManager.sessions[referenceID]['sessionID']) + '" style="display:none;">'
+        page += '</form>'
+        page += '</li>'
+        page += '<li>'
+        page += '<form action="/index.html" method="post">'
+        page += '<input type="hidden" name="ExportClip" value="loop">'
+        page += '<button type="submit" name="sessionid" value="'+ str(self.server.sessionManager.sessions[referenceID]['sessionID']) + '">Export Loop Frames as Clip</button>'
+        page += '</form>'
+        page += '</li>'
+        page += '</ul>'
+        page += '</div>'
+        page += '</body>'
+        page += '</html>'
+        return page
+
+    def do_HEAD(self):
+        '''
+        do_HEAD - handles HEAD requests, and GET requests, for downloads of recordings
+        '''
+        fileName = None
+        if self.path.startswith('/download/'):
+            fileName = http_files.recordingName(self.path, '/download/')
+        if fileName is None:
+            self.send_error(404)
+            return
+        print("Download of", fileName, "requested by", self.client_address)
+        http_files.sendFile(self, fileName)
+
     def do_POST(self):
         '''
         do_POST - handles POST requests from an HTTP client
@@ -201,6 +311,12 @@ class StreamingHandler(httpServer.BaseHTTPRequestHandler):
             newStartFrame = None
             newStopFrame = None
             newSpeedFactor = None
+            newStartTime = None
+            newStopTime = None
+            exportLoop = False
+            newPlaylistStart = None
+            newPlaylistStop = None
+            stopPlaylist = False
             referenceID = 0
             for fileName in filesToDelete:
                 if fileName:
@@ -215,22 +331,51 @@ class StreamingHandler(httpServer.BaseHTTPRequestHandler):
                         print("Setting stopFrame to", newValue)
                         if newValue != "":
                             newStopFrame = int(newValue)
+                    elif "LoopStartTime" in fileName:
+                        newValue = unquote(fileName.replace("LoopStartTime=", ""))
+                        print("Setting start time to", newValue)
+                        if newValue != "":
+                            newStartTime = newValue
+                    elif "LoopStopTime" in fileName:
+                        newValue = unquote(fileName.replace("LoopStopTime=", ""))
+                        print("Setting stop time to", newValue)
+                        if newValue != "":
+                            newStopTime = newValue
                     elif "SpeedFactor" in fileName:
                         newValue = fileName.replace("SpeedFactor=", "")
                         print("Setting speedFactor to", newValue)
                         if newValue != "":
                             newSpeedFactor = float(newValue)
+                    elif "PlaylistFrom" in fileName or "PlaylistTo" in fileName:
+                        (name, _, newValue) = unquote(fileName).partition("=")
+                        print("Setting", name, "to", newValue)
+                        try:
+                            playlistTime = calendar.timegm(time.strptime(newValue[:16], playlistTimeFormat))
+                        except ValueError:
+                            print("Invalid playlist time:", newValue)
+                        else:
+                            if name == "PlaylistFrom":
+                                newPlaylistStart = playlistTime
+                            else:
+                                newPlaylistStop = playlistTime
+                    elif "PlaylistOff" in fileName:
+                        print("Leaving playlist mode")
+                        stopPlaylist = True
+                    elif "ExportClip" in fileName:
+                        print("Exporting loop frames as a clip")
+                        exportLoop = True
                     elif "sessionid" in fileName:
                         newValue = fileName.replace("sessionid=", "")
                         print("Setting sessionid to", newValue)
                         referenceID = int(newValue)
                     else:
                         print("Unknown request:", conditionedFileName)
-            print("do_POST -- waiting for access to the thread object")
-            with self.server.sessionManager.sessions[referenceID]['theThread'].condition:
-                self.server.sessionManager.sessions[referenceID]['theThread'].setStop()
-                self.server.sessionManager.sessions[referenceID]['theThread'].condition.notify()
-            print("do_POST -- got access to the thread object")
+            if self.server.sessionManager.getSession(referenceID) is None:
+                print("do_POST -- session", referenceID, "does not exist")
+                self.send_response(302)
+                self.send_header('location', 'index.html')
+                self.end_headers()
+                return
             print("do_POST -- waiting for access to interface object")
             with self.server.sessionManager.sessions[referenceID]['condition']:
                 if not newStartFrame is None:
@@ -239,129 +384,505 @@ class StreamingHandler(httpServer.BaseHTTPRequestHandler):
                     self.server.sessionManager.sessions[referenceID]['stopFrame'] = newStopFrame
                 elif not newSpeedFactor is None:
                     self.server.sessionManager.sessions[referenceID]['speedFactor'] = newSpeedFactor
+                elif not newPlaylistStart is None and not newPlaylistStop is None:
+                    self.server.sessionManager.sessions[referenceID]['playlist'] = (newPlaylistStart, newPlaylistStop)
+                elif stopPlaylist:
+                    self.server.sessionManager.sessions[referenceID]['playlist'] = None
+                elif not newStartTime is None or not newStopTime is None:
+                    track = TimestampTrack.load(self.server.sessionManager.sessions[referenceID]['fileName'])
+                    if track is None:
+                        print("No timestamp track - can not seek by time")
+                    else:
+                        try:
+                            if not newStartTime is None:
+                                self.server.sessionManager.sessions[referenceID]['startFrame'] = track.frameAtClock(newStartTime)
+                            else:
+                                self.server.sessionManager.sessions[referenceID]['stopFrame'] = track.frameAtClock(newStopTime)
+                        except ValueError:
+                            print("Invalid time:", newStartTime, newStopTime)
                 self.server.sessionManager.sessions[referenceID]['condition'].notify()
             print("do_POST -- got access to the interface object")
+            if exportLoop:
+                with self.server.sessionManager.sessions[referenceID]['condition']:
+                    loop = (self.server.sessionManager.sessions[referenceID]['fileName'],
+                            self.server.sessionManager.sessions[referenceID]['startFrame'],
+                            self.server.sessionManager.sessions[referenceID]['stopFrame'])
+                    self.server.sessionManager.sessions[referenceID]['condition'].notify()
+                try:
+                    clipName = exportClip(*loop)
+                    self.server.catalog.record(clipName)
+                    print("Exported clip:", clipName)
+                except (OSError, ValueError) as error:
+                    print("Clip export failed:", error)
             self.send_response(302)
             self.send_header('location', 'index.html/sessionID=' + str(referenceID))
             self.end_headers()
 
 
-class VideoFileThread(threading.Thread):
+class VideoFileStream():
     '''
-    Video File Thread class - used to make objects that produce output streams to HTTP clients
+    Video File Stream class - used to make objects that produce output streams to HTTP clients.
+    One object is shared by every stream that plays the same file with the same settings.  The
+    frames are produced by the PlaybackScheduler, so a stream holds state only, not a thread.  The
+    recording is opened by the thread that subscribes, the scheduler thread does no file I/O.
     '''
-    def __init__(self, fileName, interfaceObject):
+    def __init__(self, fileName, startFrame, stopFrame, speedFactor, readAhead=None):
         '''
-        Constructor - create buffer and threading related objects
+        Constructor - create threading related objects, readAhead maps the recording again when it
+        is looked at for new frames
         '''
-        super(VideoFileThread, self).__init__()
         self.fileName = fileName
-        self.interfaceObject = interfaceObject
+        self.startFrame = max(startFrame, 1)
+        self.stopFrame = stopFrame
+        self.speedFactor = speedFactor
+        self.readAhead = readAhead
         self.stop = False
-        self.startOfFrame = b"\xff\xd8"
-        self.buffer = io.BytesIO()
-        self.condition = Condition()  # for controlling access to thread
+        self.condition = Condition()  # for controlling access to stream
         self.frame = None
-        self.notStarted = True
+        self.version = 0  # counts published frames
+        self.listeners = []  # called, in the scheduler thread, after every frame
+        self.subscribers = 0
+        self.producerKey = None  # the key the SessionManager keeps the producer under
+        self.recording = None
+        self.pacer = None
+        self.frameNumber = self.startFrame
+        self.framesProcessed = 0
 
-    def run(self):
+    def key(self):
+        '''
+        key - the playback settings that decide whether a stream can share this producer
+        '''
+        return (self.fileName, self.startFrame, self.stopFrame, self.speedFactor)
+
+    def open(self):
+        '''
+        open - map the file and prepare the first frame, returns the deadline of the first frame.
+        Called by the subscribing thread before the stream is scheduled.
         '''
-        runs - starts a thread that reads a file into a stream targeted for a HTTP client
-        '''
-        startFrame = 1
-        stopFrame = 450
-        speedFactor = 1
-        sessionID = 1
-        governor  = Condition()
-        with self.interfaceObject['condition']:
-            startFrame = self.interfaceObject['startFrame']
-            stopFrame = self.interfaceObject['stopFrame']
-            speedFactor = self.interfaceObject['speedFactor']
-            sessionID = self.interfaceObject['sessionID']
-            self.interfaceObject['condition'].notify()
-
-        print("Starting Session:", sessionID)
+        print("Starting producer:", self.key())
         try:
-            while not self.stop:
-                framesProcessed = 0
-                print("starting read of:", self.fileName, ", for session:", sessionID)
-                fileHandle = open(self.fileName, "rb")
-                buff = fileHandle.read(10000)
-                segmentStart = 0
-                while buff:
-                    location = buff.find(self.startOfFrame, segmentStart)
-                    while location > 0:
-                        framesProcessed += 1
-                        if framesProcessed >= startFrame:
-                            self.write(buff[segmentStart:location])
-                            if framesProcessed > stopFrame:
-                                print("written last frame to display")
-                                break
-                            with governor:
-                                governor.wait(0.00396 / speedFactor)
-                                governor.notify()
-                        segmentStart = location
-                        location = buff.find(self.startOfFrame, segmentStart+2)
-                    if framesProcessed > stopFrame:
-                        print("No need to process more frames - terminate this loop")
-                        buff = 0
-                        break
-                    if framesProcessed >= startFrame:
-                        self.write(buff[segmentStart:])
-                        with governor:
-                            governor.wait(0.00396 / speedFactor)
-                            governor.notify()
-                    segmentStart = 0
-                    buff = fileHandle.read(10000)
-                    if self.stop:
-                        print("told to stop - exiting read file loop")
-                        break
-                print("closing file")
-                fileHandle.close()
-                print("Frames processed:", framesProcessed)
+            self.recording = MappedRecording.open(self.fileName)
         except FileNotFoundError:
             print("File: {}, was not found".format(self.fileName))
-        print("Video display finished")
-        print("Ending Session:", sessionID)
+            self.setStop()
+            return None
+        except (OSError, ValueError) as error:
+            print("File: {}, could not be read: {}".format(self.fileName, error))
+            self.setStop()
+            return None
+        self.pacer = FramePacer(TimestampTrack.load(self.fileName), self.speedFactor)
+        return self.pacer.deadline(self.frameNumber)
 
-    def write(self, buf):
+    def lastFrame(self):
         '''
-        write - write buffer to stream.  The buffers are expected to be MJPEG frames.
+        lastFrame - last frame of the loop
         '''
-        if buf.startswith(b'\xff\xd8'):
-            # New frame, copy the existing buffer's content and notify all
-            # clients it's available
-            self.buffer.truncate()
-            with self.condition: # thread object access
-                self.frame = self.buffer.getvalue()
-                self.condition.notify()
-            self.buffer.seek(0)
-        return self.buffer.write(buf)
+        return min(self.stopFrame, len(self.recording))
 
-    def setFileName(self, fileName):
+    def advance(self):
         '''
-        Set the file name to process
+        advance - publish the frame that is due, returns the deadline of the next one or None when stopped
         '''
-        self.fileName = fileName
-        
+        if self.stop:
+            print("Video display finished")
+            print("Ending producer:", self.key())
+            return None
+        if self.frameNumber > self.lastFrame():
+            if self.framesProcessed > 0:
+                print("Frames processed:", self.framesProcessed, ", for", self.subscribers, "subscribers")
+            self.framesProcessed = 0
+            self.frameNumber = self.startFrame
+            if self.startFrame > self.lastFrame():
+                print("No frames in requested range")
+                self.reload()
+                return time.monotonic() + 1.0
+            self.pacer.start(self.frameNumber)
+        self.publish(self.recording.frame(self.frameNumber))
+        self.framesProcessed += 1
+        self.frameNumber += 1
+        return self.pacer.deadline(self.frameNumber)
+
+    def reload(self):
+        '''
+        reload - pick up the recording again, it may have grown, once the ReadAhead stage has mapped it
+        '''
+        if self.readAhead is None:
+            return
+        try:
+            prepared = self.readAhead.take(self.fileName)
+        except (OSError, ValueError) as error:
+            print("File: {}, could not be read: {}".format(self.fileName, error))
+            self.setStop()
+            return
+        if prepared is not None:
+            (self.recording, track) = prepared
+            self.pacer = FramePacer(track, self.speedFactor)
+
+    def publish(self, frame):
+        '''
+        publish - make a MJPEG frame the latest frame of the stream, replacing the previous one whether
+        or not every client has sent it
+        '''
+        with self.condition: # stream object access
+            self.frame = frame
+            self.version += 1
+            self.condition.notify_all()
+            listeners = self.listeners
+        for listener in listeners:
+            listener()
+
+    def addListener(self, listener):
+        '''
+        addListener - call listener after every frame published
+        '''
+        with self.condition: # stream object access
+            self.listeners = self.listeners + [listener]
+
+    def removeListener(self, listener):
+        '''
+        removeListener - stop calling listener
+        '''
+        with self.condition: # stream object access
+            self.listeners = [aListener for aListener in self.listeners if aListener is not listener]
+
+    def waitFrame(self, version, timeout):
+        '''
+        waitFrame - wait for a frame newer than version, returns the version and the latest frame, or
+        (version, None) on timeout.  A client that has fallen behind gets the newest frame and skips the rest.
+        '''
+        with self.condition: # stream object access
+            if not self.condition.wait_for(lambda: self.version > version, timeout):
+                return (version, None)
+            return (self.version, self.frame)
+
     def setStop(self):
         '''
-        setStop - stop readFile thread
+        setStop - stop producing frames
         '''
-        print("Stopping file read thread")
+        print("Stopping file stream")
         self.stop = True
 
-class SessionManager():
+class PlaylistStream(VideoFileStream):
+    '''
+    Playlist Stream class - plays the recordings triggered in a time range one after the other as one
+    stream, in the order they were triggered, and starts over after the last one.  While a recording
+    plays, the ReadAhead stage maps the next one and reads it into the page cache, so the first frame
+    of the next recording is due one frame interval after the last frame of the current one.  The
+    scheduler thread never loads a recording itself: while the next one is not ready, the last frame
+    stays shown.
+    '''
+    notReady = object()  # what load returns while the ReadAhead stage prepares the recording
+    retryInterval = 0.05  # seconds between looks for a recording that is not ready
+
+    def __init__(self, catalog, readAhead, rangeStart, rangeStop, speedFactor):
+        '''
+        Constructor
+        '''
+        super(PlaylistStream, self).__init__(None, 1, 0, speedFactor, readAhead)
+        self.catalog = catalog
+        self.rangeStart = rangeStart
+        self.rangeStop = rangeStop
+        self.fileNames = []
+        self.position = -1
+        self.waiting = False  # the recording at position is not ready yet
+
+    def key(self):
+        '''
+        key - the playback settings that decide whether a stream can share this producer
+        '''
+        return ('playlist', self.rangeStart, self.rangeStop, self.speedFactor)
+
+    def listRecordings(self):
+        '''
+        listRecordings - the names of the recordings of the range that can be played, oldest first
+        '''
+        return [recording.fileName for recording in self.catalog.between(self.rangeStart, self.rangeStop)
+                if http_files.isMotionJPEG(recording.fileName)]
+
+    def open(self):
+        '''
+        open - list the recordings of the range and have the first one read ahead, returns the
+        deadline of the first look for it
+        '''
+        print("Starting producer:", self.key())
+        self.fileNames = self.listRecordings()
+        if not self.fileNames:
+            print("No recordings in playlist range")
+            self.setStop()
+            return None
+        self.readAhead.request(self.fileNames[0])
+        return time.monotonic()
+
+    def load(self, position, due):
+        '''
+        load - make the recording at a position of the playlist current, with its first frame due at
+        due, and ask for the next one to be read ahead.  Returns the deadline of the first frame, None
+        if the recording is gone or can not be read, and is skipped, and notReady while the ReadAhead
+        stage prepares it.
+        '''
+        self.position = position
+        self.fileName = self.fileNames[position]
+        try:
+            prepared = self.readAhead.take(self.fileName)
+        except FileNotFoundError:
+            print("File: {}, was not found".format(self.fileName))
+            prepared = None
+        except (OSError, ValueError) as error:
+            print("File: {}, could not be read: {}".format(self.fileName, error))
+            prepared = None
+        else:
+            self.waiting = prepared is None
+            if self.waiting:
+                return self.notReady
+        self.readAhead.request(self.fileNames[(position + 1) % len(self.fileNames)])
+        if prepared is None:
+            return None
+        (self.recording, track) = prepared
+        self.pacer = FramePacer(track, self.speedFactor)
+        self.pacer.start(1, due)
+        self.frameNumber = 1
+        return self.pacer.deadline(1)
+
+    def lastFrame(self):
+        '''
+        lastFrame - last frame of the current recording
+        '''
+        return len(self.recording)
+
+    def advance(self):
+        '''
+        advance - publish the frame that is due, moving on to the next recording after the last frame
+        of the current one.  Returns the deadline of the next frame or None when stopped.
+        '''
+        if self.stop:
+            print("Ending producer:", self.key())
+            return None
+        attempts = 0
+        while self.recording is None or self.frameNumber > self.lastFrame():
+            if attempts > len(self.fileNames):
+                print("No frames in playlist range")
+                self.recording = None
+                self.position = len(self.fileNames) - 1  # look for recordings again next time
+                return time.monotonic() + 1.0
+            attempts += 1
+            due = self.pacer.deadline(self.frameNumber) if self.recording is not None else time.monotonic()
+            position = self.position if self.waiting else self.position + 1
+            if position >= len(self.fileNames):
+                # starting over, pick up recordings made or deleted meanwhile
+                self.fileNames = self.listRecordings()
+                position = 0
+                if not self.fileNames:
+                    self.recording = None
+                    return time.monotonic() + 1.0
+            deadline = self.load(position, due)
+            if deadline is self.notReady:
+                return time.monotonic() + self.retryInterval  # the last frame stays shown
+            if deadline is None:
+                self.recording = None
+        self.publish(self.recording.frame(self.frameNumber))
+        self.framesProcessed += 1
+        self.frameNumber += 1
+        return self.pacer.deadline(self.frameNumber)
+
+class ReadAhead(threading.Thread):
+    '''
+    Read Ahead class - one thread that maps the recordings playlists will play next, loading their
+    frame indexes and timestamp tracks and reading their frames into the page cache, off the
+    scheduler thread
+    '''
+    maxReady = 16
+
+    def __init__(self):
+        '''
+        Constructor
+        '''
+        super(ReadAhead, self).__init__(daemon=True)
+        self.requests = collections.deque()
+        self.ready = collections.OrderedDict()  # fileName -> (MappedRecording, TimestampTrack)
+        self.failed = {}  # fileName -> the error preparing it raised
+        self.condition = Condition()  # for controlling access to the requests and prepared recordings
+
+    def request(self, fileName):
+        '''
+        request - prepare a recording in the background
+        '''
+        with self.condition:
+            if fileName not in self.ready and fileName not in self.requests:
+                self.failed.pop(fileName, None)
+                self.requests.append(fileName)
+                self.condition.notify()
+
+    def take(self, fileName):
+        '''
+        take - (mapping, timestamp track) of a prepared recording, None while it is not ready, in which
+        case it is requested if it was not.  The error of a recording that could not be prepared is
+        raised, once.
+        '''
+        with self.condition:
+            prepared = self.ready.pop(fileName, None)
+            if prepared is None:
+                error = self.failed.pop(fileName, None)
+                if error is not None:
+                    raise error
+                if fileName not in self.requests:
+                    print("Read ahead of", fileName, "was not ready")
+                    self.requests.append(fileName)
+                    self.condition.notify()
+        return prepared
+
+    def prepare(self, fileName):
+        '''
+        prepare - map a recording, read its timestamp track and pull its frames into the page cache
+        '''
+        recording = MappedRecording.open(fileName)
+        recording.prefetch()
+        return (recording, TimestampTrack.load(fileName))
+
+    def run(self):
+        '''
+        run - prepare the requested recordings, oldest request first
+        '''
+        while True:
+            with self.condition:
+                while not self.requests:
+                    self.condition.wait()
+                fileName = self.requests[0]
+            try:
+                prepared = self.prepare(fileName)
+            except (OSError, ValueError) as error:
+                print("Read ahead of", fileName, "failed:", error)
+                prepared = None
+                failure = error
+            with self.condition:
+                self.requests.popleft()
+                if prepared is None:
+                    self.failed[fileName] = failure
+                    while len(self.failed) > self.maxReady:
+                        self.failed.pop(next(iter(self.failed)))
+                else:
+                    self.ready[fileName] = prepared
+                    while len(self.ready) > self.maxReady:
+                        self.ready.popitem(last=False)
+
+class StreamSubscription():
     '''
-    Class for making a HTTP client session manager
+    Stream Subscription class - one client's subscription to the producer of its session, in the
+    form the asyncio server reads frames from
+    '''
+    def __init__(self, sessionManager, referenceID, session, publisher):
+        '''
+        Constructor - publisher is the producer subscribed to for the session's playback settings
+        '''
+        self.sessionManager = sessionManager
+        self.referenceID = referenceID
+        self.session = session
+        self.publisher = publisher
+        self.version = 0
+
+    def poll(self):
+        '''
+        poll - (version, frame) of a frame newer than the last one read, (None, None) if there is none
+        yet and (version, None) once the session is closed
+        '''
+        if self.session['closed']:
+            return (self.version, None)
+        with self.publisher.condition: # stream object access
+            if self.publisher.version <= self.version:
+                return (None, None)
+            self.version = self.publisher.version
+            return (self.version, self.publisher.frame)
+
+    def next(self, timeout):
+        '''
+        next - wait up to timeout seconds for a frame newer than the last one read, (None, None) on timeout
+        '''
+        if self.session['closed']:
+            return (self.version, None)
+        (version, frame) = self.publisher.waitFrame(self.version, timeout)
+        if frame is None:
+            return (None, None)
+        self.version = version
+        return (version, frame)
+
+    def skip(self):
+        '''
+        skip - nothing to do, a subscription always reads the newest frame
+        '''
+
+    def close(self):
+        '''
+        close - end the subscription
+        '''
+        self.sessionManager.unsubscribe(self.publisher, self.referenceID)
+
+class PlaybackScheduler(threading.Thread):
+    '''
+    Playback Scheduler class - one thread that produces the frames of every VideoFileStream, driven
+    by a heap of next-frame deadlines
     '''
-    sessions = {}
-    nextSessionID = 1
-    condition = Condition()  # for rendevous of sessions object
     def __init__(self):
         '''
         Constructor
         '''
+        super(PlaybackScheduler, self).__init__(daemon=True)
+        self.heap = []
+        self.order = 0  # breaks deadline ties without comparing streams
+        self.condition = Condition()  # for controlling access to the heap
+
+    def add(self, stream, deadline):
+        '''
+        add - schedule the next frame of a stream
+        '''
+        with self.condition:
+            heapq.heappush(self.heap, (deadline, self.order, stream))
+            self.order += 1
+            self.condition.notify()
+
+    def run(self):
+        '''
+        run - publish frames as they become due
+        '''
+        while True:
+            with self.condition:
+                while not self.heap:
+                    self.condition.wait()
+                delay = self.heap[0][0] - time.monotonic()
+                if delay > 0:
+                    self.condition.wait(delay)  # an earlier deadline may be added meanwhile
+                    continue
+                (deadline, order, stream) = heapq.heappop(self.heap)
+            try:
+                deadline = stream.advance()
+            except Exception as error:  # a failing stream must not end playback for every session
+                print("Stopping producer", stream.key(), "after error:", repr(error))
+                stream.setStop()
+                deadline = None
+            if deadline is not None:
+                self.add(stream, deadline)
+
+class SessionManager():
+    '''
+    Class for making a HTTP client session manager.
+
+    Sessions are kept in least recently used order.  A session without open streams is removed
+    once it has been idle for idleTimeout seconds, and the least recently used session is evicted
+    when a new session would exceed maxSessions.
+    '''
+    def __init__(self, catalog, maxSessions=64, idleTimeout=1800.0):
+        '''
+        Constructor
+        '''
+        self.catalog = catalog
+        self.sessions = collections.OrderedDict()
+        self.producers = {}
+        self.nextSessionID = 1
+        self.maxSessions = maxSessions
+        self.idleTimeout = idleTimeout
+        self.condition = Condition()  # for rendevous of sessions object
+        self.scheduler = PlaybackScheduler()
+        self.scheduler.start()
+        self.readAhead = ReadAhead()
+        self.readAhead.start()
 
     def initializeSessionObject(self, fileName, referenceID):
         '''
@@ -370,41 +891,128 @@ class SessionManager():
         print("initializeSessionObject - waiting for sessions object access")
         with self.condition: # sessions object
             print("initializeSessionObject - Setting the conditions for session")
+            self.reap()
             if not referenceID in self.sessions:
+                if len(self.sessions) >= self.maxSessions:
+                    self.evict(self.leastRecentlyUsed())
                 self.sessions[self.nextSessionID] = {
                     'startFrame' : 1,
                     'stopFrame' : 450,
                     'speedFactor' : 1.0,
+                    'fileName' : fileName,
+                    'playlist' : None,  # (start, stop) trigger time range played instead of fileName
                     'condition' : Condition (),  # for controlling access to interface objects
-                    'sessionID' : self.nextSessionID }
+                    'sessionID' : self.nextSessionID,
+                    'lastActivity' : time.monotonic(),
+                    'streams' : 0,
+                    'closed' : False }
                 referenceID = self.nextSessionID
                 self.nextSessionID += 1
-                self.sessions[referenceID]['theThread'] = VideoFileThread(fileName, self.sessions[referenceID])
-            else:
-                with self.sessions[referenceID]['theThread'].condition:
-                    self.sessions[referenceID]['theThread'].setStop()
-                    self.sessions[referenceID]['theThread'].condition.notifyAll()
-                    oldFileName = self.sessions[referenceID]['theThread'].fileName
-                    self.sessions[referenceID]['theThread'] = VideoFileThread(oldFileName, self.sessions[referenceID])
+            self.touch(referenceID)
             self.condition.notify()
         print("initializeSessionObject - got sessions object access")
         return referenceID
 
-    def startVideoFileReadThread(self, referenceID):
+    def getSession(self, referenceID):
+        '''
+        Get a session entry and mark it as used, None if the session does not exist (anymore)
+        '''
+        with self.condition: # sessions object
+            session = self.sessions.get(referenceID)
+            if session is not None:
+                self.touch(referenceID)
+            self.condition.notify()
+        return session
+
+    def touch(self, referenceID):
+        '''
+        Record activity of a session, the caller holds the sessions object
+        '''
+        self.sessions[referenceID]['lastActivity'] = time.monotonic()
+        self.sessions.move_to_end(referenceID)
+
+    def leastRecentlyUsed(self):
+        '''
+        The least recently used session, preferring sessions without open streams, the caller holds the sessions object
+        '''
+        for referenceID in self.sessions:
+            if self.sessions[referenceID]['streams'] == 0:
+                return referenceID
+        return next(iter(self.sessions))
+
+    def reap(self):
+        '''
+        Remove idle sessions, the caller holds the sessions object
+        '''
+        now = time.monotonic()
+        for referenceID in list(self.sessions):
+            session = self.sessions[referenceID]
+            if session['streams'] == 0 and now - session['lastActivity'] > self.idleTimeout:
+                self.evict(referenceID)
+
+    def evict(self, referenceID):
+        '''
+        Remove a session, its open streams end at their next frame, the caller holds the sessions object
+        '''
+        print("Removing session:", referenceID)
+        self.sessions[referenceID]['closed'] = True
+        del self.sessions[referenceID]
+
+    def subscribe(self, referenceID):
         '''
-        Starts a thread and puts it in the sessions dictionary
+        Attach a stream of a session to the producer for the session's playback settings, starting
+        a producer only when no stream is already playing the same file with the same settings.  A new
+        producer is opened in the calling thread, outside the sessions object.  Returns None when the
+        session no longer exists.
         '''
-        with self.sessions[referenceID]['theThread'].condition:
-            if self.sessions[referenceID]['theThread'].notStarted:
-                self.sessions[referenceID]['theThread'].start()
-                self.sessions[referenceID]['theThread'].notStarted = False
-            self.sessions[referenceID]['theThread'].condition.notifyAll()
+        with self.condition: # sessions object
+            session = self.sessions.get(referenceID)
+        if session is None:
+            return None
+        with session['condition']:
+            playlist = session['playlist']
+            if playlist is None:
+                # the stream plays from frame 1 at the earliest, so earlier start frames share its producer
+                key = (session['fileName'], max(session['startFrame'], 1), session['stopFrame'], session['speedFactor'])
+            else:
+                key = ('playlist',) + playlist + (session['speedFactor'],)
+            session['condition'].notify()
+        with self.condition: # sessions object
+            if self.sessions.get(referenceID) is not session:
+                return None  # reaped or evicted meanwhile
+            session['streams'] += 1
+            producer = self.producers.get(key)
+            started = producer is None or producer.stop  # a producer that has failed is replaced
+            if started:
+                if playlist is None:
+                    producer = VideoFileStream(*key, readAhead=self.readAhead)
+                else:
+                    producer = PlaylistStream(self.catalog, self.readAhead, *key[1:])
+                producer.producerKey = key
+                self.producers[key] = producer
+            producer.subscribers += 1
+            print("Session", referenceID, "subscribed to producer:", key, ", subscribers:", producer.subscribers)
+            self.condition.notify()
+        if started:
+            deadline = producer.open()
+            if deadline is not None:
+                self.scheduler.add(producer, deadline)
+        return producer
 
-    def stopVideoThread(self, session):
+    def unsubscribe(self, producer, referenceID):
         '''
-        Stops the video streaming
+        Detach a stream of a session from its producer, stopping the producer when its last stream is gone
         '''
-        self.sessions[session]['theThread'].setStop()
+        with self.condition: # sessions object
+            if referenceID in self.sessions:
+                self.sessions[referenceID]['streams'] -= 1
+                self.touch(referenceID)
+            producer.subscribers -= 1
+            if producer.subscribers == 0:
+                producer.setStop()
+                if self.producers.get(producer.producerKey) is producer:
+                    del self.producers[producer.producerKey]
+            self.condition.notify()
 
 
 class StreamingFileServer(socketserver.ThreadingMixIn, httpServer.HTTPServer):
@@ -413,18 +1021,45 @@ class StreamingFileServer(socketserver.ThreadingMixIn, httpServer.HTTPServer):
     '''
     allow_reuse_address = True
     daemon_threads = True
-    def __init__(self, address, _class):
-        super(StreamingFileServer, self).__init__(address, _class)
-        self.sessionManager = SessionManager()
+    def __init__(self, address, _class, maxSessions=64, idleTimeout=1800.0, bind_and_activate=True):
+        super(StreamingFileServer, self).__init__(address, _class, bind_and_activate)
+        self.catalog = RecordingCatalog()
+        self.catalog.sync()
+        self.sessionManager = SessionManager(self.catalog, maxSessions, idleTimeout)
+        self.frameCache = FrameCache()
+        self.pageCache = http_files.PageCache(maxSessions + 1)
+        self.styleSheet = http_files.StaticAsset('playbackStyle.css', 'text/css')
+
+    def frameSource(self, path):
+        '''
+        frameSource - the frames a stream request path refers to, for the asyncio server, None if the
+        path is not a stream of an existing session
+        '''
+        matchObject = sessionIDPattern.search(path)
+        if not ('/stream.mjpg' in path or '/stream.ws' in path) or not matchObject:
+            return None
+        referenceID = int(matchObject.group(1))
+        session = self.sessionManager.getSession(referenceID)
+        publisher = None if session is None else self.sessionManager.subscribe(referenceID)
+        if publisher is None:
+            return None
+        print("Starting a stream with session ID:", referenceID)
+        return StreamSubscription(self.sessionManager, referenceID, session, publisher)
 
 def main():
     '''
     Main program for MJPEG streamer
     '''
+    parser = argparse.ArgumentParser(description="Playback server for surveillance camera recordings")
+    parser.add_argument("--asyncio", action="store_true", help="serve all clients from one asyncio event loop")
+    arguments = parser.parse_args()
     address = ('', 8000)        # use port 8000
-    server = StreamingFileServer(address, StreamingHandler)  # Make a Streaming Video HTTP server
+    server = StreamingFileServer(address, StreamingHandler, bind_and_activate=not arguments.asyncio)  # Make a Streaming Video HTTP server
     try:
-        server.serve_forever()      # start the server
+        if arguments.asyncio:
+            AsyncStreamingServer(server, address, StreamingHandler).serveForever()
+        else:
+            server.serve_forever()      # start the server
     except KeyboardInterrupt:
         print("Gracefully exiting via user request")
     finally:
@@ -0,0 +1,158 @@
+'''
+Retention module - keeps the recordings within limits of age, total size and free disk space
+'''
+import shutil
+import sqlite3
+import threading
+import time
+
+class RetentionManager(threading.Thread):
+    '''
+    RetentionManager class - a background thread that deletes the oldest recordings while one is
+    older than maxAgeDays, the recordings take more than maxBytes or the disk has less than
+    minFreeBytes free.  A limit of None is not enforced.
+
+    The candidates are read from the catalog's trigger time index a batch at a time, so the
+    directory is never scanned.  Every deletion is followed by a pause, so that freeing a lot of
+    space at once does not keep the card busy while an event is being recorded.  The newest
+    recordings are always kept, and when deleting every other recording would not free enough space
+    because something else fills the disk, the free space limit is reported instead of enforced.
+    '''
+    interval = 30.0  # seconds between checks
+    batchSize = 8  # recordings read from the catalog at a time
+    deletePause = 0.25  # seconds after every deletion
+    keepNewest = 1  # recordings never deleted
+
+    def __init__(self, catalog, maxAgeDays=None, maxBytes=None, minFreeBytes=None, path='.'):
+        '''
+        Constructor - path is a directory on the disk the recordings are written to
+        '''
+        super(RetentionManager, self).__init__(daemon=True)
+        self.catalog = catalog
+        self.maxAgeDays = maxAgeDays
+        self.maxBytes = maxBytes
+        self.minFreeBytes = minFreeBytes
+        self.path = path
+        self.usage = (0, 0, 0)  # recordings, their bytes and free bytes, as last measured
+        self.deleted = 0
+        self.freeSpaceUnreachable = False  # the free space limit can not be met by deleting recordings
+        self.terminate = False
+        self.condition = threading.Condition()  # for controlling access to the usage and terminate
+
+    def measure(self):
+        '''
+        measure - (recordings, their total bytes, free bytes on the disk) now, kept for getUsage
+        '''
+        (count, totalBytes) = self.catalog.usage()
+        usage = (count, totalBytes, shutil.disk_usage(self.path).free)
+        with self.condition:
+            self.usage = usage
+        return usage
+
+    def getUsage(self):
+        '''
+        getUsage - (recordings, their total bytes, free bytes on the disk) at the last check
+        '''
+        with self.condition:
+            return self.usage
+
+    def describeLimits(self):
+        '''
+        describeLimits - the limits in words, for the index page
+        '''
+        limits = []
+        if self.maxAgeDays is not None:
+            limits.append('{:g} days'.format(self.maxAgeDays))
+        if self.maxBytes is not None:
+            limits.append('{:.0f} MB of recordings'.format(self.maxBytes / 1e6))
+        if self.minFreeBytes is not None:
+            limits.append('{:.0f} MB free'.format(self.minFreeBytes / 1e6))
+        return ', '.join(limits) if limits else 'none'
+
+    def reason(self, recording, now, totalBytes, freeBytes):
+        '''
+        reason - why the oldest recording has to be deleted, None when it can stay.  A freeBytes of
+        None leaves the free space limit out.
+        '''
+        if self.maxAgeDays is not None and recording.triggerTime < now - self.maxAgeDays * 86400.0:
+            return 'older than {:g} days'.format(self.maxAgeDays)
+        if self.maxBytes is not None and totalBytes > self.maxBytes:
+            return 'recordings over {:.0f} MB'.format(self.maxBytes / 1e6)
+        if self.minFreeBytes is not None and freeBytes is not None and freeBytes < self.minFreeBytes:
+            return 'free space under {:.0f} MB'.format(self.minFreeBytes / 1e6)
+        return None
+
+    def reachableFree(self, totalBytes, freeBytes):
+        '''
+        reachableFree - freeBytes when deleting all but the newest recordings can bring the free space
+        up to its limit, None when it can not and the limit has to be left out
+        '''
+        if self.minFreeBytes is None or freeBytes >= self.minFreeBytes:
+            self.freeSpaceUnreachable = False
+            return freeBytes
+        (newest, nextKey) = self.catalog.page(limit=self.keepNewest)
+        deletableBytes = totalBytes - sum(recording.size for recording in newest)
+        if freeBytes + deletableBytes >= self.minFreeBytes:
+            self.freeSpaceUnreachable = False
+            return freeBytes
+        if not self.freeSpaceUnreachable:
+            print("Retention: {:.0f} MB free, deleting the recordings would not reach {:.0f} MB, "
+                  "the disk is filled by other files".format(freeBytes / 1e6, self.minFreeBytes / 1e6))
+        self.freeSpaceUnreachable = True
+        return None
+
+    def enforce(self):
+        '''
+        enforce - delete the oldest recordings until the limits are met, returns how many were deleted
+        '''
+        deleted = 0
+        (count, totalBytes, freeBytes) = self.measure()
+        freeBytes = self.reachableFree(totalBytes, freeBytes)
+        while not self.terminate:
+            batch = self.catalog.oldest(max(min(self.batchSize, count - self.keepNewest), 0))
+            now = time.time()
+            kept = False
+            for recording in batch:
+                reason = self.reason(recording, now, totalBytes, freeBytes)
+                if reason is None:
+                    kept = True
+                    break
+                print("Retention: deleting", recording.fileName, "-", reason)
+                try:
+                    self.catalog.delete(recording.fileName)
+                except OSError as error:
+                    print("Retention: could not delete", recording.fileName, error)
+                deleted += 1
+                count -= 1
+                totalBytes -= recording.size
+                if freeBytes is not None:
+                    freeBytes += recording.size
+                time.sleep(self.deletePause)
+            if kept or len(batch) < self.batchSize:
+                break
+            (count, totalBytes, freeBytes) = self.measure()  # what the disk really freed
+            freeBytes = self.reachableFree(totalBytes, freeBytes)
+        if deleted:
+            self.deleted += deleted
+            self.measure()
+        return deleted
+
+    def run(self):
+        '''
+        run - check the limits every interval seconds
+        '''
+        while not self.terminate:
+            try:
+                self.enforce()
+            except (OSError, sqlite3.Error) as error:
+                print("Retention: check failed", error)
+            with self.condition:
+                self.condition.wait_for(lambda: self.terminate, self.interval)
+
+    def terminateRetention(self):
+        '''
+        Stop the thread
+        '''
+        with self.condition:
+            self.terminate = True
+            self.condition.notify_all()
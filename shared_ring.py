@@ -0,0 +1,256 @@
+'''
+Shared frame ring module - hands frames from the capture process to HTTP serving processes
+through shared memory
+'''
+from multiprocessing import shared_memory
+import os
+import struct
+import threading
+import time
+from frame_ring import FrameRing
+
+def processAlive(pid):
+    '''
+    processAlive - whether a process with the id is running
+    '''
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass  # running as another user
+    return True
+
+class SharedFrameRing():
+    '''
+    SharedFrameRing class - a ring of frame slots in a multiprocessing.shared_memory block, written
+    by one process and read by others without pickling or sockets.
+
+    Every slot is guarded by a sequence lock: the writer makes the slot's version odd while it
+    copies a frame in and even again afterwards, and a reader keeps a frame only if it saw the same
+    even version before and after copying it out.  Each reading process also owns a counter of its
+    subscribers next to its process id, which tells the writer whether anybody wants the frames at
+    all; the counter of a process that has died is ignored.  The header also
+    says whether the camera is shown, the thumb and vga tiers have no frames while a recording is.
+    '''
+    magic = b'MJPGSHM1'
+    headerFormat = '<8sIIIIQ'  # magic, slots, slot size, readers, camera shown, newest sequence number
+    interestFormat = '<II'  # process id, subscribers
+    slotFormat = '<QQI4x'  # version, sequence number, frame length
+    endOfStream = 0xffffffff  # frame length of a frame of None
+
+    def __init__(self, name, slots=8, slotSize=512 * 1024, readers=1, create=False):
+        '''
+        Constructor - create, or attach to, the shared memory block called name
+        '''
+        self.slots = slots
+        self.slotSize = slotSize
+        self.readers = readers
+        self.headerSize = struct.calcsize(self.headerFormat)
+        self.liveOffset = struct.calcsize(self.headerFormat[:-2])
+        self.interestOffset = self.headerSize
+        self.slotOffset = self.interestOffset + 8 * readers
+        self.slotHeaderSize = struct.calcsize(self.slotFormat)
+        size = self.slotOffset + slots * (self.slotHeaderSize + slotSize)
+        if create:
+            try:
+                self.memory = shared_memory.SharedMemory(name=name, create=True, size=size)
+            except FileExistsError:
+                # left behind by a process that was killed
+                shared_memory.SharedMemory(name=name).unlink()
+                self.memory = shared_memory.SharedMemory(name=name, create=True, size=size)
+            struct.pack_into(self.headerFormat, self.memory.buf, 0, self.magic, slots, slotSize, readers, 1, 0)
+        else:
+            self.memory = shared_memory.SharedMemory(name=name)
+        self.buffer = self.memory.buf
+        self.oversized = 0
+
+    def sequence(self):
+        '''
+        sequence - sequence number of the newest frame, 0 before the first frame
+        '''
+        return struct.unpack_from('<Q', self.buffer, self.headerSize - 8)[0]
+
+    def slot(self, sequence):
+        '''
+        slot - offset of the slot that holds the frame with a sequence number
+        '''
+        return self.slotOffset + (sequence % self.slots) * (self.slotHeaderSize + self.slotSize)
+
+    def publish(self, frame):
+        '''
+        publish - copy a frame into the oldest slot, called by the writing process only.  Frames
+        larger than a slot are dropped.
+        '''
+        length = self.endOfStream if frame is None else len(frame)
+        if frame is not None and length > self.slotSize:
+            self.oversized += 1
+            if self.oversized == 1:
+                print("Frame of", length, "bytes does not fit a shared ring slot of", self.slotSize, "bytes")
+            return
+        sequence = self.sequence() + 1
+        offset = self.slot(sequence)
+        (version,) = struct.unpack_from('<Q', self.buffer, offset)
+        struct.pack_into('<Q', self.buffer, offset, version + 1)
+        struct.pack_into('<QI', self.buffer, offset + 8, sequence, length)
+        if frame is not None:
+            start = offset + self.slotHeaderSize
+            self.buffer[start:start + length] = frame
+        struct.pack_into('<Q', self.buffer, offset, version + 2)
+        struct.pack_into('<Q', self.buffer, self.headerSize - 8, sequence)
+
+    def read(self, sequence):
+        '''
+        read - (sequence number, frame) of the frame with a sequence number, copied out of its slot.
+        Returns (None, None) when the slot is being written, already holds a newer frame or its
+        length does not fit the slot.
+        '''
+        offset = self.slot(sequence)
+        (before, slotSequence, length) = struct.unpack_from(self.slotFormat, self.buffer, offset)
+        if before & 1 or slotSequence != sequence or (length > self.slotSize and length != self.endOfStream):
+            return (None, None)
+        frame = None
+        if length != self.endOfStream:
+            start = offset + self.slotHeaderSize
+            frame = bytes(self.buffer[start:start + length])
+        (after,) = struct.unpack_from('<Q', self.buffer, offset)
+        if after != before:
+            return (None, None)
+        return (sequence, frame)
+
+    def setLive(self, live):
+        '''
+        setLive - publish whether the camera is shown rather than a recording, called by the writing process
+        '''
+        struct.pack_into('<I', self.buffer, self.liveOffset, 1 if live else 0)
+
+    def live(self):
+        '''
+        live - whether the camera is shown rather than a recording
+        '''
+        return struct.unpack_from('<I', self.buffer, self.liveOffset)[0] != 0
+
+    def setInterest(self, reader, subscribers):
+        '''
+        setInterest - publish the number of subscribers of the calling reading process
+        '''
+        struct.pack_into(self.interestFormat, self.buffer, self.interestOffset + 8 * reader, os.getpid(), subscribers)
+
+    def interest(self):
+        '''
+        interest - subscribers of all reading processes that are still running together
+        '''
+        total = 0
+        for reader in range(self.readers):
+            (pid, subscribers) = struct.unpack_from(self.interestFormat, self.buffer, self.interestOffset + 8 * reader)
+            if subscribers and processAlive(pid):
+                total += subscribers
+        return total
+
+    def close(self):
+        '''
+        close - detach from the shared memory, unlink removes it
+        '''
+        self.buffer = None
+        self.memory.close()
+
+    def unlink(self):
+        '''
+        unlink - remove the shared memory block, called by the process that created it
+        '''
+        self.memory.unlink()
+
+class RingExporter(threading.Thread):
+    '''
+    RingExporter class - copies the frames of a local publisher into a SharedFrameRing while any
+    reading process has subscribers.  subscribe() returns a cursor into the local frames.
+    '''
+    def __init__(self, ring, subscribe, pollInterval=0.25):
+        '''
+        Constructor
+        '''
+        super(RingExporter, self).__init__(daemon=True)
+        self.ring = ring
+        self.subscribe = subscribe
+        self.pollInterval = pollInterval
+
+    def run(self):
+        '''
+        run - subscribe while there is interest, copying every frame read
+        '''
+        cursor = None
+        while True:
+            if self.ring.interest() > 0:
+                if cursor is None:
+                    cursor = self.subscribe()
+                (sequence, frame) = cursor.next(timeout=self.pollInterval)
+                if sequence is not None:
+                    self.ring.publish(frame)
+            else:
+                if cursor is not None:
+                    cursor.close()
+                    cursor = None
+                time.sleep(self.pollInterval)
+
+class RingImporter():
+    '''
+    RingImporter class - the serving process side of a SharedFrameRing.  While it has subscribers a
+    thread copies each new shared frame once into a local FrameRing, which all clients of the
+    process read through their own cursors.  Frames keep their shared sequence numbers, so snapshot
+    ETags mean the same in every serving process.
+    '''
+    def __init__(self, ring, reader, pollInterval=0.004):
+        '''
+        Constructor - reader is the number of this process among the ring's readers
+        '''
+        self.shared = ring
+        self.reader = reader
+        self.pollInterval = pollInterval
+        self.ring = FrameRing()
+        self.subscribers = 0
+        self.thread = None
+        self.condition = threading.Condition()  # for controlling access to the subscriber count
+
+    def subscribe(self):
+        '''
+        subscribe - a cursor into the local frames that unsubscribes when it is closed
+        '''
+        with self.condition:
+            self.subscribers += 1
+            self.shared.setInterest(self.reader, self.subscribers)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.copyFrames, daemon=True)
+                self.thread.start()
+        return self.ring.cursor(self.unsubscribe)
+
+    def unsubscribe(self):
+        '''
+        unsubscribe - remove a subscriber, the copying thread ends after the last one
+        '''
+        with self.condition:
+            self.subscribers -= 1
+            self.shared.setInterest(self.reader, self.subscribers)
+
+    def copyFrames(self):
+        '''
+        copyFrames - poll the shared ring for new frames, skipping to the newest one when the
+        writer has overwritten frames not yet copied
+        '''
+        sequence = max(self.shared.sequence() - 1, 0)  # start with the newest frame
+        while True:
+            with self.condition:
+                if self.subscribers == 0:
+                    self.thread = None
+                    return
+            newest = self.shared.sequence()
+            if newest == sequence:
+                time.sleep(self.pollInterval)
+                continue
+            if newest - sequence >= self.shared.slots:
+                sequence = newest - 1
+            (copied, frame) = self.shared.read(sequence + 1)
+            if copied is None:
+                sequence = self.shared.sequence() - 1
+                continue
+            sequence = copied
+            self.ring.publish(frame, sequence)
@@ -1,33 +1,49 @@
 '''
 Surveillance Camera module
 '''
-import io
-import glob
+import argparse
+import binascii
+import html
 from http import server as httpServer
+import http.client
+import multiprocessing
 import json
 import numpy as np
-import os
+import shutil
+import socket
 import socketserver
 import time
 import threading
+from urllib.parse import parse_qs, urlsplit
 from threading import Condition
 import picamera
 from picamera.array import PiMotionAnalysis
 import HW
+from motion import MotionZone, ZoneSet, maskShape, packMask, unpackMask
+from mjpeg import FramePacer, FrameSplitter, MappedRecording, TimestampTrack
+import http_files
+from catalog import RecordingCatalog, filterForm, listingQuery, olderLink
+from frame_ring import FrameRing
+from event_recorder import EventRecorder
+from retention import RetentionManager
+from shared_ring import RingExporter, RingImporter, SharedFrameRing
+from async_server import AsyncStreamingServer
+import websocket
 
 class StreamingOutput():
     '''
-    StreamingOutput class - used to make objects that produce output streams to HTTP clients
+    StreamingOutput class - used to make objects that produce output streams to HTTP clients.
+    Frames are published into a FrameRing that every client reads at its own pace.
     '''
     def __init__(self):
         '''
-        Constructor - create buffer and threading related objects
+        Constructor - create the frame splitter and threading related objects
         '''
         self.frame = None
         self.stop = False
-        self.buffer = io.BytesIO()
-        self.startOfFrame = b"\xff\xd8"
+        self.splitter = FrameSplitter()
         self.condition = Condition()
+        self.ring = FrameRing()
 
     def start(self, fileName):
         '''
@@ -39,56 +55,49 @@ class StreamingOutput():
 
     def readFile(self, fileName):
         '''
-        readFile - reads a file and divides it into frames for the write method.
+        readFile - reads a file and hands its frames to HTTP clients as views of the mapped file.
         '''
         if fileName == 'default':
             return
         self.stop = False
         try:
-            fileHandle = open(fileName, "rb")
-            self.write(self.startOfFrame)
-            buff = fileHandle.read(10000)
-            if not self.stop:
-                segmentStart = 0
-                while buff:
-                    location = buff.find(self.startOfFrame, segmentStart)
-                    while location > 0:
-                        self.write(buff[segmentStart:location])
-                        spin = 0
-                        while spin < 1250:
-                            spin += 1
-                        segmentStart = location
-                        location = buff.find(self.startOfFrame, segmentStart+2)
-                    self.write(buff[segmentStart:])
-                    spin = 0
-                    while spin < 1250:
-                        spin += 1
-                    segmentStart = 0
-                    buff = fileHandle.read(10000)
-                    if self.stop:
-                        print("exiting read file loop")
-                        break
-            fileHandle.close()
+            recording = MappedRecording.open(fileName)
+            pacer = FramePacer(TimestampTrack.load(fileName), 1.0)
+            governor = Condition()
+            for frameNumber in range(1, len(recording) + 1):
+                with governor:
+                    governor.wait(pacer.delay(frameNumber))
+                self.publish(recording.frame(frameNumber))
+                if self.stop:
+                    print("exiting read file loop")
+                    break
         except FileNotFoundError:
             print("File: {}, was not found".format(fileName))
-        with self.condition:
-            self.frame = None
-            self.condition.notify_all()
-            print("Video display finished")
+        self.publish(None)
+        print("Video display finished")
 
     def write(self, buf):
         '''
-        write - write buffer to stream.  The buffers are expected to be MJPEG frames.
+        write - write buffer to stream.  The buffers are pieces of an MJPEG stream; every frame they
+        complete is handed to the clients as soon as its end of image marker arrives.
         '''
-        if buf.startswith(b'\xff\xd8'):
-            # New frame, copy the existing buffer's content and notify all
-            # clients it's available
-            self.buffer.truncate()
-            with self.condition:
-                self.frame = self.buffer.getvalue()
-                self.condition.notify_all()
-            self.buffer.seek(0)
-        return self.buffer.write(buf)
+        for (offset, frame) in self.splitter.feed(buf):
+            self.publish(frame)
+        return len(buf)
+
+    def reset(self):
+        '''
+        reset - discard a partial frame left by an encoder that was stopped
+        '''
+        self.splitter = FrameSplitter()
+
+    def publish(self, frame):
+        '''
+        publish - make a frame the latest frame and hand it to the clients, None ends their streams
+        '''
+        with self.condition:
+            self.frame = frame
+        self.ring.publish(frame)
 
     def setStop(self):
         '''
@@ -96,6 +105,158 @@ class StreamingOutput():
         '''
         self.stop = True
 
+class TeeOutput():
+    '''
+    TeeOutput class - passes the output of an encoder to its target and to the outputs attached to
+    it.  Whoever holds the condition sees no chunk written to the target that the attached outputs
+    have not been given, or will not be given.
+    '''
+    def __init__(self, target):
+        '''
+        Constructor
+        '''
+        self.target = target
+        self.outputs = []
+        self.condition = Condition()  # for controlling access to the target and the list of outputs
+
+    def attach(self, output):
+        '''
+        attach - pass the chunks written from now on to output as well
+        '''
+        with self.condition:
+            self.outputs = self.outputs + [output]
+
+    def detach(self, output):
+        '''
+        detach - stop passing chunks to output
+        '''
+        with self.condition:
+            self.outputs = [anOutput for anOutput in self.outputs if anOutput is not output]
+
+    def write(self, buf):
+        '''
+        write - write buffer to the target and the attached outputs
+        '''
+        with self.condition:
+            written = self.target.write(buf)
+            outputs = self.outputs
+        for output in outputs:
+            output.write(buf)
+        return written
+
+    def flush(self):
+        '''
+        flush - flush the target
+        '''
+        return self.target.flush()
+
+class QualityTier():
+    '''
+    QualityTier class - one named quality of the live view.  All subscribers of a tier read one
+    StreamingOutput.  The tier's encoder runs on its own splitter port, or the MJPEG of the recording
+    port is teed to it, only while the tier has subscribers and the camera, not a recording, is
+    shown.  A tier stops idleTimeout seconds after its last subscriber left, so that clients polling
+    snapshots don't restart the encoder for every request.
+    '''
+    idleTimeout = 5.0
+
+    def __init__(self, name, camera, output, splitterPort=None, resize=None, tee=None):
+        '''
+        Constructor - give either a splitter port and resize for an encoder of its own, or the tee of
+        an encoder to share
+        '''
+        self.name = name
+        self.camera = camera
+        self.output = output
+        self.splitterPort = splitterPort
+        self.resize = resize
+        self.tee = tee
+        self.subscribers = 0
+        self.running = False
+        self.live = True
+        self.stopTimer = None
+        self.condition = Condition()  # for controlling access to the subscriber count and encoder state
+
+    def subscribe(self):
+        '''
+        subscribe - add a subscriber, starting the encoder for the first one.  Returns a cursor into
+        the tier's frames that unsubscribes when it is closed.
+        '''
+        with self.condition:
+            self.subscribers += 1
+            if self.stopTimer is not None:
+                self.stopTimer.cancel()
+                self.stopTimer = None
+            if self.live and not self.running:
+                self.startEncoder()
+        return self.output.ring.cursor(self.unsubscribe)
+
+    def unsubscribe(self):
+        '''
+        unsubscribe - remove a subscriber, the encoder stops a while after the last one
+        '''
+        with self.condition:
+            self.subscribers -= 1
+            if self.subscribers == 0 and self.running:
+                self.stopTimer = threading.Timer(self.idleTimeout, self.idleStop)
+                self.stopTimer.daemon = True
+                self.stopTimer.start()
+
+    def idleStop(self):
+        '''
+        idleStop - stop the encoder of a tier nobody subscribes to, its latest frame becomes None
+        '''
+        with self.condition:
+            if self.subscribers > 0 or not self.running:
+                return
+            self.stopEncoder()
+        self.output.publish(None)
+
+    def pause(self):
+        '''
+        pause - stop the encoder while a recording is shown or the camera is reconfigured
+        '''
+        with self.condition:
+            self.live = False
+            if self.stopTimer is not None:
+                self.stopTimer.cancel()
+                self.stopTimer = None
+            if self.running:
+                self.stopEncoder()
+
+    def resume(self):
+        '''
+        resume - show the camera again, restarting the encoder if the tier has subscribers
+        '''
+        with self.condition:
+            self.live = True
+            if self.subscribers > 0 and not self.running:
+                self.startEncoder()
+
+    def startEncoder(self):
+        '''
+        startEncoder - start feeding the tier's output, the caller holds the condition
+        '''
+        self.output.reset()
+        if self.tee is not None:
+            self.tee.attach(self.output)
+        else:
+            self.camera.start_recording(self.output, format='mjpeg', splitter_port=self.splitterPort,
+                                        resize=self.resize)
+        self.running = True
+        print("Started quality tier:", self.name)
+
+    def stopEncoder(self):
+        '''
+        stopEncoder - stop feeding the tier's output, the caller holds the condition
+        '''
+        if self.tee is not None:
+            self.tee.detach(self.output)
+        else:
+            self.camera.stop_recording(splitter_port=self.splitterPort)
+        self.running = False
+        print("Stopped quality tier:", self.name)
+
 class StreamingHandler(httpServer.BaseHTTPRequestHandler):
     '''
     StreamingHandler - class that will build an object that implements a basic HTTP server
@@ -110,276 +271,39 @@ class StreamingHandler(httpServer.BaseHTTPRequestHandler):
             self.send_header('Location', '/index.html')
             self.end_headers()
 
-        elif self.path == '/index.html':
+        elif urlsplit(self.path).path == '/index.html':
+            camera = self.server.camera
             if self.server.settingsMode:
-                page = ""
-                page += '<!DOCTYPE html>\n'
-                page += '<html lang="en">\n'
-                page += '<head>\n'
-                page += '<meta charset="utf-8">\n'
-                page += '<meta http-equiv="Pragma" content="no-cache">\n'
-                page += '<link rel="stylesheet" href="style.css"/>\n'
-                page += '<title>Calibrate</title>\n'
-                page += '</head>\n'
-                page += '<body>\n'
-                page += '<h1>Settings Mode</h1>\n'
-                page += '<img class="base" src="stream.mjpg" width="640" height="480" style="position:absolute; top:60px; left:10px" />\n'
-                page += '<canvas class="overlay" id="imageArea" width="640" height="480" style="position:absolute; top:60px; left:10px"></canvas>\n'
-                page += '<script>'
-                page += 'var mask = ' + str(self.server.defaultsObject.mask.tolist()) + ';\n'
-                page += 'console.log("after definition, before drawGrid:", mask[29][21]);\n'
-                page += 'function drawGrid(canvas, mask) {\n'
-                page += "  let context = canvas.getContext('2d');\n"
-                page += '  context.clearRect(0, 0, canvas.width, canvas.height);\n'
-                page += '  context.beginPath();\n'
-                page += '  context.lineWidth = 1;\n'
-                page += '  context.globalAlpha = 0.7;\n'
-                page += "  context.strokeStyle = 'white';\n"
-                page += '  let maskIndexX = 0;\n'
-                page += '  let maskIndexY = 0;\n'
-                page += '  let totalRed = 0;\n'
-                page += '  let totalWhite = 0;\n'
-                page += '  for (var row = 0; row < 480; row += 16) {\n'
-                page += '    //console.log("Processing row", row, "with mask index of", maskIndexY, "current total reds", totalRed, "whites", totalWhite);\n'
-                page += '    //context.moveTo(0, row);\n'
-                page += '    for (var col = 0; col < 640; col += 16) {\n'
-                page += '      context.beginPath();\n'
-                page += '      context.moveTo(col, row);\n'
-                page += '      //console.log("Processing col", col, "with mask index of", maskIndexX);\n'
-                page += '      if (mask[maskIndexY][maskIndexX] == 1) {\n'
-                page += "        context.strokeStyle = 'red';\n"
-                page += '        //console.log("setting red");\n'
-                page += '        totalRed++;\n'
-                page += '      } else {'
-                page += "        context.strokeStyle = 'white';\n"
-                page += '        totalWhite++;\n'
-                page += '        //console.log("setting white");\n'
-                page += '      }'
-                page += '      context.lineTo(col+16, row);\n'
-                page += '      maskIndexX += 1;\n'
-                page += '      context.stroke();\n'
-                page += '    }'
-                page += '    maskIndexX = 0;\n'
-                page += '    maskIndexY += 1;\n'
-                page += '  }\n'
-                page += '  context.beginPath();\n'
-                page += "  context.strokeStyle = 'white';\n"
-                page += '  for (var col = 0; col < 640; col += 16) {\n'
-                page += '    context.moveTo(col, 0);\n'
-                page += '    context.lineTo(col, 479);\n'
-                page += '  }\n'
-                page += '  context.stroke();\n'
-                page += '  console.log("stroking row, total red regions:", totalRed);\n'
-                page += '}\n'
-                page += 'function getMousePosition(canvas, event) {\n'
-                page += '  let rect = canvas.getBoundingClientRect();\n'
-                page += '  let x = event.clientX - rect.left;\n'
-                page += '  let y = event.clientY - rect.top;\n'
-                page += '  if (x < 0) {\n'
-                page += '    x = 0;\n'
-                page += '  } else if (x > (rect.width - 16)) {\n'
-                page += '    x = rect.width - 16;\n'
-                page += '  }\n'
-                page += '  if (y < 0) {\n'
-                page += '    y = 0;\n'
-                page += '  } else if (y > (rect.height - 16)) {\n'
-                page += '    y = rect.height - 16;\n'
-                page += '  }\n'
-                page += '  return { x: x, y: y };\n'
-                page += '}\n'
-                page += 'console.log("sample mask value:", mask[29][20]);\n'
-                page += 'var canvas = document.getElementById("imageArea");\n'
-                page += 'console.log("canvas has been definded", canvas);\n'
-                page += 'var mousePosition = {x: 0, y:0};\n'
-                page += 'var cursorMousePosition = {x:0, y:0};\n'
-                page += 'var message = "";\n'
-                page += 'var drawing = false;\n'
-                page += 'var rawLastDigit = null;\n'
-                page += 'var changeMask = false;\n'
-                page += 'var lastMaskX = -1;\n'
-                page += 'var lastMaskY = -1;\n'
-                page += "canvas.addEventListener('mousemove', function(event) {\n"
-                page += '  cursorMousePosition = getMousePosition(canvas, event);\n'
-                page += '  let newX = Math.floor(cursorMousePosition.x / 16);\n'
-                page += '  let newY = Math.floor(cursorMousePosition.y /16);\n'
-                page += '  if (changeMask) {\n'
-                page += '    if (newX != lastMaskX || newY != lastMaskY) {\n'
-                page += '      console.log("new cell position");\n'
-                page += '      lastMaskX = newX;\n'
-                page += '      lastMaskY = newY;\n'
-                page += '      mask[newY][newX] = mask[newY][newX] ^ 1;\n'
-                page += '      drawGrid(canvas, mask);\n'
-                page += '    }\n'
-                page += '  }\n'
-                page += '}, false);\n'
-                page += 'canvas.addEventListener("mousedown", function(event) {\n'
-                page += '  mousePosition = getMousePosition(canvas, event);\n'
-                page += '  changeMask = ! changeMask;\n'
-                page += '  console.log("changing changeMask to", changeMask);\n'
-                page += '  if (!changeMask) {\n'
-                page += '    let post = new XMLHttpRequest();\n'
-                page += '    post.open("POST", "/BoxPosition");\n'
-                page += "    post.setRequestHeader('Content-Type', 'application/x-www-form-urlencoded');\n"
-                page += "    let info = 'mask=' + mask ;\n"
-                page += '    post.send(info);\n'
-                page += '    post.onreadystatechange = function() {\n'
-                page += '      if (post.readyState == 4) {\n'
-                page += '        if (post.status = 200) {\n'
-                page += '          console.log("Got:", post.responseText);\n'
-                page += '        }\n'
-                page += '      }\n'
-                page += '    };\n'
-                page += '  }\n'
-                page += '}, false);\n'
-                page += 'var firstGrid = true;'
-                page += 'var intervalCount = 0;'
-                page += 'setInterval(function() {\n'
-                page += '  if (firstGrid) {\n'
-                page += '    if (intervalCount > 0) {\n'
-                page += '      console.log("drawing first grid");'
-                page += '      firstGrid = false;\n'
-                page += '      drawGrid(canvas, mask);\n'
-                page += '    } else {\n'
-                page += '      intervalCount++;\n'
-                page += '    }\n'
-                page += '  }\n'
-                page += '}, 500);\n'
-                page += 'console.log("Setup complete")\n'
-                page += "</script>\n"
-                page += '<div style="position:absolute; top:540px; left:20px">\n'
-                page += '<h2>Camera Settings</h2>'
-                page += '<ul>'
-                page += '<li>'
-                page += '<form action="/index.html" method="post">'
-                page += '<label for="camera1">Shutter Speed:</label><input pattern="[0-9]{1,7}" type="text" name="Shutter"'
-                page += ' placeholder="' + "{:7d}".format(self.server.camera.exposure_speed) + '" maxlength="8" size="8"> microseconds</li>'
-                page += '</form>'
-                page += '<li>'
-                page += '<form action="/index.html" method="post">'
-                page += '<label for="camera2">Frame Rate:</label><input pattern="[0-9]{1,2}" type="text" name="FrameRate"'
-                page += ' placeholder="' + "{:2d}".format(int(float(self.server.camera.framerate.numerator)/float(self.server.camera.framerate.denominator))) + '" maxlength="3" size="3"> frames / second</li>'
-                page += '</form>'
-                page += '</ul>'
-                page += '<form action="/index.html" method="post">'
-                page += '<h2>Motion Detection Sensitivity</h2>'
-                page += '<label for="Attenuation">Least(99.99) / Most (0.01)</label><input pattern="[0-9]{1,2}\.[0-9]{1,2}" type="text" name="Attenuation"'
-                page += ' placeholder="' + "{:5.2f}".format(self.server.motionDetector.sensitivity) + '" maxlength="6" size="6">'
-                page += '</form>'
-                page += '<form action="/index.html" method="post" id="mode">'
-                page += '<label for="mode"></label><br>'
-                page += '<input type="hidden" name="mode" value="swap">'
-                page += '<input type="submit" value="Return to Normal">'
-                page += '</form>'
-                page += '</div>\n'
-                page += '</body>\n'
-                page += '</html>\n'
+                # the page shows the shutter setting rather than exposure_speed, which auto exposure changes every frame
+                inputs = (json.dumps(self.server.defaultsObject.getPackedZones()), camera.shutter_speed, camera.framerate,
+                          self.server.motionDetector.sensitivity)
+                page = self.server.pageCache.get('settings', inputs, self.renderSettingsPage)
             else:
-                files = glob.glob('*.mjpeg')
-                page = ""
-                page += '<!DOCTYPE html>\n'
-                page += '<html lang="en">\n'
-                page += '<head>\n'
-                page += '<meta charset="utf-8">\n'
-                page += '<meta http-equiv="Pragma" content="no-cache">\n'
-                page += '<link rel="stylesheet" href="style.css"/>\n'
-                page += '<title>SurCam</title>\n'
-                page += '</head>\n'
-                page += '<body>\n'
-                if self.server.fileName == 'default':
-                    page += '<h1>Video from surCam ' + self.server.defaultsObject.getCameraName() + '</h1>\n'
-                else:
-                    page += '<h2>' + self.server.fileName + '</h2>\n'
-                page += '<img class="base" src="stream.mjpg" width="640" height="480" style="position:absolute; top:60px; left:10px" />\n'
-                page += '<canvas class="overlay" id="imageArea" width="640" height="480" style="position:absolute; top:60px; left:10px"></canvas>\n'
-                page += '<script>'
-                page += 'function getMousePosition(canvas, event) {\n'
-                page += '  let rect = canvas.getBoundingClientRect();\n'
-                page += '  let x = event.clientX - rect.left;\n'
-                page += '  let y = event.clientY - rect.top;\n'
-                page += '  if (x < 0) {\n'
-                page += '    x = 0;\n'
-                page += '  } else if (x > (rect.width - 16)) {\n'
-                page += '    x = rect.width - 16;\n'
-                page += '  }\n'
-                page += '  if (y < 0) {\n'
-                page += '    y = 0;\n'
-                page += '  } else if (y > (rect.height - 16)) {\n'
-                page += '    y = rect.height - 16;\n'
-                page += '  }\n'
-                page += '  return { x: x, y: y };\n'
-                page += '}\n'
-                page += 'var canvas = document.getElementById("imageArea");\n'
-                page += 'console.log("canvas has been definded", canvas);\n'
-                page += 'canvas.addEventListener("mousedown", function(event) {\n'
-                page += '  let mousePosition = getMousePosition(canvas, event);\n'
-                page += '  let post = new XMLHttpRequest();\n'
-                page += '  post.open("POST", "/BoxPosition");\n'
-                page += "  post.setRequestHeader('Content-Type', 'application/x-www-form-urlencoded');\n"
-                page += '  let newX = Math.floor(mousePosition.x / 16);\n'
-                page += "  let info = 'cursor=' + newX;\n"
-                page += '  post.send(info);\n'
-                page += '  post.onreadystatechange = function() {\n'
-                page += '    if (post.readyState == 4) {\n'
-                page += '      if (post.status = 200) {\n'
-                page += '        console.log("Got:", post.responseText);\n'
-                page += '      }\n'
-                page += '    }\n'
-                page += '  };\n'
-                page += '}, false);\n'
-                page += 'setInterval(function() {\n'
-                page += '}, 500);\n'
-                page += 'console.log("Setup complete")\n'
-                page += "</script>\n"
-                page += '<div style="position:absolute; top:540px; left:20px">\n'
-                page += '<h2>Video Sources</h2>\n'
-                page += '<ul>\n'
-                page += '<form action="/index.html" method="post" id="deletes">'
-                for afile in sorted(files):
-                    page += '<li><a href=' + afile + '>' + afile + '</a><label for="' + afile + '"></label><input type="checkbox" name="' + afile + '"></li>'
-                page += '<li><a href=camera>camera</a></li>'
-                page += '</form>'
-                page += '</ul>'
-                page += '<button type="submit" form="deletes">Delete Checked Files</button>'
-                page += '<form action="/index.html" method="post" id="mode">'
-                page += '<label for="mode"></label><br>'
-                page += '<input type="hidden" name="mode" value="swap">'
-                page += '<input type="submit" value="Settings">'
-                page += '</form>'
-                page += '</div>\n'
-                page += '</body>\n'
-                page += '</html>\n'
-            content = page.encode('utf-8')
+                query = urlsplit(self.path).query
+                (recordings, nextKey) = self.server.catalog.page(**listingQuery(query))
+                inputs = (recordings, nextKey, self.server.fileName, self.server.defaultsObject.getCameraName(),
+                          self.server.retention.getUsage())
+                page = self.server.pageCache.get('index?' + query, inputs,
+                                                 lambda: self.renderIndexPage(recordings, query, nextKey))
             self.server.output.start(self.server.fileName)
-            self.send_response(200)
-            self.send_header('Content-Type', 'text/html')
-            self.send_header('Content-Length', len(content))
-            self.end_headers()
-            self.wfile.write(content)
+            page.send(self)
         elif self.path == '/style.css':
-            fileObject = open('./style.css', 'r')
-            content = ""
-            for line in fileObject:
-                content += line
-            content = content.encode('utf-8')
-            self.send_response(200)
-            self.send_header('Content-Type', 'text/css')
-            self.send_header('Content-Length', len(content))
-            self.end_headers()
-            self.wfile.write(content)
-        elif self.path == '/stream.mjpg':
+            self.server.styleSheet.send(self)
+        elif urlsplit(self.path).path == '/stream.mjpg':
             self.send_response(200)
             self.send_header('Age', 0)
             self.send_header('Cache-Control', 'no-cache, private')
             self.send_header('Pragma', 'no-cache')
             self.send_header('Content-Type', 'multipart/x-mixed-replace; boundary=FRAME')
             self.end_headers()
+            cursor = self.server.tierCursor(self.path)
             try:
                 done = False
                 while not done:
                     if not self.server.fileName is None:
-                        with self.server.output.condition:
-                            self.server.output.condition.wait()
-                            frame = self.server.output.frame
+                        (sequence, frame) = cursor.next(timeout=10.0)
+                        if sequence is None:
+                            print("No frame from the camera for 10 seconds - ending stream")
                         done = frame is None
                         if not done:
                             self.wfile.write(b'--FRAME\r\n')
@@ -391,16 +315,25 @@ class StreamingHandler(httpServer.BaseHTTPRequestHandler):
                 print("Streaming has terminated")
             except BrokenPipeError:
                 print('Removed streaming client')
+            finally:
+                cursor.close()
+            print("Frames dropped for", self.client_address, ":", cursor.dropped, ", all clients:", cursor.ring.dropped)
+        elif urlsplit(self.path).path == '/stream.ws':
+            websocket.serveWebSocket(self, self.server.frameSource(self.path))
+        elif urlsplit(self.path).path == '/snapshot.jpg':
+            self.sendSnapshot()
+        elif self.path.startswith('/download/'):
+            self.do_HEAD()
         elif 'mjpeg' in self.path:
             if self.server.fileName == 'default':
-                self.server.camera.stop_recording(splitter_port=2)
+                self.server.pauseTiers()
                 with self.server.output.condition:
                     self.server.output.frame = None
             else:
                 with self.server.output.condition:
                     self.server.output.setStop()
                     self.server.output.frame = None
-            self.server.fileName = self.path[1:]
+            self.server.showFile(self.path[1:])
             print("Set file name to:", self.server.fileName)
             self.send_response(302)
             self.send_header('Location', '/index.html')
@@ -410,9 +343,8 @@ class StreamingHandler(httpServer.BaseHTTPRequestHandler):
                 with self.server.output.condition:
                     self.server.output.setStop()
                     self.server.output.frame = None
-                self.server.fileName = 'default'
-                self.server.camera.start_recording(self.server.output, format='mjpeg',
-                                                   splitter_port=2, resize=(320, 240))
+                self.server.showFile('default')
+                self.server.resumeTiers()
                 print("Set file name to:", self.server.fileName)
             self.send_response(302)
             self.send_header('Location', '/index.html')
@@ -421,6 +353,408 @@ class StreamingHandler(httpServer.BaseHTTPRequestHandler):
             self.send_error(404)
             self.end_headers()
 
+    def renderSettingsPage(self):
+        '''
+        renderSettingsPage - the text of the settings mode page
+        '''
+        page = ""
+        page += '<!DOCTYPE html>\n'
+        page += '<html lang="en">\n'
+        page += '<head>\n'
+        page += '<meta charset="utf-8">\n'
+        page += '<meta http-equiv="Pragma" content="no-cache">\n'
+        page += '<link rel="stylesheet" href="style.css"/>\n'
+        page += '<title>Calibrate</title>\n'
+        page += '</head>\n'
+        page += '<body>\n'
+        page += '<h1>Settings Mode</h1>\n'
+        page += '<img class="base" src="stream.mjpg" width="640" height="480" style="position:absolute; top:60px; left:10px" />\n'
+        page += '<canvas class="overlay" id="imageArea" width="640" height="480" style="position:absolute; top:60px; left:10px"></canvas>\n'
+        page += '<script>'
+        page += 'var zones = ' + json.dumps(self.server.defaultsObject.getPackedZones()) + ';\n'
+        page += 'var zone = 0;\n'
+        page += 'function unpackMask(text) {\n'
+        page += '  let bytes = atob(text);\n'
+        page += '  let mask = [];\n'
+        page += '  for (let row = 0; row < 30; row++) {\n'
+        page += '    mask.push([]);\n'
+        page += '    for (let col = 0; col < 41; col++) {\n'
+        page += '      let bit = row * 41 + col;\n'
+        page += '      mask[row].push((bytes.charCodeAt(bit >> 3) >> (7 - (bit & 7))) & 1);\n'
+        page += '    }\n'
+        page += '  }\n'
+        page += '  return mask;\n'
+        page += '}\n'
+        page += 'function packMask(mask) {\n'
+        page += '  let bytes = new Array(Math.ceil(30 * 41 / 8)).fill(0);\n'
+        page += '  for (let row = 0; row < 30; row++) {\n'
+        page += '    for (let col = 0; col < 41; col++) {\n'
+        page += '      let bit = row * 41 + col;\n'
+        page += '      if (mask[row][col] == 1) {\n'
+        page += '        bytes[bit >> 3] |= 0x80 >> (bit & 7);\n'
+        page += '      }\n'
+        page += '    }\n'
+        page += '  }\n'
+        page += '  return btoa(String.fromCharCode.apply(null, bytes));\n'
+        page += '}\n'
+        page += 'var mask = unpackMask(zones.length > 0 ? zones[zone].mask : "' + packMask(np.zeros(maskShape)) + '");\n'
+        page += 'console.log("after definition, before drawGrid:", mask[29][21]);\n'
+        page += 'function drawGrid(canvas, mask) {\n'
+        page += "  let context = canvas.getContext('2d');\n"
+        page += '  context.clearRect(0, 0, canvas.width, canvas.height);\n'
+        page += '  context.beginPath();\n'
+        page += '  context.lineWidth = 1;\n'
+        page += '  context.globalAlpha = 0.7;\n'
+        page += "  context.strokeStyle = 'white';\n"
+        page += '  let maskIndexX = 0;\n'
+        page += '  let maskIndexY = 0;\n'
+        page += '  let totalRed = 0;\n'
+        page += '  let totalWhite = 0;\n'
+        page += '  for (var row = 0; row < 480; row += 16) {\n'
+        page += '    //console.log("Processing row", row, "with mask index of", maskIndexY, "current total reds", totalRed, "whites", totalWhite);\n'
+        page += '    //context.moveTo(0, row);\n'
+        page += '    for (var col = 0; col < 640; col += 16) {\n'
+        page += '      context.beginPath();\n'
+        page += '      context.moveTo(col, row);\n'
+        page += '      //console.log("Processing col", col, "with mask index of", maskIndexX);\n'
+        page += '      if (mask[maskIndexY][maskIndexX] == 1) {\n'
+        page += "        context.strokeStyle = 'red';\n"
+        page += '        //console.log("setting red");\n'
+        page += '        totalRed++;\n'
+        page += '      } else {'
+        page += "        context.strokeStyle = 'white';\n"
+        page += '        totalWhite++;\n'
+        page += '        //console.log("setting white");\n'
+        page += '      }'
+        page += '      context.lineTo(col+16, row);\n'
+        page += '      maskIndexX += 1;\n'
+        page += '      context.stroke();\n'
+        page += '    }'
+        page += '    maskIndexX = 0;\n'
+        page += '    maskIndexY += 1;\n'
+        page += '  }\n'
+        page += '  context.beginPath();\n'
+        page += "  context.strokeStyle = 'white';\n"
+        page += '  for (var col = 0; col < 640; col += 16) {\n'
+        page += '    context.moveTo(col, 0);\n'
+        page += '    context.lineTo(col, 479);\n'
+        page += '  }\n'
+        page += '  context.stroke();\n'
+        page += '  console.log("stroking row, total red regions:", totalRed);\n'
+        page += '}\n'
+        page += 'function getMousePosition(canvas, event) {\n'
+        page += '  let rect = canvas.getBoundingClientRect();\n'
+        page += '  let x = event.clientX - rect.left;\n'
+        page += '  let y = event.clientY - rect.top;\n'
+        page += '  if (x < 0) {\n'
+        page += '    x = 0;\n'
+        page += '  } else if (x > (rect.width - 16)) {\n'
+        page += '    x = rect.width - 16;\n'
+        page += '  }\n'
+        page += '  if (y < 0) {\n'
+        page += '    y = 0;\n'
+        page += '  } else if (y > (rect.height - 16)) {\n'
+        page += '    y = rect.height - 16;\n'
+        page += '  }\n'
+        page += '  return { x: x, y: y };\n'
+        page += '}\n'
+        page += 'console.log("sample mask value:", mask[29][20]);\n'
+        page += 'var canvas = document.getElementById("imageArea");\n'
+        page += 'console.log("canvas has been definded", canvas);\n'
+        page += 'var mousePosition = {x: 0, y:0};\n'
+        page += 'var cursorMousePosition = {x:0, y:0};\n'
+        page += 'var message = "";\n'
+        page += 'var drawing = false;\n'
+        page += 'var rawLastDigit = null;\n'
+        page += 'var changeMask = false;\n'
+        page += 'var lastMaskX = -1;\n'
+        page += 'var lastMaskY = -1;\n'
+        page += "canvas.addEventListener('mousemove', function(event) {\n"
+        page += '  cursorMousePosition = getMousePosition(canvas, event);\n'
+        page += '  let newX = Math.floor(cursorMousePosition.x / 16);\n'
+        page += '  let newY = Math.floor(cursorMousePosition.y /16);\n'
+        page += '  if (changeMask) {\n'
+        page += '    if (newX != lastMaskX || newY != lastMaskY) {\n'
+        page += '      console.log("new cell position");\n'
+        page += '      lastMaskX = newX;\n'
+        page += '      lastMaskY = newY;\n'
+        page += '      mask[newY][newX] = mask[newY][newX] ^ 1;\n'
+        page += '      drawGrid(canvas, mask);\n'
+        page += '    }\n'
+        page += '  }\n'
+        page += '}, false);\n'
+        page += 'canvas.addEventListener("mousedown", function(event) {\n'
+        page += '  mousePosition = getMousePosition(canvas, event);\n'
+        page += '  changeMask = ! changeMask;\n'
+        page += '  console.log("changing changeMask to", changeMask);\n'
+        page += '  if (!changeMask) {\n'
+        page += '    postZone("", false);\n'
+        page += '  }\n'
+        page += '}, false);\n'
+        page += 'function postZone(extra, reload) {\n'
+        page += '  let post = new XMLHttpRequest();\n'
+        page += '  post.open("POST", "/BoxPosition");\n'
+        page += "  post.setRequestHeader('Content-Type', 'application/x-www-form-urlencoded');\n"
+        page += "  let info = 'zone=' + encodeURIComponent(document.getElementById('ZoneName').value) +\n"
+        page += "             '&weight=' + encodeURIComponent(document.getElementById('ZoneWeight').value) +\n"
+        page += "             '&threshold=' + encodeURIComponent(document.getElementById('ZoneThreshold').value) +\n"
+        page += "             '&mask=' + encodeURIComponent(packMask(mask)) + extra;\n"
+        page += '  post.send(info);\n'
+        page += '  post.onreadystatechange = function() {\n'
+        page += '    if (post.readyState == 4) {\n'
+        page += '      console.log("Got:", post.status);\n'
+        page += '      if (reload) {\n'
+        page += '        location.reload();\n'
+        page += '      }\n'
+        page += '    }\n'
+        page += '  };\n'
+        page += '}\n'
+        page += 'function selectZone(number) {\n'
+        page += '  zone = number;\n'
+        page += '  mask = unpackMask(zones[zone].mask);\n'
+        page += "  document.getElementById('ZoneName').value = zones[zone].name;\n"
+        page += "  document.getElementById('ZoneWeight').value = zones[zone].weight;\n"
+        page += "  document.getElementById('ZoneThreshold').value = zones[zone].threshold === null ? '' : zones[zone].threshold;\n"
+        page += '  drawGrid(canvas, mask);\n'
+        page += '}\n'
+        page += 'var firstGrid = true;'
+        page += 'var intervalCount = 0;'
+        page += 'setInterval(function() {\n'
+        page += '  if (firstGrid) {\n'
+        page += '    if (intervalCount > 0) {\n'
+        page += '      console.log("drawing first grid");'
+        page += '      firstGrid = false;\n'
+        page += '      drawGrid(canvas, mask);\n'
+        page += '    } else {\n'
+        page += '      intervalCount++;\n'
+        page += '    }\n'
+        page += '  }\n'
+        page += '}, 500);\n'
+        page += 'console.log("Setup complete")\n'
+        page += "</script>\n"
+        page += '<div style="position:absolute; top:540px; left:20px">\n'
+        page += '<h2>Camera Settings</h2>'
+        page += '<ul>'
+        page += '<li>'
+        page += '<form action="/index.html" method="post">'
+        page += '<label for="camera1">Shutter Speed:</label><input pattern="[0-9]{1,7}" type="text" name="Shutter"'
+        shutterSpeed = self.server.camera.shutter_speed
+        page += ' placeholder="' + ("auto" if shutterSpeed == 0 else "{:7d}".format(shutterSpeed)) + '" maxlength="8" size="8"> microseconds</li>'
+        page += '</form>'
+        page += '<li>'
+        page += '<form action="/index.html" method="post">'
+        page += '<label for="camera2">Frame Rate:</label><input pattern="[0-9]{1,2}" type="text" name="FrameRate"'
+        page += ' placeholder="' + "{:2d}".format(int(float(self.server.camera.framerate.numerator)/float(self.server.camera.framerate.denominator))) + '" maxlength="3" size="3"> frames / second</li>'
+        page += '</form>'
+        page += '</ul>'
+        page += '<h2>Motion Zones</h2>'
+        page += '<p>Click the picture to start and stop marking the cells of the zone. Motion is detected when the zone scores add up to 1; '
+        page += 'a zone scores its weight once threshold of its cells changed, and a blank threshold follows the sensitivity.</p>'
+        page += '<label for="ZoneSelect">Zone:</label><select id="ZoneSelect" onchange="selectZone(this.selectedIndex)">'
+        for zone in self.server.motionDetector.zones.zones:
+            page += '<option>' + html.escape(zone.name) + '</option>'
+        page += '</select>'
+        page += ' <label for="ZoneName">Name:</label><input type="text" id="ZoneName" size="10">'
+        page += ' <label for="ZoneWeight">Weight:</label><input type="text" id="ZoneWeight" size="4">'
+        page += ' <label for="ZoneThreshold">Threshold (cells):</label><input type="text" id="ZoneThreshold" size="4">'
+        page += ' <button onclick="postZone(\'\', true)">Save Zone</button>'
+        page += ' <button onclick="postZone(\'&delete=on\', true)">Delete Zone</button>'
+        page += '<script>if (zones.length > 0) { selectZone(0); } else { document.getElementById("ZoneName").value = "default"; document.getElementById("ZoneWeight").value = 1; }</script>'
+        page += '<form action="/index.html" method="post">'
+        page += '<h2>Motion Detection Sensitivity</h2>'
+        page += '<label for="Attenuation">Least(99.99) / Most (0.01)</label><input pattern="[0-9]{1,2}\.[0-9]{1,2}" type="text" name="Attenuation"'
+        page += ' placeholder="' + "{:5.2f}".format(self.server.motionDetector.sensitivity) + '" maxlength="6" size="6">'
+        page += '</form>'
+        page += '<form action="/index.html" method="post" id="mode">'
+        page += '<label for="mode"></label><br>'
+        page += '<input type="hidden" name="mode" value="swap">'
+        page += '<input type="submit" value="Return to Normal">'
+        page += '</form>'
+        page += '</div>\n'
+        page += '</body>\n'
+        page += '</html>\n'
+        return page
+
+    def renderIndexPage(self, recordings, query, nextKey):
+        '''
+        renderIndexPage - the text of the live view page, with a page of the recording catalog
+        '''
+        page = ""
+        page += '<!DOCTYPE html>\n'
+        page += '<html lang="en">\n'
+        page += '<head>\n'
+        page += '<meta charset="utf-8">\n'
+        page += '<meta http-equiv="Pragma" content="no-cache">\n'
+        page += '<link rel="stylesheet" href="style.css"/>\n'
+        page += '<title>SurCam</title>\n'
+        page += '</head>\n'
+        page += '<body>\n'
+        if self.server.fileName == 'default':
+            page += '<h1>Video from surCam ' + self.server.defaultsObject.getCameraName() + '</h1>\n'
+        else:
+            page += '<h2>' + self.server.fileName + '</h2>\n'
+        page += '<img class="base" src="stream.mjpg" width="640" height="480" style="position:absolute; top:60px; left:10px" />\n'
+        page += '<canvas class="overlay" id="imageArea" width="640" height="480" style="position:absolute; top:60px; left:10px"></canvas>\n'
+        page += '<script>'
+        page += 'function getMousePosition(canvas, event) {\n'
+        page += '  let rect = canvas.getBoundingClientRect();\n'
+        page += '  let x = event.clientX - rect.left;\n'
+        page += '  let y = event.clientY - rect.top;\n'
+        page += '  if (x < 0) {\n'
+        page += '    x = 0;\n'
+        page += '  } else if (x > (rect.width - 16)) {\n'
+        page += '    x = rect.width - 16;\n'
+        page += '  }\n'
+        page += '  if (y < 0) {\n'
+        page += '    y = 0;\n'
+        page += '  } else if (y > (rect.height - 16)) {\n'
+        page += '    y = rect.height - 16;\n'
+        page += '  }\n'
+        page += '  return { x: x, y: y };\n'
+        page += '}\n'
+        page += 'var canvas = document.getElementById("imageArea");\n'
+        page += 'console.log("canvas has been definded", canvas);\n'
+        page += 'canvas.addEventListener("mousedown", function(event) {\n'
+        page += '  let mousePosition = getMousePosition(canvas, event);\n'
+        page += '  let post = new XMLHttpRequest();\n'
+        page += '  post.open("POST", "/BoxPosition");\n'
+        page += "  post.setRequestHeader('Content-Type', 'application/x-www-form-urlencoded');\n"
+        page += '  let newX = Math.floor(mousePosition.x / 16);\n'
+        page += "  let info = 'cursor=' + newX;\n"
+        page += '  post.send(info);\n'
+        page += '  post.onreadystatechange = function() {\n'
+        page += '    if (post.readyState == 4) {\n'
+        page += '      if (post.status = 200) {\n'
+        page += '        console.log("Got:", post.responseText);\n'
+        page += '      }\n'
+        page += '    }\n'
+        page += '  };\n'
+        page += '}, false);\n'
+        page += 'setInterval(function() {\n'
+        page += '}, 500);\n'
+        page += 'console.log("Setup complete")\n'
+        page += "</script>\n"
+        page += '<div style="position:absolute; top:540px; left:20px">\n'
+        page += '<h2>Video Sources</h2>\n'
+        page += '<ul>\n'
+        (count, totalBytes, freeBytes) = self.server.retention.getUsage()
+        page += '<p>{} recordings, {:.1f} MB, {:.1f} MB free; keeping {}</p>\n'.format(
+            count, totalBytes / 1e6, freeBytes / 1e6, self.server.retention.describeLimits())
+        page += filterForm('/index.html', query)
+        page += '<form action="/index.html" method="post" id="deletes">'
+        for recording in recordings:
+            afile = recording.fileName
+            if http_files.isMotionJPEG(afile):
+                page += '<li><a href=' + afile + '>' + afile + '</a> <a href=/download/' + afile + '>download</a>'
+            else:
+                page += '<li>' + afile + ' <a href=/download/' + afile + '>download</a>'
+            page += ' {} frames, {:.1f} s, {:.1f} MB'.format(recording.frames, recording.duration, recording.size / 1e6)
+            if recording.peakActiveCells is not None:
+                page += ', peak ' + str(recording.peakActiveCells) + ' active cells'
+            page += '<label for="' + afile + '"></label><input type="checkbox" name="' + afile + '"></li>'
+        page += '<li><a href=camera>camera</a></li>'
+        page += '</form>'
+        page += '</ul>'
+        page += olderLink('/index.html', query, nextKey)
+        page += '<button type="submit" form="deletes">Delete Checked Files</button>'
+        page += '<form action="/index.html" method="post" id="mode">'
+        page += '<label for="mode"></label><br>'
+        page += '<input type="hidden" name="mode" value="swap">'
+        page += '<input type="submit" value="Settings">'
+        page += '</form>'
+        page += '</div>\n'
+        page += '</body>\n'
+        page += '</html>\n'
+        return page
+
+    def sendSnapshot(self):
+        '''
+        sendSnapshot - answer /snapshot.jpg with the newest frame, tagged with its sequence number.
+        With ?after=<sequence number> the request waits until a newer frame exists, ?quality= picks
+        the tier.
+        '''
+        query = parse_qs(urlsplit(self.path).query)
+        try:
+            after = int(query['after'][0].strip('"')) if 'after' in query else None
+        except ValueError:
+            self.send_error(400, "after must be a frame sequence number")
+            return
+        cursor = self.server.tierCursor(self.path)
+        ring = cursor.ring
+        try:
+            if after is None:
+                (sequence, frame) = ring.latest()
+            else:
+                (sequence, frame) = ring.newer(after, self.server.longPollTimeout)
+            if sequence is not None and frame is None:
+                # the tier was idle, wait for the first frame of its encoder
+                (sequence, frame) = ring.newer(sequence, self.server.longPollTimeout)
+        finally:
+            cursor.close()
+        if sequence is None and after is not None:
+            sequence = after
+        etag = '"{}"'.format(sequence)
+        if sequence == after or etag in [tag.strip() for tag in self.headers.get('If-None-Match', '').split(',')]:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+        if frame is None:
+            self.send_response(503)
+            self.send_header('Retry-After', 1)
+            self.send_header('Content-Length', 0)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'image/jpeg')
+        self.send_header('Content-Length', len(frame))
+        self.send_header('Cache-Control', 'no-cache, private')
+        self.send_header('ETag', etag)
+        self.end_headers()
+        try:
+            self.wfile.write(frame)
+        except BrokenPipeError:
+            print('Removed snapshot client')
+
+    def updateZone(self, fields):
+        '''
+        updateZone - save or delete the motion zone named in the fields of a settings mode POST
+        and hand the zones to the motion detector
+        '''
+        name = fields.get('zone', ['default'])[0]
+        if 'delete' in fields:
+            print("Deleting motion zone", name)
+            self.server.defaultsObject.deleteZone(name)
+        else:
+            try:
+                packed = fields['mask'][0]
+                if ',' in packed:
+                    # the comma separated integers of a page from before there were zones
+                    mask = np.asarray([int(asciiValue) for asciiValue in packed.split(',')]).reshape(30, 41)
+                else:
+                    mask = unpackMask(packed)
+                weight = float(fields.get('weight', ['1'])[0])
+                threshold = float(fields['threshold'][0]) if fields.get('threshold', [''])[0] else None
+            except (KeyError, ValueError, binascii.Error) as error:
+                print("Invalid motion zone:", error)
+                return
+            print("Setting motion zone", name, "weight", weight, "threshold", threshold, "cells", int(mask.sum()))
+            self.server.defaultsObject.setZone(MotionZone(name, mask, weight, threshold))
+        self.server.motionDetector.setZones(self.server.defaultsObject.getZones())
+
+    def do_HEAD(self):
+        '''
+        do_HEAD - handles HEAD requests, and GET requests, for downloads of recordings
+        '''
+        fileName = None
+        if self.path.startswith('/download/'):
+            fileName = http_files.recordingName(self.path, '/download/')
+        if fileName is None:
+            self.send_error(404)
+            return
+        print("Download of", fileName, "requested by", self.client_address)
+        http_files.sendFile(self, fileName)
+
     def do_POST(self):
         '''
         do_POST - handles POST requests from an HTTP client
@@ -466,9 +800,10 @@ class StreamingHandler(httpServer.BaseHTTPRequestHandler):
                     else:
                         print("Request to delete file:", conditionedFileName)
                         try:
-                            os.remove(conditionedFileName)
-                        except FileNotFound:
+                            self.server.catalog.delete(conditionedFileName)
+                        except FileNotFoundError:
                             print("Error on attempt to delete", conditionedFileName)
+                        self.server.retention.measure()
             self.send_response(302)
             self.send_header('location', 'index.html')
             self.end_headers()
@@ -478,11 +813,9 @@ class StreamingHandler(httpServer.BaseHTTPRequestHandler):
                 line = self.rfile.read(length)
                 line = line.decode('utf-8')
                 print('got a post with:', line)
-                values = line.split("=")[1].split(",")
-                newMask = np.asarray([int(asciiValue) for asciiValue in values]).reshape(30, 41)
-                print('newMask:', newMask, type(newMask), newMask.shape)
-                self.server.defaultsObject.setMask(newMask)
-                self.server.motionDetector.mask = newMask
+                self.updateZone(parse_qs(line))
+                self.send_response(204)
+                self.end_headers()
             else:
                 length = int(self.headers['Content-Length'])
                 line = self.rfile.read(length)
@@ -509,52 +842,108 @@ class MotionDetector(PiMotionAnalysis):
     '''
     MotionDector - class derived from PiMotionAnalysis that implements a motion detection algorithm
     '''
+    bufferSeconds = 15.0  # seconds of video held by the circular buffer
 
-    def __init__(self, camera, stream, defaultsObject):
+    def __init__(self, camera, stream, tee, defaultsObject, catalog, eventFormat='mjpeg'):
         '''
-        Constructor
+        Constructor - stream is the circular buffer the recording port writes to through tee,
+        eventFormat the format of its encoder, mjpeg or h264
         '''
         super(MotionDetector, self).__init__(camera)
         self.stream = stream
+        self.tee = tee
+        self.catalog = catalog
+        self.eventFormat = eventFormat
+        self.peakActiveCells = 0
         self.lastSampleTime = time.time() - 15.0
         self.consecutiveCount = 0
-        self.writeThreadActive = False
+        self.recorder = None  # the EventRecorder of the event in progress
+        self.lastEventEnd = None
         self.defaultsObject = defaultsObject
         self.sensitivity = self.defaultsObject.getSensitivity()
-        self.mask = self.defaultsObject.mask
+        self.zones = ZoneSet(self.defaultsObject.getZones())
+
+    def startEvent(self, triggerTime):
+        '''
+        startEvent - start recording a motion event.  The pre-trigger frames go back to the end of the
+        previous event at most, so back to back events do not share frames.
+        '''
+        fileName = time.strftime("Motion_Detected%Y-%m-%d:%H:%M:%S.", time.gmtime(triggerTime)) + self.eventFormat
+        preTriggerSeconds = None
+        if self.lastEventEnd is not None and triggerTime - self.lastEventEnd < self.bufferSeconds:
+            preTriggerSeconds = max(triggerTime - self.lastEventEnd, 0.0)
+        # an H.264 event has to start at a key frame, announced by its SPS header
+        firstFrame = picamera.PiVideoFrameType.sps_header if self.eventFormat == 'h264' else None
+        self.recorder = EventRecorder(fileName, self.tee, self.stream, self.preTriggerFrames, triggerTime,
+                                      self.defaultsObject.getMaxEventSeconds(), preTriggerSeconds, self.finishEvent,
+                                      self.eventFormat, firstFrame)
+        self.recorder.start()
 
-    def writeFile(self):
+    def finishEvent(self, recorder):
         '''
-        writeFile - writes a sample of the camera stream to a file
+        finishEvent - called by the recorder of an event when its recording is complete or has failed.
+        What was written of a failed recording is catalogued too, so that retention can delete it.
         '''
-        fileName = time.strftime("Motion_Detected%Y-%m-%d:%H:%M:%S.mjpeg", time.gmtime())
-        print("Writing file:", fileName)
-        time.sleep(15)
-        self.stream.copy_to(fileName, first_frame=None)
-        print("Done")
-        self.writeThreadActive = False
+        try:
+            self.catalog.record(recorder.fileName, recorder.triggerTime, int(self.peakActiveCells))
+        except OSError as error:
+            print("Could not catalog", recorder.fileName, error)
+        finally:
+            self.lastEventEnd = time.time()
+            self.recorder = None
+
+    def preTriggerFrames(self, seconds=None, firstFrame=None):
+        '''
+        preTriggerFrames - (position, times) of the frames held by the circular buffer that
+        copy_to(seconds=seconds, first_frame=firstFrame) copies: of the last seconds only if given,
+        from a frame of type firstFrame if given.  position is where copy_to starts, None when it
+        copies nothing, and times are the wall-clock capture times.  Headers have no capture time.
+        '''
+        now = time.time()
+        cameraNow = self.camera.timestamp
+        frames = list(self.stream.frames)
+        start = len(frames)
+        last = None
+        for number in range(len(frames) - 1, -1, -1):  # walked back the way the circular buffer looks for the first frame
+            frame = frames[number]
+            if firstFrame in (None, frame.frame_type):
+                start = number
+            if seconds is not None and frame.timestamp is not None:
+                if last is None:
+                    last = frame.timestamp
+                elif last - frame.timestamp >= seconds * 1000000.0:
+                    break
+        position = frames[start].position if start < len(frames) else None
+        return (position, [now - (cameraNow - frame.timestamp) / 1000000.0 for frame in frames[start:] if frame.timestamp is not None])
 
     def analyze(self, array):
         '''
         analyze a set of frames and determine if something is moving in the frame
         '''
-        if not self.writeThreadActive:
-            shape = array['sad'].shape
-            size = shape[0] * (shape[1] - 1)
-            threshold = size / 100 * self.sensitivity # 1% of scene changed by more than 254 counts
-            # Count the cells where the sum of the absolute difference is greater than 255
-            activeCells = ((array['sad'] * self.mask) > 255).sum()
-            if time.time() - self.lastSampleTime > 15:
-                if activeCells > threshold:
-                    self.consecutiveCount += 1
-                    if self.consecutiveCount > 2:
-                        self.lastSampleTime = time.time()
-                        self.writeThreadActive = True
-                        threading.Thread(target=self.writeFile).start()
-                        self.consecutiveCount = 0
-                        print("current threshold:", threshold, " activeCells:", activeCells, " sensitivity:", self.sensitivity)
-                else:
-                    self.consecutiveCount = 0
+        shape = array['sad'].shape
+        size = shape[0] * (shape[1] - 1)
+        threshold = size / 100 * self.sensitivity # 1% of scene changed by more than 254 counts
+        # Count the cells of each zone where the sum of the absolute difference is greater than 255
+        zones = self.zones
+        (score, activeCells) = zones.score(array['sad'], threshold)
+        moving = zones.triggered(score)
+        recorder = self.recorder
+        if recorder is not None:
+            # the peak motion of the recording being written is kept in the catalog
+            self.peakActiveCells = max(self.peakActiveCells, activeCells)
+            if moving:
+                recorder.extend()
+        elif moving:
+            self.consecutiveCount += 1
+            if self.consecutiveCount > 2:
+                self.lastSampleTime = time.time()
+                self.peakActiveCells = activeCells
+                self.startEvent(self.lastSampleTime)
+                self.consecutiveCount = 0
+                print("current threshold:", threshold, " activeCells:", activeCells, " sensitivity:", self.sensitivity)
+                print("zones:", zones.describe())
+        else:
+            self.consecutiveCount = 0
 
     def analyse(self, array):
         '''
@@ -568,6 +957,12 @@ class MotionDetector(PiMotionAnalysis):
         '''
         self.sensitivity = value
 
+    def setZones(self, value):
+        '''
+        setter for zones, a list of MotionZone, the cells analyze looks at are worked out here rather than per frame
+        '''
+        self.zones = ZoneSet(value)
+
 class Background():
     '''
     A background thread that does camera data collection
@@ -617,25 +1012,31 @@ class HandleDefaults():
         '''
         Constructor - get initial defaults if they exist, otherwise set them
         '''
-        self.mask = np.ones((30, 41), dtype = int)
+        mask = np.ones((30, 41), dtype = int)
         for row in range(30):
             for col in range(41):
                 if row < 25:
-                    self.mask[row][col] = 0
+                    mask[row][col] = 0
                 else:
                     if col > 39:
-                        self.mask[row][col] = 0
+                        mask[row][col] = 0
         self.defaults = {}
         try:
             fileHandle = open("./surCamDefaults.json", "r")
             self.defaults = json.load(fileHandle)
-            self.mask = np.asarray(self.defaults['mask']).reshape(30, 41)
             fileHandle.close()
+            if 'mask' in self.defaults:
+                # a single on/off mask of integers, saved before there were zones
+                print("Converting the motion mask to a zone")
+                legacyMask = np.asarray(self.defaults.pop('mask')).reshape(30, 41)
+                self.defaults['zones'] = [MotionZone('default', legacyMask).toDefaults()]
+                self.write()
         except FileNotFoundError:
             print("Defaults file was not found - setting")
             
             self.defaults = { 'cameraName' : 'Alpha', 'framerate' : 15, 'vflip' : True, 'hflip' : True,
-                              'iso' : 800, 'shutter_speed' : 0, 'sensitivity' : 99.99, 'mask' : self.mask.tolist() }
+                              'iso' : 800, 'shutter_speed' : 0, 'sensitivity' : 99.99,
+                              'zones' : [MotionZone('default', mask).toDefaults()] }
             self.write()
 
     def getCameraName(self):
@@ -674,6 +1075,36 @@ class HandleDefaults():
         '''
         return self.defaults['shutter_speed']
     
+    def getMaxEventSeconds(self):
+        '''
+        getter - maxEventSeconds, the longest a motion event is recorded
+        '''
+        return self.defaults.get('maxEventSeconds', 120.0)
+
+    def getEventFormat(self):
+        '''
+        getter - eventFormat, mjpeg or h264, the format motion events are recorded in
+        '''
+        return self.defaults.get('eventFormat', 'mjpeg')
+
+    def getMaxAgeDays(self):
+        '''
+        getter - maxAgeDays, recordings older than this are deleted, None to keep them
+        '''
+        return self.defaults.get('maxAgeDays')
+
+    def getMaxRecordingMB(self):
+        '''
+        getter - maxRecordingMB, the oldest recordings are deleted beyond this total, None for no limit
+        '''
+        return self.defaults.get('maxRecordingMB')
+
+    def getMinFreeMB(self):
+        '''
+        getter - minFreeMB, the oldest recordings are deleted while less disk space is free, None for no limit
+        '''
+        return self.defaults.get('minFreeMB', 500)
+
     def getSensitivity(self):
         '''
         getter - sensitivity
@@ -729,12 +1160,35 @@ class HandleDefaults():
         self.defaults['sensitivity'] = value
         self.write()
 
-    def setMask(self, value):
+    def getPackedZones(self):
+        '''
+        getter - zones, as saved with their masks packed
+        '''
+        return self.defaults.get('zones', [])
+
+    def getZones(self):
+        '''
+        getter - zones, as a list of MotionZone
+        '''
+        return [MotionZone.fromDefaults(entry) for entry in self.defaults.get('zones', [])]
+
+    def setZone(self, zone):
+        '''
+        setter - zone, replacing the zone of the same name or adding it
+        '''
+        zones = self.defaults.setdefault('zones', [])
+        names = [entry['name'] for entry in zones]
+        if zone.name in names:
+            zones[names.index(zone.name)] = zone.toDefaults()
+        else:
+            zones.append(zone.toDefaults())
+        self.write()
+
+    def deleteZone(self, name):
         '''
-        setter - mask
+        deleteZone - remove the zone called name
         '''
-        self.defaults['mask'] = value.tolist()
-        self.mask = value
+        self.defaults['zones'] = [entry for entry in self.defaults.get('zones', []) if entry['name'] != name]
         self.write()
 
     def write(self):
@@ -745,16 +1199,57 @@ class HandleDefaults():
         jsonString = json.dump(self.defaults, fileHandle)
         fileHandle.close()
             
-class StreamingCameraServer(socketserver.ThreadingMixIn, httpServer.HTTPServer):
+class LiveViewServer():
+    '''
+    LiveViewServer class - the live view routes a server answers from its quality tiers.  A
+    subclass provides tierCursor(path).
+    '''
+    longPollTimeout = 30.0  # seconds a /snapshot.jpg?after= request waits for a newer frame
+    defaultQuality = 'sd'
+    sharedRingBytes = {'thumb': 128 * 1024, 'sd': 512 * 1024, 'vga': 1024 * 1024}  # slot size per tier in serving process mode
+
+    def frameSource(self, path):
+        '''
+        frameSource - the frames a stream request path refers to, for the asyncio server, None if the
+        path is not a stream
+        '''
+        if urlsplit(path).path not in ('/stream.mjpg', '/stream.ws'):
+            return None
+        return self.tierCursor(path)
+
+    def longPoll(self, path):
+        '''
+        longPoll - (cursor, sequence number) a snapshot request path waits on, for the asyncio
+        server, None if the request does not wait.  The caller closes the cursor.
+        '''
+        (route, _, query) = path.partition('?')
+        if route != '/snapshot.jpg':
+            return None
+        try:
+            after = int(parse_qs(query)['after'][0].strip('"'))
+        except (KeyError, ValueError):
+            return None
+        return (self.tierCursor(path), after)
+
+class StreamingCameraServer(LiveViewServer, socketserver.ThreadingMixIn, httpServer.HTTPServer):
     '''
     A Streaming Camera HTTP server class that iterfaces the camera to a HTTP server
     '''
     allow_reuse_address = True
     daemon_threads = True
-    def __init__(self, address, _class):
-        super(StreamingCameraServer, self).__init__(address, _class)
+    eventBitrate = 1000000  # bits per second of H.264 events, which also sizes their circular buffer
+    keyFrameSeconds = 1  # an H.264 event's pre-trigger video starts at a key frame at most this much early
+
+    def __init__(self, address, _class, eventFormat=None, bind_and_activate=True):
+        '''
+        Constructor - eventFormat, mjpeg or h264, overrides the format of the defaults file
+        '''
+        super(StreamingCameraServer, self).__init__(address, _class, bind_and_activate)
         self.fileName = 'default'
+        self.sharedRings = {}  # the rings of the serving processes, by tier
         self.output = StreamingOutput()
+        self.pageCache = http_files.PageCache()
+        self.styleSheet = http_files.StaticAsset('style.css', 'text/css')
         self.defaultsObject = HandleDefaults()
         self.framerate = self.defaultsObject.getFramerate()
         self.camera = picamera.PiCamera(resolution='VGA', framerate=self.framerate)
@@ -764,53 +1259,256 @@ class StreamingCameraServer(socketserver.ThreadingMixIn, httpServer.HTTPServer):
         self.camera.shutter_speed = self.defaultsObject.getShutter_speed()
         self.camera.sensor_mode = 1
         self.camera.exposure_mode = 'fixedfps'
-        self.circularBuffer = picamera.PiCameraCircularIO(self.camera, seconds=15)
-        self.motionDetector = MotionDetector(self.camera, self.circularBuffer, self.defaultsObject)
-        self.camera.start_recording(self.circularBuffer, format='mjpeg', splitter_port=1)
-        self.camera.start_recording(self.output, format='mjpeg', splitter_port=2, resize=(320, 240))
-        self.camera.start_recording('/dev/null', format='h264', splitter_port=3,
-                                    motion_output=self.motionDetector)
+        self.eventFormat = eventFormat or self.defaultsObject.getEventFormat()
+        self.catalog = RecordingCatalog()
+        self.catalog.sync()
+        maxRecordingMB = self.defaultsObject.getMaxRecordingMB()
+        minFreeMB = self.defaultsObject.getMinFreeMB()
+        self.retention = RetentionManager(self.catalog, self.defaultsObject.getMaxAgeDays(),
+                                          None if maxRecordingMB is None else maxRecordingMB * 1000000,
+                                          None if minFreeMB is None else minFreeMB * 1000000)
+        if self.eventFormat == 'h264':
+            # the motion port's H.264 is buffered and recorded, port 1 is left to the vga tier
+            self.circularBuffer = picamera.PiCameraCircularIO(self.camera, seconds=MotionDetector.bufferSeconds,
+                                                              bitrate=self.eventBitrate, splitter_port=3)
+            self.recordingTee = None
+            self.eventTee = TeeOutput(self.circularBuffer)
+            vga = QualityTier('vga', self.camera, StreamingOutput(), splitterPort=1)
+        else:
+            # ports 1 and 3 record and detect motion; vga shares the recording's MJPEG through the tee
+            self.circularBuffer = picamera.PiCameraCircularIO(self.camera, seconds=MotionDetector.bufferSeconds)
+            self.recordingTee = TeeOutput(self.circularBuffer)
+            self.eventTee = self.recordingTee
+            vga = QualityTier('vga', self.camera, StreamingOutput(), tee=self.recordingTee)
+        self.motionDetector = MotionDetector(self.camera, self.circularBuffer, self.eventTee, self.defaultsObject, self.catalog,
+                                             self.eventFormat)
+        self.tiers = {'thumb': QualityTier('thumb', self.camera, StreamingOutput(), splitterPort=0, resize=(160, 120)),
+                      'sd': QualityTier('sd', self.camera, self.output, splitterPort=2, resize=(320, 240)),
+                      'vga': vga}
+        self.startRecording()
         self.background = Background(self.camera)
         self.settingsMode = False
         self.servo = HW.HW()
         self.postCount = 0
         self.lastServoCommandTime = time.time()
 
-    def restartCamera(self):
-        self.camera.stop_recording(splitter_port=1)
-        if self.fileName == 'default':
-            self.camera.stop_recording(splitter_port=2)
+    def tierCursor(self, path):
+        '''
+        tierCursor - subscribe to the quality tier named by the ?quality= parameter of a request path,
+        sd by default.  A recording is shown through the sd tier whatever the quality.
+        '''
+        quality = parse_qs(urlsplit(path).query).get('quality', [self.defaultQuality])[0]
+        if self.fileName != 'default' or quality not in self.tiers:
+            quality = self.defaultQuality
+        return self.tiers[quality].subscribe()
+
+    def showFile(self, fileName):
+        '''
+        showFile - show a recording, or the camera for 'default', and let the serving processes know
+        '''
+        self.fileName = fileName
+        for ring in self.sharedRings.values():
+            ring.setLive(fileName == 'default')
+
+    def pauseTiers(self):
+        '''
+        pauseTiers - stop the live view encoders
+        '''
+        for tier in self.tiers.values():
+            tier.pause()
+
+    def resumeTiers(self):
+        '''
+        resumeTiers - restart the live view encoders that have subscribers
+        '''
+        for tier in self.tiers.values():
+            tier.resume()
+
+    def startRecording(self):
+        '''
+        startRecording - start the encoders that feed the circular buffer and motion detection
+        '''
+        if self.recordingTee is not None:
+            self.camera.start_recording(self.recordingTee, format='mjpeg', splitter_port=1)
+        if self.eventFormat == 'h264':
+            self.camera.start_recording(self.eventTee, format='h264', splitter_port=3, motion_output=self.motionDetector,
+                                        bitrate=self.eventBitrate, intra_period=self.framerate * self.keyFrameSeconds)
+        else:
+            self.camera.start_recording('/dev/null', format='h264', splitter_port=3,
+                                        motion_output=self.motionDetector)
+
+    def stopRecording(self):
+        '''
+        stopRecording - stop the encoders started by startRecording
+        '''
+        if self.recordingTee is not None:
+            self.camera.stop_recording(splitter_port=1)
         self.camera.stop_recording(splitter_port=3)
+
+    def restartCamera(self):
+        self.pauseTiers()
+        self.stopRecording()
         time.sleep(1.0)
         self.camera.framerate = self.framerate
-        self.camera.start_recording(self.circularBuffer, format='mjpeg', splitter_port=1)
+        self.startRecording()
         if self.fileName == 'default':
-            self.camera.start_recording(self.output, format='mjpeg', splitter_port=2, resize=(320, 240))
-        self.camera.start_recording('/dev/null', format='h264', splitter_port=3,
-                                    motion_output=self.motionDetector)
+            self.resumeTiers()
 
     def stopCamera(self):
-        self.camera.stop_recording(splitter_port=1)
-        if self.fileName == 'default':
-            self.camera.stop_recording(splitter_port=2)
-        self.camera.stop_recording(splitter_port=3)
+        self.pauseTiers()
+        self.stopRecording()
+
+class ServingHandler(StreamingHandler):
+    '''
+    ServingHandler - the handler of a serving process.  Live view requests are answered from the
+    shared frame rings and downloads from the recordings directory; everything else is forwarded to
+    the capture process, so clients can't tell the processes apart.
+    '''
+    liveRoutes = ('/stream.mjpg', '/stream.ws', '/snapshot.jpg', '/style.css')
+
+    def do_GET(self):
+        '''
+        do_GET - answer live view and download requests, forward the rest
+        '''
+        if urlsplit(self.path).path in self.liveRoutes or self.path.startswith('/download/'):
+            super(ServingHandler, self).do_GET()
+        else:
+            self.forward()
+
+    def do_HEAD(self):
+        '''
+        do_HEAD - answer downloads, forward the rest
+        '''
+        if self.path.startswith('/download/'):
+            super(ServingHandler, self).do_HEAD()
+        else:
+            self.forward()
+
+    def do_POST(self):
+        '''
+        do_POST - forward to the capture process
+        '''
+        self.forward()
+
+    def forward(self):
+        '''
+        forward - pass the request to the capture process and copy its response back
+        '''
+        body = None
+        if self.headers.get('Content-Length'):
+            body = self.rfile.read(int(self.headers['Content-Length']))
+        headers = {keyword: value for (keyword, value) in self.headers.items()
+                   if keyword.lower() not in ('connection', 'keep-alive')}
+        connection = http.client.HTTPConnection(*self.server.captureAddress, timeout=60)
+        try:
+            connection.request(self.command, self.path, body=body, headers=headers)
+            response = connection.getresponse()
+            self.send_response(response.status, response.reason)
+            for (keyword, value) in response.getheaders():
+                if keyword.lower() not in ('connection', 'date', 'server', 'transfer-encoding'):
+                    self.send_header(keyword, value)
+            self.end_headers()
+            if self.command != 'HEAD':
+                shutil.copyfileobj(response, self.wfile)
+        except (ConnectionRefusedError, http.client.HTTPException, socket.timeout):
+            self.send_error(502, "Capture process is not answering")
+        finally:
+            connection.close()
+
+class ServingServer(LiveViewServer, socketserver.ThreadingMixIn, httpServer.HTTPServer):
+    '''
+    ServingServer class - an HTTP server of a serving process.  Several of them share the public port
+    with SO_REUSEPORT and read the camera's quality tiers from shared frame rings.
+    '''
+    allow_reuse_address = True
+    daemon_threads = True
+    fileName = 'default'
+    def __init__(self, address, _class, captureAddress, rings, reader, bind_and_activate=True):
+        self.captureAddress = captureAddress
+        self.styleSheet = http_files.StaticAsset('style.css', 'text/css')
+        self.importers = {name: RingImporter(ring, reader) for (name, ring) in rings.items()}
+        super(ServingServer, self).__init__(address, _class, bind_and_activate)
+
+    def server_bind(self):
+        '''
+        server_bind - let the serving processes listen on the same port
+        '''
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        super(ServingServer, self).server_bind()
+
+    def tierCursor(self, path):
+        '''
+        tierCursor - subscribe to the shared ring of the quality tier named by the ?quality=
+        parameter of a request path, sd by default.  A recording is shown through the sd tier
+        whatever the quality, as in the capture process.
+        '''
+        quality = parse_qs(urlsplit(path).query).get('quality', [self.defaultQuality])[0]
+        if quality not in self.importers or not self.importers[quality].shared.live():
+            quality = self.defaultQuality
+        return self.importers[quality].subscribe()
+
+def serveProcess(address, captureAddress, rings, reader, useAsyncio):
+    '''
+    serveProcess - main program of a serving process
+    '''
+    server = ServingServer(address, ServingHandler, captureAddress, rings, reader, bind_and_activate=not useAsyncio)
+    print("Serving process", reader, "started")
+    try:
+        if useAsyncio:
+            AsyncStreamingServer(server, address, ServingHandler, reusePort=True).serveForever()
+        else:
+            server.serve_forever()
+    except KeyboardInterrupt:
+        pass
 
 def main():
     '''
     Main program for MJPEG streamer
     '''
+    parser = argparse.ArgumentParser(description="Surveillance camera server")
+    parser.add_argument("--asyncio", action="store_true", help="serve all clients from one asyncio event loop")
+    parser.add_argument("--serve-processes", type=int, default=0, metavar="N",
+                        help="serve HTTP clients from N processes of their own, the camera and motion detection keep this one")
+    parser.add_argument("--capture-port", type=int, default=8001,
+                        help="local port the serving processes forward requests to, with --serve-processes")
+    parser.add_argument("--event-format", choices=('mjpeg', 'h264'),
+                        help="record motion events as MJPEG or as H.264 from the motion detection encoder, "
+                             "which needs far less memory and storage; the defaults file decides otherwise")
+    arguments = parser.parse_args()
     address = ('', 8000)        # use port 8000
-    server = StreamingCameraServer(address, StreamingHandler)  # Make a Streaming Camera HTTP server
+    rings = {}
+    if arguments.serve_processes > 0:
+        # the serving processes are forked before the camera and its threads exist
+        rings = {name: SharedFrameRing('surveillance_' + name, slotSize=size, readers=arguments.serve_processes, create=True)
+                 for (name, size) in LiveViewServer.sharedRingBytes.items()}
+        captureAddress = ('127.0.0.1', arguments.capture_port)
+        context = multiprocessing.get_context('fork')
+        for reader in range(arguments.serve_processes):
+            context.Process(target=serveProcess, daemon=True,
+                            args=(address, captureAddress, rings, reader, arguments.asyncio)).start()
+        address = captureAddress
+    useAsyncio = arguments.asyncio and not rings
+    server = StreamingCameraServer(address, StreamingHandler, arguments.event_format, bind_and_activate=not useAsyncio)  # Make a Streaming Camera HTTP server
+    server.sharedRings = rings
+    for (name, ring) in rings.items():
+        RingExporter(ring, server.tiers[name].subscribe).start()
     backgroundThread = threading.Thread(target=server.background.collector)
     backgroundThread.start()
     print("Background collection started")
+    server.retention.start()
     try:
-        server.serve_forever()      # start the server
+        if useAsyncio:
+            AsyncStreamingServer(server, address, StreamingHandler).serveForever()
+        else:
+            server.serve_forever()      # start the server
     except KeyboardInterrupt:
         print("Gracefully exiting via user request")
     finally:
         server.stopCamera()
+        for ring in rings.values():
+            ring.unlink()
     server.background.terminateBackground()
+    server.retention.terminateRetention()
     backgroundThread.join()
 if __name__ == '__main__':
     main()
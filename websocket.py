@@ -0,0 +1,193 @@
+'''
+WebSocket module - pushes JPEG frames to clients as binary WebSocket messages (RFC 6455)
+
+A client controls its stream with JSON text messages:
+    {"fps": 2}          send at most 2 frames a second, 0 sends every frame
+    {"paused": true}    stop sending frames until {"paused": false}
+'''
+import base64
+import hashlib
+import json
+import select
+import struct
+import time
+
+guid = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+opContinuation = 0x0
+opText = 0x1
+opBinary = 0x2
+opClose = 0x8
+opPing = 0x9
+opPong = 0xa
+maxControlMessage = 65536
+
+def acceptKey(headers):
+    '''
+    acceptKey - the Sec-WebSocket-Accept value for an upgrade request, None if it is not a WebSocket upgrade
+    '''
+    key = headers.get('Sec-WebSocket-Key')
+    if headers.get('Upgrade', '').lower() != 'websocket' or not key:
+        return None
+    return base64.b64encode(hashlib.sha1((key.strip() + guid).encode('ascii')).digest()).decode('ascii')
+
+def frameHeader(length, opcode=opBinary):
+    '''
+    frameHeader - header of an unfragmented, unmasked server message, the payload is written after it
+    '''
+    if length < 126:
+        return struct.pack('!BB', 0x80 | opcode, length)
+    if length < 65536:
+        return struct.pack('!BBH', 0x80 | opcode, 126, length)
+    return struct.pack('!BBQ', 0x80 | opcode, 127, length)
+
+class MessageParser():
+    '''
+    MessageParser class - splits the bytes received from a client into (opcode, payload) messages
+    '''
+    def __init__(self):
+        '''
+        Constructor
+        '''
+        self.buffer = bytearray()
+
+    def feed(self, data):
+        '''
+        feed - add received bytes, returns the messages completed by them
+        '''
+        self.buffer += data
+        messages = []
+        while len(self.buffer) >= 2:
+            opcode = self.buffer[0] & 0x0f
+            masked = self.buffer[1] & 0x80
+            length = self.buffer[1] & 0x7f
+            position = 2
+            if length == 126:
+                if len(self.buffer) < 4:
+                    break
+                (length,) = struct.unpack('!H', self.buffer[2:4])
+                position = 4
+            elif length == 127:
+                if len(self.buffer) < 10:
+                    break
+                (length,) = struct.unpack('!Q', self.buffer[2:10])
+                position = 10
+            if length > maxControlMessage:
+                raise ValueError("WebSocket message of {} bytes is too long".format(length))
+            mask = b''
+            if masked:
+                mask = self.buffer[position:position + 4]
+                position += 4
+            if len(self.buffer) < position + length:
+                break
+            payload = bytes(self.buffer[position:position + length])
+            if masked:
+                payload = bytes(byte ^ mask[index % 4] for (index, byte) in enumerate(payload))
+            del self.buffer[:position + length]
+            messages.append((opcode, payload))
+        return messages
+
+class WebSocketClient():
+    '''
+    WebSocketClient class - the rate and pause settings a client asked for
+    '''
+    def __init__(self):
+        '''
+        Constructor
+        '''
+        self.fps = 0.0
+        self.paused = False
+        self.closed = False
+        self.parser = MessageParser()
+
+    def interval(self):
+        '''
+        interval - seconds between frames, 0 for every frame
+        '''
+        return 1.0 / self.fps if self.fps > 0 else 0.0
+
+    def receive(self, data):
+        '''
+        receive - process bytes from the client, returns the bytes to send back (pongs and the close reply)
+        '''
+        if not data:
+            self.closed = True
+            return b''
+        reply = b''
+        for (opcode, payload) in self.parser.feed(data):
+            if opcode == opClose:
+                self.closed = True
+                reply += frameHeader(len(payload[:2]), opClose) + payload[:2]
+            elif opcode == opPing:
+                reply += frameHeader(len(payload), opPong) + payload
+            elif opcode in (opText, opContinuation):
+                self.control(payload)
+        return reply
+
+    def control(self, payload):
+        '''
+        control - apply a JSON control message
+        '''
+        try:
+            settings = json.loads(payload.decode('utf-8'))
+            if 'fps' in settings:
+                self.fps = max(0.0, float(settings['fps']))
+            if 'paused' in settings:
+                self.paused = bool(settings['paused'])
+            print("WebSocket client settings - fps:", self.fps, ", paused:", self.paused)
+        except (ValueError, TypeError, AttributeError):
+            print("Ignoring WebSocket control message:", payload[:80])
+
+def serveWebSocket(handler, source, timeout=10.0):
+    '''
+    serveWebSocket - upgrade a request of a threaded HTTP handler to a WebSocket and send the frames
+    of source until the client closes it.  Paused or throttled clients are not sent the frames
+    they skip.
+    '''
+    accept = acceptKey(handler.headers)
+    if accept is None:
+        source.close()
+        handler.send_error(400, "WebSocket upgrade expected")
+        return
+    handler.send_response(101)
+    handler.send_header('Upgrade', 'websocket')
+    handler.send_header('Connection', 'Upgrade')
+    handler.send_header('Sec-WebSocket-Accept', accept)
+    handler.end_headers()
+    connection = handler.connection
+    client = WebSocketClient()
+    sent = 0
+    try:
+        while not client.closed:
+            # idle on the socket while paused or until the next frame is due, reading control messages
+            wait = 0.0
+            if client.paused:
+                wait = 0.5
+            elif client.interval() > 0 and sent > 0:
+                wait = max(0.0, lastSent + client.interval() - time.monotonic())
+            (readable, _, _) = select.select([connection], [], [], wait)
+            if readable:
+                reply = client.receive(connection.recv(4096))
+                if reply:
+                    handler.wfile.write(reply)
+                continue
+            if client.paused:
+                continue
+            if client.interval() > 0 and sent > 0:
+                source.skip()
+            (sequence, frame) = source.next(timeout)
+            if sequence is None:
+                print("No frame for", timeout, "seconds - ending WebSocket stream")
+                break
+            if frame is None:
+                break
+            handler.wfile.write(frameHeader(len(frame)))
+            handler.wfile.write(frame)
+            sent += 1
+            lastSent = time.monotonic()
+        if not client.closed:
+            handler.wfile.write(frameHeader(0, opClose))
+    except (BrokenPipeError, ConnectionResetError, ValueError):
+        print('Removed WebSocket client')
+    finally:
+        print("WebSocket frames sent:", sent)
+        source.close()